@@ -21,6 +21,7 @@ from chromite.buildbot import cbuildbot_config
 from chromite.buildbot import cbuildbot_results as results_lib
 from chromite.buildbot import portage_utilities
 from chromite.lib import cros_build_lib
+from chromite.lib import resource_usage
 
 
 class BuilderStage(object):
@@ -257,6 +258,7 @@ class BuilderStage(object):
       return
 
     start_time = time.time()
+    start_usage = resource_usage.Sample()
 
     # Set default values
     result = results_lib.Results.SUCCESS
@@ -282,7 +284,8 @@ class BuilderStage(object):
     finally:
       elapsed_time = time.time() - start_time
       results_lib.Results.Record(self.name, result, description,
-                                 time=elapsed_time)
+                                 time=elapsed_time,
+                                 resources=resource_usage.Since(start_usage))
       self._Finish()
       sys.stdout.flush()
       sys.stderr.flush()
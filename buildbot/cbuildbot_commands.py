@@ -1117,7 +1117,7 @@ def BuildRecoveryImage(buildroot, board, image_dir, extra_env):
 
 
 def BuildTarball(buildroot, input_list, tarball_output, cwd=None,
-                 compressed=True):
+                 compressed=True, profile=cros_build_lib.COMP_PROFILE_DEFAULT):
   """Tars and zips files and directories from input_list to tarball_output.
 
   Args:
@@ -1125,7 +1125,10 @@ def BuildTarball(buildroot, input_list, tarball_output, cwd=None,
     input_list: A list of files and directories to be archived.
     tarball_output: Path of output tar archive file.
     cwd: Current working directory when tar command is executed.
-    compressed: Whether or not the tarball should be compressed with pbzip2.
+    compressed: Whether or not the tarball should be compressed with bzip2
+      (a parallel implementation, if available).
+    profile: The speed/ratio tradeoff to compress with; one of
+      cros_build_lib.COMP_PROFILES.
   """
   compressor = cros_build_lib.COMP_NONE
   chroot = None
@@ -1134,7 +1137,93 @@ def BuildTarball(buildroot, input_list, tarball_output, cwd=None,
     chroot = os.path.join(buildroot, 'chroot')
   cros_build_lib.CreateTarball(
       tarball_output, cwd, compression=compressor, chroot=chroot,
-      inputs=input_list)
+      inputs=input_list, profile=profile)
+
+
+def StreamTarball(buildroot, input_list, archive_path, filename, upload_url,
+                  debug, cwd=None, compression=cros_build_lib.COMP_XZ,
+                  profile=cros_build_lib.COMP_PROFILE_DEFAULT, acl=None,
+                  update_list=False, timeout=30 * 60):
+  """Tar, compress and upload files to Google Storage in a single pass.
+
+  This is the streaming equivalent of BuildTarball followed by
+  UploadArchivedFile: tar is piped through the compressor, and the tarball
+  is saved in the archive dir and checksummed as it is uploaded, rather than
+  uploaded once it has been written out.
+
+  Args:
+    buildroot: Root directory where build occurs.
+    input_list: A list of files and directories to be archived.
+    archive_path: Path to archive dir, where the tarball is saved too.
+    filename: Filename of the tarball to upload.
+    upload_url: Location where tarball should be uploaded.
+    debug: Whether we are in debug mode; the tarball is only saved then.
+    cwd: Current working directory when tar command is executed.
+    compression: The type of compression desired.  See the FindCompressor
+      function for details.
+    profile: The speed/ratio tradeoff to compress with; one of
+      cros_build_lib.COMP_PROFILES.
+    acl: Canned gsutil acl to use (e.g. 'public-read'), otherwise the internal
+         (private) one is used.
+    update_list: Flag to update the list of uploaded files.
+    timeout: Raise an exception if the upload takes longer than this timeout.
+
+  Returns:
+    A gs.StreamResult with the size, md5 and sha1 of the tarball, or None if
+    it was only saved.
+  """
+  local_path = os.path.join(archive_path, filename)
+  chroot = os.path.join(buildroot, 'chroot')
+  if debug or not upload_url:
+    cros_build_lib.CreateTarball(local_path, cwd, compression=compression,
+                                 chroot=chroot, inputs=input_list,
+                                 profile=profile)
+    return None
+
+  cmds = [['tar', '-cf', '-'] + input_list]
+  if compression != cros_build_lib.COMP_NONE:
+    cmds.append(cros_build_lib.GetCompressorCommand(
+        compression, chroot=chroot, profile=profile))
+
+  full_url = '%s/%s' % (upload_url, filename)
+  gs_context = gs.GSContext(gsutil_bin=_GSUTIL_PATH)
+  cros_build_lib.Info('Streaming %s to %s', filename, full_url)
+  success = False
+  try:
+    with cros_build_lib.SubCommandTimeout(timeout):
+      with cros_build_lib.CommandPool(max_parallel=len(cmds)) as pool:
+        # Chain the commands together with pipes; each command gets its own
+        # copies of the ends it uses, so ours are closed once it's started.
+        producers = []
+        stream = None
+        for cmd in cmds:
+          read_fd, write_fd = os.pipe()
+          try:
+            producers.append(pool.RunCommand(
+                cmd, cwd=cwd, input=stream, log_stdout_to_file=write_fd,
+                debug_level=logging.DEBUG))
+          finally:
+            os.close(write_fd)
+            if stream is not None:
+              os.close(stream)
+            stream = read_fd
+        try:
+          result = gs_context.CopyFromStream(
+              stream, full_url, acl=acl, local_path=local_path,
+              producers=producers)
+        finally:
+          os.close(stream)
+    success = True
+  finally:
+    if not success:
+      # Don't leave a partial tarball in the archive.
+      osutils.SafeUnlink(local_path)
+
+  if not acl:
+    gs_context.SetACL(full_url, _GS_ACL)
+  if update_list:
+    UpdateUploadedList(filename, archive_path, upload_url, debug)
+  return result
 
 
 def FindFilesWithPattern(pattern, target='./', cwd=os.curdir):
@@ -1224,24 +1313,6 @@ def BuildImageZip(archive_dir, image_dir):
   return filename
 
 
-def BuildStandaloneImageTarball(archive_dir, image_bin):
-  """Create a compressed tarball from the specified image.
-
-  Args:
-    archive_dir: Directory to store image zip.
-    image_bin: Image to zip up.
-
-    Returns the base name of the tarball.
-  """
-  # Strip off the .bin from the filename.
-  image_dir, image_filename = os.path.split(image_bin)
-  filename = '%s.tar.xz' % os.path.splitext(image_filename)[0]
-  archive_filename = os.path.join(archive_dir, filename)
-  cros_build_lib.CreateTarball(archive_filename, image_dir,
-                               inputs=[image_filename])
-  return filename
-
-
 def BuildFirmwareArchive(buildroot, board, archive_dir):
   """Build firmware_from_source.tar.bz2 in archive_dir from build root.
 
@@ -6,6 +6,7 @@
 
 """Unittests for commands."""
 
+import hashlib
 import os
 import sys
 
@@ -13,6 +14,7 @@ import constants
 sys.path.insert(0, constants.SOURCE_ROOT)
 from chromite.buildbot import cbuildbot_commands as commands
 from chromite.buildbot import cbuildbot_results as results_lib
+from chromite.lib import cros_build_lib
 from chromite.lib import cros_build_lib_unittest
 from chromite.lib import cros_test_lib
 from chromite.lib import git
@@ -351,5 +353,49 @@ class UnmockedTests(cros_test_lib.TempDirTestCase):
     # Verify the tarball contents.
     cros_test_lib.VerifyTarball(tarball, fw_archived_files)
 
+class StreamTarballTest(cros_test_lib.TempDirTestCase):
+  """Tests for StreamTarball against a fake gsutil."""
+
+  def setUp(self):
+    self.uploaded = os.path.join(self.tempdir, 'uploaded')
+    self.archive_path = os.path.join(self.tempdir, 'archive')
+    self.tarball = os.path.join(self.archive_path, 'foo.tar.gz')
+    os.makedirs(self.archive_path)
+    cros_test_lib.CreateOnDiskHierarchy(self.tempdir, ['src/foo.txt'])
+
+    gsutil = os.path.join(self.tempdir, 'gsutil')
+    osutils.WriteFile(gsutil, '#!/bin/sh\ncat > %(path)s.tmp || exit 1\n'
+                      'mv %(path)s.tmp %(path)s\n' % {'path': self.uploaded})
+    os.chmod(gsutil, 0755)
+    boto_file = os.path.join(self.tempdir, 'boto')
+    osutils.Touch(boto_file)
+    for patcher in (mock.patch.object(commands, '_GSUTIL_PATH', gsutil),
+                    mock.patch.dict(os.environ, {'BOTO_CONFIG': boto_file})):
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def _StreamTarball(self, inputs):
+    return commands.StreamTarball(
+        self.tempdir, inputs, self.archive_path, 'foo.tar.gz', 'gs://foo/bar',
+        False, cwd=os.path.join(self.tempdir, 'src'),
+        compression=cros_build_lib.COMP_GZIP, acl='public-read')
+
+  def testStreamTarball(self):
+    """Verify the tarball is uploaded, saved and checksummed in one pass."""
+    result = self._StreamTarball(['foo.txt'])
+    cros_test_lib.VerifyTarball(self.tarball, ['foo.txt'])
+    data = osutils.ReadFile(self.tarball)
+    self.assertEqual(osutils.ReadFile(self.uploaded), data)
+    self.assertEqual(result, (len(data), hashlib.md5(data).hexdigest(),
+                              hashlib.sha1(data).hexdigest()))
+
+  def testStreamTarballFailure(self):
+    """Verify a failed tar is reported, and nothing is uploaded or saved."""
+    self.assertRaises(cros_build_lib.RunCommandError, self._StreamTarball,
+                      ['missing'])
+    self.assertFalse(os.path.exists(self.uploaded))
+    self.assertFalse(os.path.exists(self.tarball))
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
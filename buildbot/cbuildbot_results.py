@@ -9,6 +9,7 @@ import math
 import os
 
 from chromite.lib import cros_build_lib
+from chromite.lib import resource_usage
 
 
 def _GetCheckpointFile(buildroot):
@@ -125,7 +126,8 @@ class _Results(object):
 
   def __init__(self):
     # List of results for all stages that's built up as we run. Members are of
-    #  the form ('name', SUCCESS | FORGIVEN | Exception, None | description)
+    #  the form ('name', SUCCESS | FORGIVEN | Exception, None | description,
+    #  time, None | resource usage)
     self._results_log = []
 
     # Stages run in a previous run and restored. Stored as a dictionary of
@@ -150,7 +152,7 @@ class _Results(object):
     This method returns true if all was successful or forgiven.
     """
     for entry in self._results_log:
-      _, result, _, _ = entry
+      result = entry[1]
       if not result in (self.SUCCESS, self.FORGIVEN):
         return False
 
@@ -160,14 +162,14 @@ class _Results(object):
     """Return true stage passed."""
     cros_build_lib.Info('Checking for %s' % name)
     for entry in self._results_log:
-      entry, result, _, _ = entry
+      entry, result = entry[:2]
       if entry == name:
         cros_build_lib.Info('Found %s' % result)
         return result == self.SUCCESS
 
     return False
 
-  def Record(self, name, result, description=None, time=0):
+  def Record(self, name, result, description=None, time=0, resources=None):
     """Store off an additional stage result.
 
        Args:
@@ -178,8 +180,11 @@ class _Results(object):
              The exception the stage errored with.
          description:
            The textual backtrace of the exception, or None
+         time: How long the stage took, in seconds.
+         resources: The resources the stage used, from resource_usage.Since(),
+           or None
     """
-    self._results_log.append((name, result, description, time))
+    self._results_log.append((name, result, description, time, resources))
 
   def UpdateResult(self, name, result, description=None):
     """Updates a stage result with a different result.
@@ -194,8 +199,9 @@ class _Results(object):
     """
     for index in range(len(self._results_log)):
       if self._results_log[index][0] == name:
-        _, _, _, run_time = self._results_log[index]
-        self._results_log[index] = name, result, description, run_time
+        run_time, resources = self._results_log[index][3:]
+        self._results_log[index] = (name, result, description, run_time,
+                                    resources)
         break
 
   def Get(self):
@@ -206,6 +212,19 @@ class _Results(object):
     """
     return self._results_log
 
+  def Mark(self):
+    """Returns a marker for the results recorded so far; see GetSince."""
+    return len(self._results_log)
+
+  def GetSince(self, mark):
+    """Fetch the stage results recorded since Mark() returned |mark|.
+
+    Background steps keep the results (and the stages restored from a
+    previous run) that they inherit from their parent, so that they still
+    skip completed stages, and use this to send back only their own.
+    """
+    return self._results_log[mark:]
+
   def GetPrevious(self):
     """Fetch stage results.
 
@@ -216,7 +235,7 @@ class _Results(object):
 
   def SaveCompletedStages(self, out):
     """Save the successfully completed stages to the provided file |out|."""
-    for name, result, description, time in self._results_log:
+    for name, result, description, time, _ in self._results_log:
       if result != self.SUCCESS: break
       out.write(self.SPLIT_TOKEN.join([name, str(description), str(time)]))
       out.write('\n')
@@ -241,7 +260,7 @@ class _Results(object):
     Returns:
        A list of RecordedTraceback objects.
     """
-    for name, result, description, _ in self._results_log:
+    for name, result, description, _, _ in self._results_log:
       # If result is not SUCCESS or FORGIVEN, then the stage failed, and
       # result is the exception object and description is a string containing
       # the full traceback.
@@ -265,7 +284,7 @@ class _Results(object):
     out.write(line)
     out.write(edge + ' Stage Results\n')
 
-    for name, result, _, run_time in results:
+    for name, result, _, run_time, resources in results:
       timestr = datetime.timedelta(seconds=math.ceil(run_time))
 
       out.write(line)
@@ -290,6 +309,8 @@ class _Results(object):
           details = ' with %s' % type(result).__name__
 
       out.write('%s %s %s (%s)%s\n' % (edge, status, name, timestr, details))
+      if resources:
+        out.write('%s   %s\n' % (edge, resource_usage.Format(resources)))
 
     out.write(line)
 
@@ -20,6 +20,7 @@ from chromite.buildbot import builderstage as bs
 from chromite.buildbot import cbuildbot_commands as commands
 from chromite.buildbot import cbuildbot_config
 from chromite.buildbot import configure_repo
+from chromite.buildbot import image_cache
 from chromite.buildbot import cbuildbot_results as results_lib
 from chromite.buildbot import constants
 from chromite.buildbot import lkgm_manager
@@ -32,6 +33,7 @@ from chromite.lib import commandline
 from chromite.lib import cros_build_lib
 from chromite.lib import git
 from chromite.lib import gs
+from chromite.lib import locking
 from chromite.lib import toolchain
 from chromite.lib import osutils
 from chromite.lib import parallel
@@ -113,9 +115,15 @@ class CleanUpStage(bs.BuilderStage):
   def _DeleteChroot(self):
     chroot = os.path.join(self._build_root, constants.DEFAULT_CHROOT_DIR)
     if os.path.exists(chroot):
-      cros_build_lib.RunCommand(['cros_sdk', '--delete', '--chroot', chroot],
-                                self._build_root,
-                                cwd=self._build_root)
+      # This is what `cros_sdk --delete` does, except that the chroot is
+      # deleted in the background rather than holding up the build; take
+      # the same lock, so that nothing is using the chroot meanwhile.
+      lock_path = os.path.join(os.path.dirname(chroot),
+                               '.%s_lock' % os.path.basename(chroot))
+      with locking.FileLock(lock_path, 'chroot lock') as lock:
+        lock.write_lock()
+        commands.CleanUpMountPoints(chroot)
+        osutils.RmDirInBackground(chroot, ignore_missing=True, sudo=True)
 
   def _DeleteArchivedTrybotImages(self):
     """For trybots, clear all previus archive images to save space."""
@@ -465,7 +473,7 @@ class SyncStage(bs.BuilderStage):
                            'NEXT MANIFEST: %s' % next_manifest]))
 
     if not self.skip_sync:
-      self.repo.Sync(next_manifest)
+      self.repo.Sync(next_manifest, incremental=True)
     print >> sys.stderr, self.repo.ExportManifest(
         mark_revision=self.output_manifest_sha1)
 
@@ -1100,8 +1108,12 @@ class BuildTargetStage(BoardSpecificBuilderStage):
     self._tarball_dir = None
     self._version = version if version else ''
 
-  def _CommunicateVersion(self):
-    """Communicates to archive_stage the image path of this stage."""
+  def _CommunicateVersion(self, image_cache_key=None):
+    """Communicates to archive_stage the image path of this stage.
+
+    Args:
+      image_cache_key: The key the images were cached with, if they were.
+    """
     verinfo = manifest_version.VersionInfo.from_repo(self._build_root)
     if self._version:
       version = self._version
@@ -1114,7 +1126,7 @@ class BuildTargetStage(BoardSpecificBuilderStage):
     if not self._version:
       version += '-b%s' % self._options.buildnumber
 
-    self._archive_stage.SetVersion(version)
+    self._archive_stage.SetVersion(version, image_cache_key=image_cache_key)
 
   def HandleSkip(self):
     self._CommunicateVersion()
@@ -1126,20 +1138,53 @@ class BuildTargetStage(BoardSpecificBuilderStage):
         images_can_build)
 
     rootfs_verification = self._build_config['rootfs_verification']
-    commands.BuildImage(self._build_root,
-                        self._current_board,
-                        list(images_to_build),
-                        rootfs_verification=rootfs_verification,
-                        version=self._version,
-                        disk_layout=self._build_config['disk_layout'],
-                        extra_env=self._env)
-
-    if self._build_config['vm_tests']:
-      commands.BuildVMImageForTesting(
-          self._build_root,
-          self._current_board,
-          disk_layout=self._build_config['disk_vm_layout'],
-          extra_env=self._env)
+
+    # Images stamped with the version can only be reused by a rebuild of the
+    # same version, so don't hash or store them for a version built just
+    # once, or for unversioned builds.
+    cache = image_cache.ImageCache(self._build_root, self._current_board)
+    cache_key = None
+    if self._version and cache.IsRebuild(self._version):
+      cache_key = cache.GetImageKey(
+          [self._version, ' '.join(sorted(images_to_build)),
+           str(rootfs_verification), str(self._build_config['disk_layout']),
+           str(self._build_config['vm_tests']),
+           str(self._build_config['disk_vm_layout'])] +
+          ['%s=%s' % x for x in sorted(self._env.items())])
+
+    cached_image = None
+    if cache_key and self._options.image_cache:
+      cached_image = cache.RestoreImages(
+          cache_key, os.path.dirname(self.GetImageDirSymlink()))
+
+    if cached_image:
+      cros_build_lib.Info('Reusing images %s cached from an earlier build '
+                          'with the same inputs (key %s)', cached_image,
+                          cache_key)
+      cros_build_lib.PrintBuildbotStepText('cached images')
+      latest_link = self.GetImageDirSymlink('latest')
+      if os.path.lexists(latest_link):
+        os.remove(latest_link)
+      os.symlink(cached_image, latest_link)
+    else:
+      commands.BuildImage(self._build_root,
+                          self._current_board,
+                          list(images_to_build),
+                          rootfs_verification=rootfs_verification,
+                          version=self._version,
+                          disk_layout=self._build_config['disk_layout'],
+                          extra_env=self._env)
+
+      if self._build_config['vm_tests']:
+        commands.BuildVMImageForTesting(
+            self._build_root,
+            self._current_board,
+            disk_layout=self._build_config['disk_vm_layout'],
+            extra_env=self._env)
+
+      if (cache_key and
+          not cache.StoreImages(cache_key, self.GetImageDirSymlink('latest'))):
+        cache_key = None
 
     # Update link to latest image.
     latest_image = os.readlink(self.GetImageDirSymlink('latest'))
@@ -1148,7 +1193,7 @@ class BuildTargetStage(BoardSpecificBuilderStage):
       os.remove(cbuildbot_image_link)
 
     os.symlink(latest_image, cbuildbot_image_link)
-    self._CommunicateVersion()
+    self._CommunicateVersion(image_cache_key=cache_key)
 
   def _BuildAutotestTarballs(self):
     # Build autotest tarball, which is used in archive step. This is generated
@@ -1469,11 +1514,9 @@ class SDKPackageStage(bs.BuilderStage):
     # TODO(zbehan): We cannot use xz from the chroot unless it's
     # statically linked.
     extra_args = ['--exclude=%s/*' % path for path in self._EXCLUDED_PATHS]
-    # Options for maximum compression.
-    extra_env = { 'XZ_OPT' : '-e9' }
     cros_build_lib.CreateTarball(
         dest_tarball, sdk_path, sudo=True, extra_args=extra_args,
-        extra_env=extra_env)
+        profile=cros_build_lib.COMP_PROFILE_BEST)
 
   def CreateManifestFromSDK(self, sdk_path, dest_manifest):
     """Creates a manifest from a given source chroot.
@@ -1530,6 +1573,21 @@ class ArchiveStage(BoardSpecificBuilderStage):
   _BUILDBOT_ARCHIVE = 'buildbot_archive'
   _TRYBOT_ARCHIVE = 'trybot_archive'
 
+  # The number of artifacts to upload at once.
+  UPLOAD_PROCESSES = 16
+
+  # The number of those that release and other artifacts may take, so that
+  # some are always left for the classes above them.
+  UPLOAD_RELEASE_PROCESSES = 12
+  UPLOAD_ARTIFACTS_PROCESSES = 8
+
+  # The classes of uploads, from the highest priority to the lowest.  HW test
+  # artifacts block the test lab, and release artifacts block signing.
+  _UPLOAD_HW_TEST = 'hw-test-uploads'
+  _UPLOAD_RELEASE = 'release-uploads'
+  _UPLOAD_ARTIFACTS = 'artifact-uploads'
+  _UPLOAD_SYMBOLS = 'symbol-uploads'
+
   @classmethod
   def GetArchiveRoot(cls, buildroot, trybot=False):
     """Return the location where trybot archive images are kept."""
@@ -1542,6 +1600,7 @@ class ArchiveStage(BoardSpecificBuilderStage):
     # Set version is dependent on setting external to class.  Do not use
     # directly.  Use GetVersion() instead.
     self._set_version = ArchiveStage._VERSION_NOT_SET
+    self._image_cache_key = None
     self.prod_archive = self._options.buildbot and not self._options.debug
     self._archive_root = self.GetArchiveRoot(
         self._build_root, trybot=not self.prod_archive)
@@ -1571,15 +1630,16 @@ class ArchiveStage(BoardSpecificBuilderStage):
     self._archive_path = None
     self._pkg_dir = None
 
-  def SetVersion(self, path_to_image):
+  def SetVersion(self, path_to_image, image_cache_key=None):
     """Sets the cros version for the given built path to an image.
 
     This must be called in order for archive stage to finish.
 
     Args:
       path_to_image: Path to latest image.""
+      image_cache_key: The key the images were cached with, if they were.
     """
-    self._version_queue.put(path_to_image)
+    self._version_queue.put((path_to_image, image_cache_key))
 
   def AutotestTarballsReady(self, autotest_tarballs):
     """Tell Archive Stage that autotest tarball is ready.
@@ -1602,16 +1662,24 @@ class ArchiveStage(BoardSpecificBuilderStage):
     """
     self._full_autotest_tarball_queue.put(full_autotest_tarball)
 
-  def GetVersion(self):
-    """Gets the version for the archive stage."""
+  def _WaitForVersion(self):
+    """Waits for the version and image cache key from BuildTargetStage."""
     if self._set_version == ArchiveStage._VERSION_NOT_SET:
-      version = self._version_queue.get()
+      version, self._image_cache_key = self._version_queue.get()
       self._set_version = version
       # Put the version right back on the queue in case anyone else is waiting.
-      self._version_queue.put(version)
+      self._version_queue.put((version, self._image_cache_key))
 
+  def GetVersion(self):
+    """Gets the version for the archive stage."""
+    self._WaitForVersion()
     return self._set_version
 
+  def GetImageCacheKey(self):
+    """Gets the key the images were cached with, or None."""
+    self._WaitForVersion()
+    return self._image_cache_key
+
   def WaitForHWTestUploads(self):
     """Waits until artifacts needed for HWTest stage are uploaded.
 
@@ -1771,6 +1839,20 @@ class ArchiveStage(BoardSpecificBuilderStage):
       json_input['toolchain-tuple'] = (
           toolchain.FilterToolchains(toolchains, 'default', True).keys() +
           toolchain.FilterToolchains(toolchains, 'default', False).keys())
+
+    # The stages that have completed by now, and the resources they used.
+    stage_results = []
+    for name, result, _, run_time, resources in results_lib.Results.Get():
+      if result == results_lib.Results.SUCCESS:
+        status = 'passed'
+      elif result == results_lib.Results.FORGIVEN:
+        status = 'forgiven'
+      else:
+        status = 'failed'
+      stage_results.append({'name': name, 'status': status,
+                            'duration': run_time,
+                            'resources': resources or {}})
+    json_input['results'] = stage_results
     osutils.WriteFile(target, json.dumps(json_input))
     self._upload_queue.put([constants.METADATA_JSON])
 
@@ -1846,7 +1928,6 @@ class ArchiveStage(BoardSpecificBuilderStage):
     upload_queue = self._upload_queue
     upload_symbols_queue = self._upload_symbols_queue
     hw_test_upload_queue = self._hw_test_upload_queue
-    bg_task_runner = parallel.BackgroundTaskRunner
 
     extra_env = {}
     if config['useflags']:
@@ -1886,6 +1967,22 @@ class ArchiveStage(BoardSpecificBuilderStage):
           hw_test_upload_queue.put([commands.ArchiveFile(tarball,
                                                          archive_path)])
 
+    def GenerateFullPayload(target_image_path, update_payloads_dir):
+      """Generates the full payloads, or reuses those cached for the image."""
+      cache = image_cache.ImageCache(buildroot, board)
+      cache_key = self.GetImageCacheKey()
+      if (cache_key and self._options.image_cache and
+          cache.RestorePayloads(cache_key, update_payloads_dir)):
+        cros_build_lib.Info('Reusing payloads cached with the images '
+                            '(key %s)', cache_key)
+        cros_build_lib.PrintBuildbotStepText('cached payloads')
+        return
+
+      commands.GenerateFullPayload(
+          buildroot, target_image_path, update_payloads_dir)
+      if cache_key:
+        cache.StorePayloads(cache_key, update_payloads_dir)
+
     def ArchivePayloads():
       """Archives update payloads when they are ready."""
       if self._build_config['upload_hw_test_artifacts']:
@@ -1896,8 +1993,7 @@ class ArchiveStage(BoardSpecificBuilderStage):
         # for the purpose of imaging machines. This means we shouldn't generate
         # delta payloads for n-1->n testing.
         if self._build_config['build_type'] != constants.CANARY_TYPE:
-          commands.GenerateFullPayload(
-              buildroot, target_image_path, update_payloads_dir)
+          GenerateFullPayload(target_image_path, update_payloads_dir)
         else:
           commands.GenerateNPlus1Payloads(
               buildroot, self.bot_archive_root, target_image_path,
@@ -1962,19 +2058,14 @@ class ArchiveStage(BoardSpecificBuilderStage):
             buildroot, board, archive_path, image_root)
         release_upload_queue.put([filename])
 
-    def ArchiveStandaloneTarball(image_file):
-      """Build and upload a single tarball."""
-      release_upload_queue.put([commands.BuildStandaloneImageTarball(
-          archive_path, image_file)])
-
     def ArchiveStandaloneTarballs():
-      """Build and upload standalone tarballs for each image."""
+      """Stream standalone tarballs for each image to Google Storage."""
       if config['upload_standalone_images']:
-        inputs = []
         for image_file in glob.glob(os.path.join(image_dir, '*.bin')):
-          if os.path.basename(image_file) != 'chromiumos_qemu_image.bin':
-            inputs.append([image_file])
-        parallel.RunTasksInProcessPool(ArchiveStandaloneTarball, inputs)
+          image_filename = os.path.basename(image_file)
+          if image_filename != 'chromiumos_qemu_image.bin':
+            filename = '%s.tar.xz' % os.path.splitext(image_filename)[0]
+            release_upload_queue.put([filename, [image_filename]])
 
     def ArchiveZipFiles():
       """Build and archive zip files.
@@ -2035,20 +2126,57 @@ class ArchiveStage(BoardSpecificBuilderStage):
                                    ArchiveStandaloneTarballs,
                                    ArchiveZipFiles])
 
-    def UploadArtifact(filename):
-      """Upload generated artifact to Google Storage."""
+    def UploadArtifact(filename, image_files=None):
+      """Upload generated artifact to Google Storage.
+
+      Args:
+        filename: The name of the artifact in the archive dir.
+        image_files: If set, the artifact is a tarball of these files from the
+          image dir, which is built as it is uploaded.
+      """
       acl = None if config['internal'] else 'public-read'
-      commands.UploadArchivedFile(archive_path, upload_url, filename, debug,
-                                  update_list=True, acl=acl)
+      if image_files:
+        commands.StreamTarball(buildroot, image_files, archive_path, filename,
+                               upload_url, debug, cwd=image_dir, acl=acl,
+                               update_list=True)
+      else:
+        commands.UploadArchivedFile(archive_path, upload_url, filename, debug,
+                                    update_list=True, acl=acl)
 
-    def ArchiveArtifactsForHWTesting(num_upload_processes=6):
+    def GetArtifactSize(filename, image_files=None):
+      """Return the size of an artifact, for the upload bandwidth budget.
+
+      Tarballs that are built as they are uploaded are budgeted by the size of
+      their inputs, which bounds their size.
+      """
+      if image_files:
+        return sum(os.path.getsize(os.path.join(image_dir, x))
+                   for x in image_files)
+      return os.path.getsize(os.path.join(archive_path, filename))
+
+    rate = None
+    if self._options.upload_bandwidth:
+      rate = self._options.upload_bandwidth * 2 ** 20
+    uploads = parallel.PriorityTaskRunner(processes=self.UPLOAD_PROCESSES,
+                                          rate=rate)
+    uploads.AddQueue(self._UPLOAD_HW_TEST, hw_test_upload_queue,
+                     UploadArtifact, size=GetArtifactSize)
+    uploads.AddQueue(self._UPLOAD_RELEASE, release_upload_queue,
+                     UploadArtifact, size=GetArtifactSize,
+                     max_parallel=self.UPLOAD_RELEASE_PROCESSES)
+    uploads.AddQueue(self._UPLOAD_ARTIFACTS, upload_queue, UploadArtifact,
+                     size=GetArtifactSize,
+                     max_parallel=self.UPLOAD_ARTIFACTS_PROCESSES)
+    uploads.AddQueue(self._UPLOAD_SYMBOLS, upload_symbols_queue, UploadSymbols,
+                     max_parallel=1)
+
+    def ArchiveArtifactsForHWTesting():
       """Archives artifacts required for HWTest stage."""
       success = False
       try:
-        with bg_task_runner(UploadArtifact, queue=hw_test_upload_queue,
-                            processes=num_upload_processes):
-          steps = [ArchiveAutotestTarballs, ArchivePayloads]
-          parallel.RunParallelSteps(steps)
+        steps = [ArchiveAutotestTarballs, ArchivePayloads]
+        parallel.RunParallelSteps(steps)
+        uploads.Close(self._UPLOAD_HW_TEST)
         success = True
       finally:
         self._hw_test_uploads_status_queue.put(success)
@@ -2081,15 +2209,14 @@ class ArchiveStage(BoardSpecificBuilderStage):
                           profile=self._options.profile or config['profile'],
                           sign_types=sign_types)
 
-    def ArchiveReleaseArtifacts(num_upload_processes=10):
-      with bg_task_runner(UploadArtifact, queue=release_upload_queue,
-                          processes=num_upload_processes):
-        steps = [ArchiveDebugSymbols, BuildAndArchiveAllImages,
-                 ArchiveFirmwareImages]
-        parallel.RunParallelSteps(steps)
+    def ArchiveReleaseArtifacts():
+      steps = [ArchiveDebugSymbols, BuildAndArchiveAllImages,
+               ArchiveFirmwareImages]
+      parallel.RunParallelSteps(steps)
+      uploads.Close(self._UPLOAD_RELEASE)
       PushImage()
 
-    def BuildAndArchiveArtifacts(num_upload_processes=10):
+    def BuildAndArchiveArtifacts():
       # Run archiving steps in parallel.
       steps = [ArchiveReleaseArtifacts, ArchiveArtifactsForHWTesting,
                self.ArchiveMetadataJson]
@@ -2098,11 +2225,10 @@ class ArchiveStage(BoardSpecificBuilderStage):
             [self.ArchiveStrippedChrome, self.BuildAndArchiveChromeSysroot,
              self.ArchiveChromeEbuildEnv, ArchiveImageScripts])
 
-      with bg_task_runner(UploadSymbols, queue=upload_symbols_queue,
-                          processes=1):
-        with bg_task_runner(UploadArtifact, queue=upload_queue,
-                            processes=num_upload_processes):
-          parallel.RunParallelSteps(steps)
+      # All artifacts are uploaded by one pool, which uploads them in order of
+      # priority.  Exiting it waits for the remaining uploads to finish.
+      with uploads:
+        parallel.RunParallelSteps(steps)
 
     def MarkAsLatest():
       # Update and upload LATEST file.
@@ -21,6 +21,7 @@ from chromite.buildbot import cbuildbot_config as config
 from chromite.buildbot import cbuildbot_commands as commands
 from chromite.buildbot import cbuildbot_results as results_lib
 from chromite.buildbot import cbuildbot_stages as stages
+from chromite.buildbot import image_cache
 from chromite.buildbot import lkgm_manager
 from chromite.buildbot import manifest_version
 from chromite.buildbot import repository
@@ -32,6 +33,7 @@ from chromite.lib import osutils
 from chromite.lib import parallel
 from chromite.lib import parallel_unittest
 from chromite.lib import partial_mock
+from chromite.lib import resource_usage
 from chromite.scripts import cbuildbot
 
 # TODO(build): Finish test wrapper (http://crosbug.com/37517).
@@ -956,7 +958,8 @@ class BuildTargetStageTest(AbstractStageTest, cros_test_lib.MockTestCase):
                                       ).AndReturn(full_autotest_tarball)
     self.archive_stage_mock.AutotestTarballsReady(tarballs)
     self.archive_stage_mock.FullAutotestTarballReady(full_autotest_tarball)
-    self.archive_stage_mock.SetVersion(self.branch_version)
+    self.archive_stage_mock.SetVersion(self.branch_version,
+                                       image_cache_key=None)
 
     shutil.copyfile(full_autotest_tarball_path,
                     os.path.join(self.images_root, 'latest-cbuildbot',
@@ -983,7 +986,45 @@ class BuildTargetStageTest(AbstractStageTest, cros_test_lib.MockTestCase):
     commands.BuildImage(self.build_root, self._current_board, ['test'],
                         disk_layout=None, rootfs_verification=True,
                         version=self.version, extra_env={})
-    self.archive_stage_mock.SetVersion(self.branch_version)
+    self.archive_stage_mock.SetVersion(self.branch_version,
+                                       image_cache_key=None)
+
+    self.mox.ReplayAll()
+    self.RunStage()
+    self.mox.VerifyAll()
+
+  def testCachedImages(self):
+    """Make sure cached images are reused rather than rebuilt."""
+    self.build_config['useflags'] = None
+    self.mox.StubOutWithMock(image_cache.ImageCache, 'IsRebuild')
+    self.mox.StubOutWithMock(image_cache.ImageCache, 'GetImageKey')
+    self.mox.StubOutWithMock(image_cache.ImageCache, 'RestoreImages')
+
+    # The 'latest' link is updated before 'latest-cbuildbot', so record the
+    # expectations from setUp again in that order.
+    self.mox.ResetAll()
+    manifest_version.VersionInfo._LoadFromFile()
+    latest_image_dir = os.path.join(self.images_root, 'latest')
+    os.symlink('myimage', latest_image_dir)
+    os.readlink(latest_image_dir).AndReturn('myimage')
+    os.symlink('myimage', self.latest_cbuildbot)
+
+    commands.Build(self.build_root,
+                   self._current_board,
+                   build_autotest=mox.IgnoreArg(),
+                   usepkg=mox.IgnoreArg(),
+                   chrome_root=None,
+                   skip_toolchain_update=mox.IgnoreArg(),
+                   nowithdebug=mox.IgnoreArg(),
+                   packages=mox.IgnoreArg(),
+                   extra_env={})
+    self.archive_stage_mock.AutotestTarballsReady(None)
+    image_cache.ImageCache.IsRebuild(self.version).AndReturn(True)
+    image_cache.ImageCache.GetImageKey(mox.IgnoreArg()).AndReturn('key')
+    image_cache.ImageCache.RestoreImages('key', self.images_root).AndReturn(
+        'myimage')
+    self.archive_stage_mock.SetVersion(self.branch_version,
+                                       image_cache_key='key')
 
     self.mox.ReplayAll()
     self.RunStage()
@@ -1018,7 +1059,8 @@ class BuildTargetStageTest(AbstractStageTest, cros_test_lib.MockTestCase):
                         rootfs_verification=True,
                         disk_layout=None, version=self.version,
                         extra_env=proper_env)
-    self.archive_stage_mock.SetVersion(self.branch_version)
+    self.archive_stage_mock.SetVersion(self.branch_version,
+                                       image_cache_key=None)
 
     self.mox.ReplayAll()
     self.RunStage()
@@ -1079,7 +1121,8 @@ class BuildTargetStageTest(AbstractStageTest, cros_test_lib.MockTestCase):
                                    fake_autotest_dir).AndReturn(tarballs)
     self.archive_stage_mock.AutotestTarballsReady(tarballs)
     self.archive_stage_mock.SetVersion('%s-b%s' % (self.branch_version,
-                                                   self.options.buildnumber))
+                                                   self.options.buildnumber),
+                                       image_cache_key=None)
     self.mox.ReplayAll()
     self.RunStage()
     self.mox.VerifyAll()
@@ -1089,13 +1132,16 @@ class ArchiveStageMock(partial_mock.PartialMock):
   """Partial mock for Archive Stage."""
 
   TARGET = 'chromite.buildbot.cbuildbot_stages.ArchiveStage'
-  ATTRS = ('GetVersion', 'WaitForBreakpadSymbols',)
+  ATTRS = ('GetVersion', 'GetImageCacheKey', 'WaitForBreakpadSymbols',)
 
   VERSION = '0.0.0.1'
 
   def GetVersion(self, _inst):
     return self.VERSION
 
+  def GetImageCacheKey(self, _inst):
+    return None
+
   def WaitForBreakpadSymbols(self, _inst):
     return True
 
@@ -1157,6 +1203,10 @@ class ArchiveStageTest(AbstractStageTest, cros_test_lib.MockTestCase):
 
   def testArchiveMetadataJson(self):
     """Test that the json metadata is built correctly"""
+    results_lib.Results.Clear()
+    results_lib.Results.Record('Pass', results_lib.Results.SUCCESS, time=1,
+                               resources={resource_usage.CPU_SECONDS: 2.5})
+
     # First run the code.
     stage = self.ConstructStage()
     stage._Initialize()
@@ -1186,6 +1236,9 @@ class ArchiveStageTest(AbstractStageTest, cros_test_lib.MockTestCase):
     self.assertEquals(json_data['metadata-version'], '1')
     self.assertEquals(json_data['toolchain-tuple'], ['i686-pc-linux-gnu',
                                                      'arm-none-eabi'])
+    self.assertEquals(json_data['results'], [
+        {'name': 'Pass', 'status': 'passed', 'duration': 1,
+         'resources': {resource_usage.CPU_SECONDS: 2.5}}])
   def testChromeEnvironment(self):
     """Test that the Chrome environment is built."""
     # Create the chrome environment compressed file.
@@ -1404,12 +1457,15 @@ class BuildStagesResultsTest(cros_test_lib.TestCase):
     # Break out the asserts to be per item to make debugging easier
     self.assertEqual(len(expectedResults), len(actualResults))
     for i in xrange(len(expectedResults)):
-      name, result, description, runtime = actualResults[i]
+      name, result, description, runtime, resources = actualResults[i]
 
       if result != results_lib.Results.SUCCESS:
         self.assertTrue(isinstance(description, str))
 
       self.assertTrue(runtime >= 0 and runtime < 2.0)
+      # Stages skipped after a restore don't record the resources used.
+      if resources is not None:
+        self.assertTrue(resources[resource_usage.CPU_SECONDS] >= 0)
       self.assertEqual(expectedResults[i], (name, result))
 
   def _PassString(self):
@@ -1584,6 +1640,19 @@ class BuildStagesResultsTest(cros_test_lib.TestCase):
       self.assertEqual(expectedLines[i], actualLines[i])
     self.assertEqual(len(expectedLines), len(actualLines))
 
+  def testStagesReportResources(self):
+    """Tests the resources used by stages are reported."""
+    results_lib.Results.Clear()
+    results_lib.Results.Record('Pass', results_lib.Results.SUCCESS, time=1,
+                               resources={resource_usage.CPU_SECONDS: 2.5,
+                                          resource_usage.NET_BYTES: 2048})
+
+    results = StringIO.StringIO()
+    results_lib.Results.Report(results)
+
+    self.assertTrue('** PASS Pass (0:00:01)\n'
+                    '**   cpu 2.5s, net 2.0 KiB\n' in results.getvalue())
+
   def testSaveCompletedStages(self):
     """Tests that we can save out completed stages."""
 
@@ -216,9 +216,20 @@ DEFAULT_CQ_READY_QUERY = ('status:open AND CodeReview=+2 AND Verified=+1 '
 # locations and standardize.
 KNOWN_ACL_FILES = {'slave': os.path.expanduser('~/slave_archive_acl')}
 
+# If set, cros_build_lib.RunCommand appends a JSON record of the resources
+# used by every command it runs to the file this names.
+RUNCOMMAND_STATS_ENVVAR = 'CROS_RUNCOMMAND_STATS'
+
+# While a lib.chroot_server.ChrootServer is running, this names its chroot,
+# and RunCommand(..., enter_chroot=True) routes commands through it.
+CHROOT_SERVER_ENVVAR = 'CROS_CHROOT_SERVER'
+# Where the chroot server listens, relative to the chroot.
+CHROOT_SERVER_SOCKET = 'tmp/cros_chroot_server.sock'
+
 # Environment variables that should be exposed to all children processes
 # invoked via cros_build_lib.RunCommand.
-ENV_PASSTHRU = ('CROS_SUDO_KEEP_ALIVE', SHARED_CACHE_ENVVAR)
+ENV_PASSTHRU = ('CROS_SUDO_KEEP_ALIVE', SHARED_CACHE_ENVVAR,
+                RUNCOMMAND_STATS_ENVVAR, CHROOT_SERVER_ENVVAR)
 
 # List of variables to proxy into the chroot from the host, and to
 # have sudo export if existent. Anytime this list is modified, a new
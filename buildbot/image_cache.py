@@ -0,0 +1,256 @@
+# Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Cache the images and payloads built for a board on this builder.
+
+Images are keyed on a hash of everything they are built from: the packages
+installed in the chroot and the board (by CPV, and by the SHA1 of each
+binary package), the scripts that build them, and the parameters given to
+those scripts.  build_image stamps the version into each image, so only a
+rebuild of a version can reuse its images; the cache remembers which
+versions were built, and is only used when one is built again.
+
+Payloads are kept with the images they were generated from, keyed on the
+scripts that generate them, so that they are only reused along with those
+exact images.  When nothing has changed since an earlier build, the cached
+copies are reused instead of being rebuilt.
+"""
+
+import hashlib
+import os
+
+from chromite.buildbot import constants
+from chromite.lib import binpkg
+from chromite.lib import cros_build_lib
+from chromite.lib import git
+from chromite.lib import osutils
+
+
+# Where the cache is kept, relative to the buildroot.
+CACHE_DIR = '.cache/images'
+
+# How many entries of each kind to keep per board.  Each set of images takes
+# up several GiB.
+MAX_ENTRIES = 2
+
+# How many of the versions built most recently to remember per board.
+MAX_VERSIONS = 50
+
+# The source trees whose scripts build images and generate payloads.
+IMAGE_SCRIPTS = ('src/scripts',)
+PAYLOAD_SCRIPTS = ('src/platform/crostestutils',)
+
+_IMAGES = 'images'
+_PAYLOADS = 'payloads'
+_VERSIONS = 'versions'
+_IMAGE_NAME = 'image-name'
+
+
+class ImageCache(object):
+  """The cached images and payloads for a board.
+
+  Failures to read or write the cache are logged, and treated as misses, so
+  that they never fail the build.
+  """
+
+  def __init__(self, buildroot, board):
+    self._buildroot = buildroot
+    self._board = board
+    self._cache_dir = os.path.join(buildroot, CACHE_DIR, board)
+
+  def _HashTrees(self, hasher, paths):
+    """Add the git trees checked out at |paths| to |hasher|."""
+    for path in paths:
+      tree = git.RunGit(os.path.join(self._buildroot, path),
+                        ['rev-parse', 'HEAD^{tree}']).output.strip()
+      hasher.update('%s %s\0' % (path, tree))
+
+  def _HashPackages(self, hasher, root):
+    """Add the packages installed in |root| to |hasher|."""
+    vdb = os.path.join(root, 'var', 'db', 'pkg')
+    for category in sorted(os.listdir(vdb)):
+      category_dir = os.path.join(vdb, category)
+      if os.path.isdir(category_dir):
+        for package in sorted(os.listdir(category_dir)):
+          hasher.update('%s/%s\0' % (category, package))
+
+    # Packages built from the same ebuild version can differ, so the binary
+    # packages they were installed from are hashed too.
+    packages_dir = os.path.join(root, 'packages')
+    if os.path.exists(os.path.join(packages_dir, 'Packages')):
+      pkgindex = binpkg.GrabLocalPackageIndex(packages_dir)
+      for pkg in sorted(pkgindex.packages, key=lambda x: x['CPV']):
+        hasher.update('%s %s\0' % (pkg['CPV'], pkg.get('SHA1', '')))
+
+  def IsRebuild(self, version):
+    """Returns whether |version| was built for the board before.
+
+    The version is remembered, so that it is a rebuild when built again.
+    """
+    versions_dir = os.path.join(self._cache_dir, _VERSIONS)
+    marker = os.path.join(versions_dir, version)
+    rebuild = os.path.exists(marker)
+    try:
+      osutils.Touch(marker, makedirs=True)
+      self._Prune(versions_dir, MAX_VERSIONS)
+    except EnvironmentError as e:
+      cros_build_lib.Warning('Failed to remember version %s: %s', version, e)
+    return rebuild
+
+  def GetImageKey(self, params):
+    """Returns the key for images built from what is installed now.
+
+    Args:
+      params: A list of strings for everything else the images depend on,
+        such as the version and the arguments to build_image.
+
+    Returns:
+      The key, or None if it could not be computed.
+    """
+    hasher = hashlib.sha1()
+    chroot = os.path.join(self._buildroot, constants.DEFAULT_CHROOT_DIR)
+    try:
+      self._HashPackages(hasher, chroot)
+      self._HashPackages(hasher, os.path.join(chroot, 'build', self._board))
+      self._HashTrees(hasher, IMAGE_SCRIPTS)
+    except (EnvironmentError, cros_build_lib.RunCommandError) as e:
+      cros_build_lib.Warning('Not caching images: %s', e)
+      return None
+
+    for param in params:
+      hasher.update('%s\0' % param)
+    return hasher.hexdigest()
+
+  def _EntryPath(self, key):
+    return os.path.join(self._cache_dir, _IMAGES, key)
+
+  def _PayloadsPath(self, image_key):
+    """Returns the path of the payloads kept with the images for |image_key|.
+
+    Returns:
+      The path, or None if it could not be computed.
+    """
+    hasher = hashlib.sha1()
+    try:
+      self._HashTrees(hasher, PAYLOAD_SCRIPTS)
+    except (EnvironmentError, cros_build_lib.RunCommandError) as e:
+      cros_build_lib.Warning('Not caching payloads: %s', e)
+      return None
+    return os.path.join(self._EntryPath(image_key), _PAYLOADS,
+                        hasher.hexdigest())
+
+  def _Restore(self, entry, name, target):
+    """Copy |name| from the cache |entry| to |target|.
+
+    Returns:
+      True if it was restored, False if it isn't cached.
+    """
+    if not os.path.isdir(entry):
+      return False
+
+    osutils.RmDir(target, ignore_missing=True, sudo=True)
+    try:
+      osutils.SafeMakedirs(os.path.dirname(target), sudo=True)
+      cros_build_lib.SudoRunCommand(
+          ['cp', '-a', '--sparse=always', os.path.join(entry, name), target],
+          print_cmd=False)
+    except (EnvironmentError, cros_build_lib.RunCommandError) as e:
+      cros_build_lib.Warning('Failed to restore cached %s: %s', name, e)
+      osutils.RmDir(target, ignore_missing=True, sudo=True)
+      return False
+
+    # Mark the entry as recently used, so that it is pruned last.
+    os.utime(entry, None)
+    return True
+
+  def _Store(self, entry, name, source, extra_files=None):
+    """Copy |source| to the cache as |name| in |entry|.
+
+    Returns:
+      True if it was cached.
+    """
+    staging = '%s.tmp' % entry
+    try:
+      osutils.RmDir(staging, ignore_missing=True, sudo=True)
+      osutils.SafeMakedirs(staging)
+      cros_build_lib.SudoRunCommand(
+          ['cp', '-a', '--sparse=always', source, os.path.join(staging, name)],
+          print_cmd=False)
+      for filename, content in (extra_files or {}).iteritems():
+        osutils.WriteFile(os.path.join(staging, filename), content)
+      osutils.RmDir(entry, ignore_missing=True, sudo=True)
+      os.rename(staging, entry)
+    except (EnvironmentError, cros_build_lib.RunCommandError) as e:
+      cros_build_lib.Warning('Failed to cache %s: %s', name, e)
+      osutils.RmDir(staging, ignore_missing=True, sudo=True)
+      return False
+
+    cros_build_lib.Info('Cached %s for %s in %s', name, self._board, entry)
+    self._Prune(os.path.dirname(entry), MAX_ENTRIES)
+    return True
+
+  def _Prune(self, path, count):
+    """Remove all but the |count| most recently used entries in |path|."""
+    entries = [os.path.join(path, x) for x in os.listdir(path)]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for entry in entries[count:]:
+      if os.path.isdir(entry):
+        osutils.RmDirInBackground(entry, ignore_missing=True, sudo=True)
+      else:
+        os.unlink(entry)
+
+  def RestoreImages(self, key, images_dir):
+    """Copy the cached images for |key| into |images_dir|.
+
+    Args:
+      key: The key from GetImageKey().
+      images_dir: The directory holding the board's images.
+
+    Returns:
+      The name of the restored image directory within |images_dir|, or None
+      if the images are not cached.
+    """
+    entry = self._EntryPath(key)
+    try:
+      name = osutils.ReadFile(os.path.join(entry, _IMAGE_NAME)).strip()
+    except EnvironmentError:
+      return None
+    if not self._Restore(entry, _IMAGES, os.path.join(images_dir, name)):
+      return None
+    return name
+
+  def StoreImages(self, key, image_dir):
+    """Cache the images in |image_dir| as the entry for |key|.
+
+    This replaces any payloads cached with earlier images for |key|.
+
+    Returns:
+      True if the images were cached.
+    """
+    image_dir = os.path.realpath(image_dir)
+    return self._Store(self._EntryPath(key), _IMAGES, image_dir,
+                       extra_files={_IMAGE_NAME: os.path.basename(image_dir)})
+
+  def RestorePayloads(self, image_key, payloads_dir):
+    """Copy the payloads cached for the images of |image_key|.
+
+    Args:
+      image_key: The key the images were restored or stored with.
+      payloads_dir: Where to copy the payloads to.
+
+    Returns:
+      True if the payloads were cached.
+    """
+    entry = self._PayloadsPath(image_key)
+    return bool(entry) and self._Restore(entry, _PAYLOADS, payloads_dir)
+
+  def StorePayloads(self, image_key, payloads_dir):
+    """Cache the payloads in |payloads_dir| with the images of |image_key|.
+
+    The images must have been restored or stored with |image_key| by this
+    build, so that the payloads were generated from the cached images.
+    """
+    entry = self._PayloadsPath(image_key)
+    if entry and os.path.isdir(self._EntryPath(image_key)):
+      self._Store(entry, _PAYLOADS, payloads_dir)
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for image_cache.py."""
+
+import os
+import sys
+
+import constants
+sys.path.insert(0, constants.SOURCE_ROOT)
+from chromite.buildbot import image_cache
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import git
+from chromite.lib import osutils
+
+
+# pylint: disable=W0212
+_PACKAGES = """\
+PACKAGES: 1
+
+CPV: sys-apps/foo-1
+SHA1: %s
+
+"""
+
+
+class ImageCacheTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for caching images and payloads."""
+
+  def _RunWithoutSudo(self, cmd, user='root', **kwds):
+    self.assertEqual(user, 'root')
+    return cros_build_lib.RunCommand(cmd, **kwds)
+
+  def setUp(self):
+    self.buildroot = os.path.join(self.tempdir, 'buildroot')
+    self.chroot = os.path.join(self.buildroot, constants.DEFAULT_CHROOT_DIR)
+    self.board_root = os.path.join(self.chroot, 'build', 'board')
+    for root in (self.chroot, self.board_root):
+      osutils.SafeMakedirs(os.path.join(root, 'var/db/pkg/sys-apps/foo-1'))
+    self._WritePackages('abc')
+
+    for path in image_cache.IMAGE_SCRIPTS + image_cache.PAYLOAD_SCRIPTS:
+      self._Commit(os.path.join(self.buildroot, path), 'v1', init=True)
+
+    self.images_dir = os.path.join(self.buildroot, 'src/build/images/board')
+    self.image_dir = os.path.join(self.images_dir, 'R1-1.0.0-a1')
+    osutils.WriteFile(os.path.join(self.image_dir, 'image.bin'), 'image',
+                      makedirs=True)
+    os.symlink('R1-1.0.0-a1', os.path.join(self.images_dir, 'latest'))
+
+    self.PatchObject(cros_build_lib, 'SudoRunCommand',
+                     side_effect=self._RunWithoutSudo)
+    self.PatchObject(osutils, 'RmDirInBackground',
+                     side_effect=osutils.RmDir)
+    self.cache = image_cache.ImageCache(self.buildroot, 'board')
+
+  def _WritePackages(self, sha1):
+    osutils.WriteFile(os.path.join(self.board_root, 'packages', 'Packages'),
+                      _PACKAGES % sha1, makedirs=True)
+
+  def _Commit(self, path, content, init=False):
+    if init:
+      osutils.SafeMakedirs(path)
+      git.RunGit(path, ['init'])
+    osutils.WriteFile(os.path.join(path, 'script'), content)
+    git.RunGit(path, ['add', 'script'])
+    git.RunGit(path, ['-c', 'user.name=a', '-c', 'user.email=a@b',
+                      'commit', '-m', content])
+
+  def testImageKey(self):
+    """Verify the key changes with each of the inputs."""
+    key = self.cache.GetImageKey(['1.0.0'])
+    self.assertEqual(key, self.cache.GetImageKey(['1.0.0']))
+    self.assertNotEqual(key, self.cache.GetImageKey(['1.0.1']))
+
+    self._WritePackages('def')
+    self.assertNotEqual(key, self.cache.GetImageKey(['1.0.0']))
+    self._WritePackages('abc')
+
+    osutils.SafeMakedirs(os.path.join(self.board_root, 'var/db/pkg/a/b-2'))
+    key2 = self.cache.GetImageKey(['1.0.0'])
+    self.assertNotEqual(key, key2)
+
+    self._Commit(os.path.join(self.buildroot, 'src/scripts'), 'v2')
+    self.assertNotEqual(key2, self.cache.GetImageKey(['1.0.0']))
+
+  def testMissingInputs(self):
+    """Verify nothing is cached without a board."""
+    cache = image_cache.ImageCache(self.buildroot, 'missing')
+    self.assertEqual(cache.GetImageKey(['1.0.0']), None)
+
+  def testIsRebuild(self):
+    """Verify only versions that were built before are rebuilds."""
+    self.assertFalse(self.cache.IsRebuild('1.0.0'))
+    self.assertTrue(self.cache.IsRebuild('1.0.0'))
+    self.assertFalse(self.cache.IsRebuild('1.0.1'))
+
+  def testImages(self):
+    """Verify images are restored under the name they were stored with."""
+    key = self.cache.GetImageKey(['1.0.0'])
+    self.assertEqual(self.cache.RestoreImages(key, self.images_dir), None)
+    self.assertTrue(
+        self.cache.StoreImages(key, os.path.join(self.images_dir, 'latest')))
+
+    osutils.RmDir(self.images_dir)
+    self.assertEqual(self.cache.RestoreImages(key, self.images_dir),
+                     'R1-1.0.0-a1')
+    self.assertEqual(
+        osutils.ReadFile(os.path.join(self.image_dir, 'image.bin')), 'image')
+
+  def testPayloads(self):
+    """Verify payloads are kept with the images they were generated from."""
+    payloads = os.path.join(self.tempdir, 'payloads')
+    osutils.WriteFile(os.path.join(payloads, 'update.gz'), 'payload',
+                      makedirs=True)
+    restored = os.path.join(self.tempdir, 'restored')
+
+    # Payloads are only cached along with their images.
+    self.cache.StorePayloads('key', payloads)
+    self.assertFalse(self.cache.RestorePayloads('key', restored))
+
+    self.cache.StoreImages('key', self.image_dir)
+    self.cache.StorePayloads('key', payloads)
+    self.assertTrue(self.cache.RestorePayloads('key', restored))
+    self.assertEqual(os.listdir(restored), ['update.gz'])
+
+    # New scripts generate new payloads.
+    self._Commit(os.path.join(self.buildroot, 'src/platform/crostestutils'),
+                 'v2')
+    self.assertFalse(self.cache.RestorePayloads('key', restored))
+    self.cache.StorePayloads('key', payloads)
+
+    # Storing new images for the key drops the payloads of the old ones.
+    self.cache.StoreImages('key', self.image_dir)
+    self.assertFalse(self.cache.RestorePayloads('key', restored))
+
+  def testPrune(self):
+    """Verify only the most recently used entries are kept."""
+    keys = ['a', 'b', 'c']
+    for i, key in enumerate(keys):
+      self.cache.StoreImages(key, self.image_dir)
+      os.utime(self.cache._EntryPath(key), (i, i))
+
+    self.assertEqual(self.cache.RestoreImages('a', self.images_dir), None)
+    self.assertTrue(self.cache.RestoreImages('b', self.images_dir))
+    self.assertTrue(self.cache.RestoreImages('c', self.images_dir))
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -7,6 +7,7 @@
 A library to generate and store the manifests for cros builders to use.
 """
 
+import cPickle
 import logging
 import os
 import re
@@ -19,6 +20,7 @@ from chromite.buildbot import constants
 from chromite.buildbot import manifest_version
 from chromite.lib import cros_build_lib
 from chromite.lib import git
+from chromite.lib import osutils
 
 
 # Paladin constants for manifest names.
@@ -113,6 +115,12 @@ class LKGMManager(manifest_version.BuildSpecsManager):
   MAX_TIMEOUT_SECONDS = 300
   # Polling timeout for checking git repo for other build statuses.
   SLEEP_TIMEOUT = constants.SLEEP_TIMEOUT
+  # Longest polling interval for other build statuses, used while none of the
+  # other builders have finished.  The interval grows by STATUS_BACKOFF after
+  # each poll in which no builder finished, up to a limit which shrinks from
+  # this towards SLEEP_TIMEOUT as the remaining builders finish.
+  MAX_STATUS_SLEEP_TIMEOUT = 4 * constants.SLEEP_TIMEOUT
+  STATUS_BACKOFF = 1.5
 
   # Sub-directories for LKGM and Chrome LKGM's.
   LKGM_SUBDIR = 'LKGM-candidates'
@@ -122,6 +130,12 @@ class LKGMManager(manifest_version.BuildSpecsManager):
   # Set path in repository to keep latest approved LKGM manifest.
   LKGM_PATH = 'LKGM/lkgm.xml'
 
+  # Where the CLs found in each project's history since the LKGM are cached
+  # for the next candidate, relative to the buildroot.
+  BLAMELIST_CACHE = '.cache/lkgm-blamelist'
+  # Max number of projects to query the history of at once.
+  MAX_PARALLEL_BLAMELIST = 16
+
   def __init__(self, source_repo, manifest_repo, build_name, build_type,
                incr_type, force, branch, dry_run=True, master=False):
     """Initialize an LKGM Manager.
@@ -148,8 +162,17 @@ class LKGMManager(manifest_version.BuildSpecsManager):
       assert cbuildbot_config.IsPFQType(self.build_type)
       self.rel_working_dir = self.LKGM_SUBDIR
 
-  def _RunLambdaWithTimeout(self, function_to_run, use_long_timeout=False):
-    """Runs function_to_run until it returns a value or timeout is reached."""
+  def _RunLambdaWithTimeout(self, function_to_run, use_long_timeout=False,
+                            get_sleep_timeout=None):
+    """Runs function_to_run until it returns a value or timeout is reached.
+
+    Args:
+      function_to_run: The function to run.  It is retried while it returns
+        a false value.
+      use_long_timeout: Whether to allow the long timeout for this build type.
+      get_sleep_timeout: Optional function returning how long to sleep before
+        the next attempt.  Defaults to SLEEP_TIMEOUT.
+    """
     function_success = False
     start_time = time.time()
     max_timeout = self.MAX_TIMEOUT_SECONDS
@@ -165,7 +188,12 @@ class LKGMManager(manifest_version.BuildSpecsManager):
       if function_success:
         break
       else:
-        time.sleep(self.SLEEP_TIMEOUT)
+        sleep_timeout = self.SLEEP_TIMEOUT
+        if get_sleep_timeout is not None:
+          sleep_timeout = get_sleep_timeout()
+        # Make a last attempt at the timeout rather than oversleeping it.
+        remaining = max_timeout - (time.time() - start_time)
+        time.sleep(max(0, min(sleep_timeout, remaining)))
 
     return function_success
 
@@ -365,7 +393,7 @@ class LKGMManager(manifest_version.BuildSpecsManager):
 
       # Actually perform the sync.
       manifest = self.GetLocalManifest(version_to_build)
-      self.cros_source.Sync(manifest)
+      self.cros_source.Sync(manifest, incremental=True)
       self._GenerateBlameListSinceLKGM()
       return manifest
     else:
@@ -375,35 +403,52 @@ class LKGMManager(manifest_version.BuildSpecsManager):
     """Returns a build-names->status dictionary of build statuses."""
     builders_completed = set()
     builder_statuses = {}
+    # The polling interval, which backs off while no builders are finishing.
+    poll_state = {'sleep_timeout': self.SLEEP_TIMEOUT}
 
     def _CheckStatusOfBuildersArray():
-      """Helper function that iterates through current statuses."""
-      for b in builders_array:
-        cached_status = builder_statuses.get(b)
-        if not cached_status or not cached_status.Completed():
-          logging.debug("Checking for builder %s's status", b)
-          builder_status = self.GetBuildStatus(b, self.current_version)
-          builder_statuses[b] = builder_status
-          if builder_status is None:
-            logging.warn('No status found for builder %s.', b)
-          elif builder_status.Passed():
-            builders_completed.add(b)
-            logging.info('Builder %s completed with status passed', b)
-          elif builder_status.Failed():
-            builders_completed.add(b)
-            logging.info('Builder %s completed with status failed', b)
-
+      """Helper function that checks the statuses of incomplete builders."""
+      pending = [b for b in builders_array if b not in builders_completed]
+      logging.debug('Checking the statuses of builders %r', pending)
+      statuses = self.GetBuildStatuses(pending, self.current_version)
+      newly_completed = False
+      for b in pending:
+        builder_status = statuses.get(b)
+        builder_statuses[b] = builder_status
+        if builder_status is None:
+          logging.warn('No status found for builder %s.', b)
+        elif builder_status.Passed():
+          builders_completed.add(b)
+          newly_completed = True
+          logging.info('Builder %s completed with status passed', b)
+        elif builder_status.Failed():
+          builders_completed.add(b)
+          newly_completed = True
+          logging.info('Builder %s completed with status failed', b)
 
       if len(builders_completed) < len(builders_array):
         logging.info('Still waiting for the following builds to complete: %r',
                      sorted(set(builders_array).difference(builders_completed)))
+        # Poll quickly again once builders start finishing, and back off
+        # while they are not, more so the more builders are outstanding.
+        fraction_pending = (float(len(builders_array) - len(builders_completed))
+                            / len(builders_array))
+        max_sleep_timeout = self.SLEEP_TIMEOUT + fraction_pending * (
+            self.MAX_STATUS_SLEEP_TIMEOUT - self.SLEEP_TIMEOUT)
+        if newly_completed:
+          sleep_timeout = self.SLEEP_TIMEOUT
+        else:
+          sleep_timeout = poll_state['sleep_timeout'] * self.STATUS_BACKOFF
+        poll_state['sleep_timeout'] = max(
+            self.SLEEP_TIMEOUT, min(sleep_timeout, max_sleep_timeout))
         return None
       else:
         return 'Builds completed.'
 
     # Check for build completion until all builders report in.
-    builds_succeeded = self._RunLambdaWithTimeout(_CheckStatusOfBuildersArray,
-                                                  use_long_timeout=True)
+    builds_succeeded = self._RunLambdaWithTimeout(
+        _CheckStatusOfBuildersArray, use_long_timeout=True,
+        get_sleep_timeout=lambda: poll_state['sleep_timeout'])
     if not builds_succeeded:
       logging.error('Not all builds finished before MAX_TIMEOUT reached.')
 
@@ -448,6 +493,96 @@ class LKGMManager(manifest_version.BuildSpecsManager):
             cbuildbot_config.IsPFQType(self.build_type) and
             self.build_type != constants.CHROME_PFQ_TYPE)
 
+  @staticmethod
+  def _ParseBlameList(log):
+    """Returns the reviewed CLs in the output of `git log --pretty=full`.
+
+    Returns:
+      A list of (author, committer, change_number, review_url) tuples.
+    """
+    reviewed_on_re = re.compile(r'\s*Reviewed-on:\s*(\S+)')
+    author_re = re.compile(r'\s*Author:.*<(\S+)@\S+>\s*')
+    committer_re = re.compile(r'\s*Commit:.*<(\S+)@\S+>\s*')
+    current_author = None
+    current_committer = None
+    changes = []
+    for line in log.splitlines():
+      author_match = author_re.match(line)
+      if author_match:
+        current_author = author_match.group(1)
+
+      committer_match = committer_re.match(line)
+      if committer_match:
+        current_committer = committer_match.group(1)
+
+      review_match = reviewed_on_re.match(line)
+      if review_match:
+        review = review_match.group(1)
+        _, _, change_number = review.rpartition('/')
+        changes.append((current_author, current_committer, change_number,
+                        review))
+    return changes
+
+  def _LoadBlameListCache(self):
+    """Returns the cached (project, from, to) -> CL list dict, if any."""
+    path = os.path.join(self.cros_source.directory, self.BLAMELIST_CACHE)
+    try:
+      with open(path, 'rb') as f:
+        return cPickle.load(f)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+      return {}
+
+  def _SaveBlameListCache(self, cache):
+    """Saves |cache| for the next candidate."""
+    path = os.path.join(self.cros_source.directory, self.BLAMELIST_CACHE)
+    osutils.WriteFile(path, cPickle.dumps(cache, cPickle.HIGHEST_PROTOCOL),
+                      mode='wb', atomic=True, makedirs=True)
+
+  def _GetBlameListChanges(self, projects):
+    """Returns the CLs committed to each project since its given revision.
+
+    The history of all the projects is queried concurrently.  As the history
+    between two commits never changes, the results are cached by
+    (project, revision, HEAD), so that successive candidates only query the
+    projects which have changed since the last one.
+
+    Args:
+      projects: A list of (project, src_path, revision) tuples.
+
+    Returns:
+      A dict mapping each project to its list of CLs, in the format of
+      _ParseBlameList.
+    """
+    start_time = time.time()
+    cache = self._LoadBlameListCache()
+    new_cache = {}
+    changes = {}
+    queries = []
+    with cros_build_lib.CommandPool(
+        max_parallel=self.MAX_PARALLEL_BLAMELIST) as pool:
+      for project, src_path, revision in projects:
+        head = git.GetGitBatch(src_path).ResolveRevision('HEAD')
+        key = (project, revision, head)
+        if key in cache:
+          changes[project] = new_cache[key] = cache[key]
+        else:
+          future = pool.RunCommand(
+              ['git', 'log', '--pretty=full', '%s..%s' % key[1:]],
+              print_cmd=False, redirect_stdout=True, cwd=src_path)
+          queries.append((key, future))
+
+    for key, future in queries:
+      changes[key[0]] = new_cache[key] = self._ParseBlameList(
+          future.result().output)
+
+    # Only keep what this candidate used; older LKGMs won't be needed again.
+    self._SaveBlameListCache(new_cache)
+    logging.info('Generated the blamelist of %d projects in %.1fs; queried '
+                 'the history of %d, and reused the rest from the last '
+                 'candidate.', len(projects), time.time() - start_time,
+                 len(queries))
+    return changes
+
   def _GenerateBlameListSinceLKGM(self):
     """Prints out links to all CL's that have been committed since LKGM.
 
@@ -460,9 +595,7 @@ class LKGMManager(manifest_version.BuildSpecsManager):
       return
 
     handler = git.Manifest(self.lkgm_path)
-    reviewed_on_re = re.compile('\s*Reviewed-on:\s*(\S+)')
-    author_re = re.compile('\s*Author:.*<(\S+)@\S+>\s*')
-    committer_re = re.compile('\s*Commit:.*<(\S+)@\S+>\s*')
+    projects = []
     for project in handler.projects.keys():
       rel_src_path = handler.projects[project].get('path')
 
@@ -477,35 +610,19 @@ class LKGMManager(manifest_version.BuildSpecsManager):
         continue
 
       revision = handler.projects[project]['revision']
-      result = cros_build_lib.RunCommand(['git', 'log', '--pretty=full',
-                                          '%s..HEAD' % revision],
-                                         print_cmd=False, redirect_stdout=True,
-                                         cwd=src_path)
-      current_author = None
-      current_committer = None
-      for line in result.output.splitlines():
-        author_match = author_re.match(line)
-        if author_match:
-          current_author = author_match.group(1)
-
-        committer_match = committer_re.match(line)
-        if committer_match:
-          current_committer = committer_match.group(1)
-
-        review_match = reviewed_on_re.match(line)
-        if review_match:
-          review = review_match.group(1)
-          _, _, change_number = review.rpartition('/')
-          if current_committer != 'chrome-bot':
-            cros_build_lib.PrintBuildbotLink(
-                'CHUMP %s:%s' % (current_author, change_number),
-                review)
-          elif self.build_type != constants.PALADIN_TYPE:
-            # Suppress re-printing changes we tried ourselves on paladin
-            # builders since they are redundant.
-            cros_build_lib.PrintBuildbotLink(
-                '%s:%s' % (current_author, change_number),
-                review)
+      projects.append((project, src_path, revision))
+
+    changes = self._GetBlameListChanges(projects)
+    for project, _, _ in projects:
+      for author, committer, change_number, review in changes[project]:
+        if committer != 'chrome-bot':
+          cros_build_lib.PrintBuildbotLink(
+              'CHUMP %s:%s' % (author, change_number), review)
+        elif self.build_type != constants.PALADIN_TYPE:
+          # Suppress re-printing changes we tried ourselves on paladin
+          # builders since they are redundant.
+          cros_build_lib.PrintBuildbotLink(
+              '%s:%s' % (author, change_number), review)
 
   def GetLatestPassingSpec(self):
     """Get the last spec file that passed in the current branch."""
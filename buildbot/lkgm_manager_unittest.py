@@ -10,6 +10,7 @@ import mox
 import os
 import sys
 import tempfile
+import time
 from xml.dom import minidom
 
 if __name__ == '__main__':
@@ -138,6 +139,7 @@ class LKGMManagerTest(cros_test_lib.MoxTempDirTestCase):
                                                   self.manager.rel_working_dir,
                                                   'build-name', '%(builder)s')
     self.manager.SLEEP_TIMEOUT = 0
+    self.manager.MAX_STATUS_SLEEP_TIMEOUT = 0
 
   def _GetPathToManifest(self, info):
     return os.path.join(self.manager.all_specs_dir, '%s.xml' %
@@ -270,7 +272,7 @@ class LKGMManagerTest(cros_test_lib.MoxTempDirTestCase):
 
     lkgm_manager.LKGMManager.SetInFlight(most_recent_candidate.VersionString())
     repository.RepoRepository.Sync(
-        self._GetPathToManifest(most_recent_candidate))
+        self._GetPathToManifest(most_recent_candidate), incremental=True)
 
     self.manager.latest_unprocessed = '1.2.3-rc12'
     self.mox.ReplayAll()
@@ -301,7 +303,7 @@ class LKGMManagerTest(cros_test_lib.MoxTempDirTestCase):
 
     lkgm_manager.LKGMManager.SetInFlight(most_recent_candidate.VersionString())
     repository.RepoRepository.Sync(
-        self._GetPathToManifest(most_recent_candidate))
+        self._GetPathToManifest(most_recent_candidate), incremental=True)
 
     self.manager.latest_unprocessed = '1.2.4-rc12'
     self.mox.ReplayAll()
@@ -346,16 +348,22 @@ class LKGMManagerTest(cros_test_lib.MoxTempDirTestCase):
 
     Args:
       builders: List of builders to get status for.
-      status_runs: List of expected (builder, status) tuples.
+      status_runs: List of dictionaries of expected statuses, one for each
+        poll.  Each maps the builders still expected to be polled to their
+        statuses.
     """
-    self.mox.StubOutWithMock(lkgm_manager.LKGMManager, 'GetBuildStatus')
-    for builder, status in status_runs:
-      # GetBuildStatus returns None if the builder has not even started yet
-      # (e.g. because the builder is down.)
-      if status is not None:
-        status = manifest_version.BuilderStatus(status, None)
-      lkgm_manager.LKGMManager.GetBuildStatus(
-          builder, mox.IgnoreArg()).AndReturn(status)
+    self.mox.StubOutWithMock(lkgm_manager.LKGMManager, 'GetBuildStatuses')
+    for status_run in status_runs:
+      statuses = {}
+      for builder, status in status_run.iteritems():
+        # A builder has no status if it has not even started yet (e.g. because
+        # the builder is down.)
+        if status is not None:
+          status = manifest_version.BuilderStatus(status, None)
+        statuses[builder] = status
+      lkgm_manager.LKGMManager.GetBuildStatuses(
+          [b for b in builders if b in status_run],
+          mox.IgnoreArg()).AndReturn(statuses)
 
     self.mox.ReplayAll()
     statuses = self.manager.GetBuildersStatus(builders)
@@ -364,88 +372,94 @@ class LKGMManagerTest(cros_test_lib.MoxTempDirTestCase):
 
   def testGetBuildersStatusBothFinished(self):
     """Tests GetBuilderStatus where both builds have finished."""
-    status_runs = [('build1', 'fail'), ('build2', 'pass')]
+    status_runs = [{'build1': 'fail', 'build2': 'pass'}]
     statuses = self._GetBuildersStatus(['build1', 'build2'], status_runs)
     self.assertTrue(statuses['build1'].Failed())
     self.assertTrue(statuses['build2'].Passed())
 
   def testGetBuildersStatusLoop(self):
     """Tests GetBuilderStatus where builds are inflight."""
-    status_runs = [('build1', 'inflight'), ('build2', None),
-                   ('build1', 'fail'), ('build2', 'inflight'),
-                   ('build2', 'pass')]
+    status_runs = [{'build1': 'inflight', 'build2': None},
+                   {'build1': 'fail', 'build2': 'inflight'},
+                   {'build2': 'pass'}]
     statuses = self._GetBuildersStatus(['build1', 'build2'], status_runs)
     self.assertTrue(statuses['build1'].Failed())
     self.assertTrue(statuses['build2'].Passed())
 
+  def testGetBuildersStatusBackoff(self):
+    """Tests that polling backs off until a builder finishes."""
+    self.manager.SLEEP_TIMEOUT = 10
+    self.manager.MAX_STATUS_SLEEP_TIMEOUT = 40
+    self.manager.STATUS_BACKOFF = 2
+    self.mox.StubOutWithMock(time, 'sleep')
+    for sleep_timeout in (20, 40, 40, 40, 10, 20, 25):
+      time.sleep(sleep_timeout)
+    self.mox.ReplayAll()
+    inflight = 'inflight'
+    status_runs = ([{'build1': inflight, 'build2': inflight}] * 4 +
+                   [{'build1': 'pass', 'build2': inflight}] +
+                   [{'build2': inflight}] * 2 + [{'build2': 'pass'}])
+    statuses = self._GetBuildersStatus(['build1', 'build2'], status_runs)
+    self.assertTrue(statuses['build2'].Passed())
+
   def testGenerateBlameListSinceLKGM(self):
     """Tests that we can generate a blamelist from two commit messages.
 
     This test tests the functionality of generating a blamelist for a git log.
     Note in this test there are two commit messages, one commited by the
     Commit Queue and another from Non-Commit Queue.  We test the correct
-    handling in both cases.
+    handling in both cases.  The history is then cached for the next call.
     """
-    fake_git_log = """Author: Sammy Sosa <fake@fake.com>
-    Commit: Chris Sosa <sosa@chromium.org>
-
-    Date:   Mon Aug 8 14:52:06 2011 -0700
-
-    Add in a test for cbuildbot
+    fake_commit_message = """Add in a test for cbuildbot
 
     TEST=So much testing
     BUG=chromium-os:99999
 
     Change-Id: Ib72a742fd2cee3c4a5223b8easwasdgsdgfasdf
-    Reviewed-on: http://gerrit.chromium.org/gerrit/1234
-    Reviewed-by: Fake person <fake@fake.org>
-    Tested-by: Sammy Sosa <fake@fake.com>
-    Author: Sammy Sosa <fake@fake.com>
-    Commit: Gerrit <chrome-bot@chromium.org>
-
-    Date:   Mon Aug 8 14:52:06 2011 -0700
-
-    Add in a test for cbuildbot
-
-    TEST=So much testing
-    BUG=chromium-os:99999
-
-    Change-Id: Ib72a742fd2cee3c4a5223b8easwasdgsdgfasdf
-    Reviewed-on: http://gerrit.chromium.org/gerrit/1235
+    Reviewed-on: http://gerrit.chromium.org/gerrit/%s
     Reviewed-by: Fake person <fake@fake.org>
     Tested-by: Sammy Sosa <fake@fake.com>
     """
+    src_path = os.path.join(self.tmpdir, 'fake', 'path')
+    osutils.SafeMakedirs(src_path)
+    git.RunGit(src_path, ['init'])
+    author_env = {'GIT_AUTHOR_NAME': 'Sammy Sosa',
+                  'GIT_AUTHOR_EMAIL': 'fake@fake.com',
+                  'GIT_COMMITTER_NAME': 'Chris Sosa',
+                  'GIT_COMMITTER_EMAIL': 'sosa@chromium.org'}
+    git.RunGit(src_path, ['commit', '--allow-empty', '-m', 'LKGM'],
+               extra_env=author_env)
+    fake_revision = git.RunGit(src_path, ['rev-parse', 'HEAD']).output.strip()
+    for change_number, committer in ((1235, 'chrome-bot'), (1234, 'sosa')):
+      author_env.update(GIT_COMMITTER_EMAIL='%s@chromium.org' % committer)
+      git.RunGit(src_path, ['commit', '--allow-empty',
+                            '-m', fake_commit_message % change_number],
+                 extra_env=author_env)
+
     self.manager.incr_type = 'build'
-    self.mox.StubOutWithMock(os.path, 'exists')
-    self.mox.StubOutWithMock(cros_build_lib, 'RunCommand')
     self.mox.StubOutWithMock(cros_build_lib, 'PrintBuildbotLink')
 
-    fake_revision = '1234567890'
     fake_project_handler = self.mox.CreateMock(git.Manifest)
     fake_project_handler.projects = { 'fake/repo': { 'name': 'fake/repo',
                                                      'path': 'fake/path',
                                                      'revision': fake_revision,
                                                    }
                                     }
-    fake_result = self.mox.CreateMock(cros_build_lib.CommandResult)
-    fake_result.output = fake_git_log
 
     self.mox.StubOutWithMock(git, 'Manifest', use_mock_anything=True)
 
-    git.Manifest(
-        self.tmpmandir + '/LKGM/lkgm.xml').AndReturn(fake_project_handler)
-    os.path.exists(mox.StrContains('fake/path')).AndReturn(True)
-    cros_build_lib.RunCommand(['git', 'log', '--pretty=full',
-                               '%s..HEAD' % fake_revision],
-                              print_cmd=False, redirect_stdout=True,
-                              cwd=self.tmpdir + '/fake/path').AndReturn(
-                                  fake_result)
-    cros_build_lib.PrintBuildbotLink('CHUMP fake:1234',
-                                     'http://gerrit.chromium.org/gerrit/1234')
-    cros_build_lib.PrintBuildbotLink('fake:1235',
-                                     'http://gerrit.chromium.org/gerrit/1235')
+    for _ in range(2):
+      git.Manifest(
+          self.tmpmandir + '/LKGM/lkgm.xml').AndReturn(fake_project_handler)
+      cros_build_lib.PrintBuildbotLink('CHUMP fake:1234',
+                                       'http://gerrit.chromium.org/gerrit/1234')
+      cros_build_lib.PrintBuildbotLink('fake:1235',
+                                       'http://gerrit.chromium.org/gerrit/1235')
     self.mox.ReplayAll()
     self.manager._GenerateBlameListSinceLKGM()
+    # The history is unchanged, so it shouldn't be looked at again.
+    self.mox.stubs.Set(lkgm_manager.LKGMManager, '_ParseBlameList', None)
+    self.manager._GenerateBlameListSinceLKGM()
     self.mox.VerifyAll()
 
   def testAddPatchesToManifest(self):
@@ -355,6 +355,9 @@ class BuilderStatus(object):
 class BuildSpecsManager(object):
   """A Class to manage buildspecs and their states."""
 
+  # Maximum number of builder statuses to download at once.
+  MAX_PARALLEL_STATUS_FETCHES = 8
+
   def __init__(self, source_repo, manifest_repo, build_name, incr_type, force,
                branch, dry_run=True, master=False):
     """Initializes a build specs manager.
@@ -398,6 +401,9 @@ class BuildSpecsManager(object):
     self.compare_versions_fn = VersionInfo.VersionCompare
 
     self.current_version = None
+
+    # Maps (version, builder) to the (generation, BuilderStatus) last seen.
+    self._build_status_cache = {}
     self.rel_working_dir = ''
 
   def _LatestSpecFromList(self, specs):
@@ -538,6 +544,97 @@ class BuildSpecsManager(object):
       raise
     return BuilderStatus(**cPickle.loads(result.output))
 
+  @staticmethod
+  def _ListStatusGenerations(version):
+    """Returns the current generation of each builder status for |version|.
+
+    This is a single listing of the version's status directory, which is much
+    cheaper than downloading every status.
+
+    Args:
+      version: Version string.
+
+    Returns:
+      A dict mapping builder names to generation numbers, or None if the
+      statuses could not be listed.
+    """
+    url = BuildSpecsManager._GetStatusUrl('', version)
+    cmd = [gs.GSUTIL_BIN, 'ls', '-a', url]
+    result = cros_build_lib.RunCommand(
+        cmd, redirect_stdout=True, redirect_stderr=True, error_code_ok=True,
+        debug_level=logging.DEBUG)
+    if result.returncode != 0:
+      # Nobody has uploaded a status for this version yet.
+      if result.error and 'matched no objects' in result.error:
+        return {}
+      return None
+
+    generations = {}
+    for line in result.output.splitlines():
+      path, sep, generation = line.strip().rpartition('#')
+      if not path.startswith(url) or not sep or not generation.isdigit():
+        logging.debug('Ignoring unexpected status listing line %r', line)
+        continue
+      builder = path[len(url):]
+      # Older generations of an object are listed too; keep the newest.
+      generations[builder] = max(generations.get(builder, 0), int(generation))
+    return generations
+
+  def GetBuildStatuses(self, builders, version):
+    """Returns a dict mapping each of |builders| to its BuilderStatus.
+
+    Unlike calling GetBuildStatus for each builder, the generations of all the
+    statuses are listed first, so statuses which have not changed since the
+    last call are not downloaded again, and those which have are downloaded
+    concurrently.
+
+    Args:
+      builders: List of builders to look at.
+      version: Version string.
+
+    Returns:
+      A dict mapping builder names to BuilderStatus instances, or to None if
+      the builder has not uploaded a status.
+    """
+    generations = self._ListStatusGenerations(version)
+    if generations is None:
+      logging.warning('Could not list build statuses; fetching each one.')
+      return dict((b, self.GetBuildStatus(b, version)) for b in builders)
+
+    statuses = {}
+    to_fetch = []
+    for builder in builders:
+      generation = generations.get(builder)
+      cached = self._build_status_cache.get((version, builder))
+      if generation is None:
+        statuses[builder] = None
+      elif cached and cached[0] == generation:
+        statuses[builder] = cached[1]
+      else:
+        to_fetch.append((builder, generation))
+
+    fetches = []
+    with cros_build_lib.CommandPool(
+        max_parallel=self.MAX_PARALLEL_STATUS_FETCHES) as pool:
+      for builder, generation in to_fetch:
+        url = '%s#%d' % (self._GetStatusUrl(builder, version), generation)
+        future = pool.RunCommand(
+            [gs.GSUTIL_BIN, 'cat', url], redirect_stdout=True,
+            redirect_stderr=True, error_code_ok=True, debug_level=logging.DEBUG)
+        fetches.append((builder, generation, future))
+
+    for builder, generation, future in fetches:
+      result = future.result()
+      if result.returncode == 0:
+        status = BuilderStatus(**cPickle.loads(result.output))
+        self._build_status_cache[(version, builder)] = (generation, status)
+      else:
+        # Fall back to the retrying fetch of whatever is current now.
+        status = self.GetBuildStatus(builder, version)
+      statuses[builder] = status
+
+    return statuses
+
   def GetLatestPassingSpec(self):
     """Get the last spec file that passed in the current branch."""
     version_info = self.GetCurrentVersionInfo()
@@ -6,6 +6,7 @@
 
 """Unittests for manifest_version. Needs to be run inside of chroot for mox."""
 
+import cPickle
 import os
 import sys
 import tempfile
@@ -20,6 +21,7 @@ from chromite.buildbot import repository
 from chromite.lib import cros_build_lib
 from chromite.lib import git
 from chromite.lib import cros_test_lib
+from chromite.lib import gs
 from chromite.lib import osutils
 
 # pylint: disable=W0212,R0904
@@ -252,6 +254,89 @@ class BuildSpecsManagerTest(cros_test_lib.MoxTempDirTestCase):
     self.mox.VerifyAll()
     self.assertEqual(FAKE_VERSION_STRING_NEXT, version)
 
+  def _SetUpFakeGSUtil(self, version):
+    """Install a fake gsutil which serves statuses from the tempdir.
+
+    Returns:
+      A function which returns the urls fetched so far, and resets them.
+    """
+    self.status_dir = os.path.join(self.tempdir, 'status')
+    osutils.SafeMakedirs(self.status_dir)
+    self.listing = os.path.join(self.tempdir, 'listing')
+    cat_log = os.path.join(self.tempdir, 'cat_log')
+    gsutil = os.path.join(self.tempdir, 'gsutil')
+    osutils.WriteFile(gsutil, '\n'.join([
+        '#!/bin/sh',
+        'case "$1" in',
+        '  ls) cat %s ;;' % self.listing,
+        '  cat) echo "$2" >> %s' % cat_log,
+        '       f=${2##*/}; cat %s/${f%%%%#*} ;;' % self.status_dir,
+        'esac', '']))
+    os.chmod(gsutil, 0755)
+    self.mox.stubs.Set(gs, 'GSUTIL_BIN', gsutil)
+    self.status_url = manifest_version.BuildSpecsManager._GetStatusUrl(
+        '', version)
+
+    def _PopFetches():
+      fetches = osutils.ReadFile(cat_log).split() if os.path.exists(
+          cat_log) else []
+      osutils.SafeUnlink(cat_log)
+      return sorted(x[len(self.status_url):] for x in fetches)
+    return _PopFetches
+
+  def _WriteStatuses(self, statuses, generations):
+    """Write the fake statuses of each builder, with the given listing."""
+    for builder, status in statuses.iteritems():
+      osutils.WriteFile(os.path.join(self.status_dir, builder),
+                        cPickle.dumps(dict(status=status, message=None)))
+    osutils.WriteFile(self.listing, ''.join(
+        '%s%s#%d\n' % (self.status_url, builder, generation)
+        for builder, generation in generations))
+
+  def testGetBuildStatuses(self):
+    """Tests that only changed statuses are downloaded again."""
+    version = '1.2.3'
+    pop_fetches = self._SetUpFakeGSUtil(version)
+    builders = ['build1', 'build2', 'build3']
+
+    self._WriteStatuses({'build1': 'inflight', 'build2': 'inflight'},
+                        [('build1', 1), ('build1', 2), ('build2', 5)])
+    statuses = self.manager.GetBuildStatuses(builders, version)
+    self.assertEqual(pop_fetches(), ['build1#2', 'build2#5'])
+    self.assertTrue(statuses['build1'].Inflight())
+    self.assertTrue(statuses['build2'].Inflight())
+    self.assertEqual(statuses['build3'], None)
+
+    statuses = self.manager.GetBuildStatuses(builders, version)
+    self.assertEqual(pop_fetches(), [])
+    self.assertTrue(statuses['build2'].Inflight())
+
+    self._WriteStatuses({'build2': 'pass', 'build3': 'fail'},
+                        [('build1', 2), ('build2', 6), ('build3', 1)])
+    statuses = self.manager.GetBuildStatuses(builders, version)
+    self.assertEqual(pop_fetches(), ['build2#6', 'build3#1'])
+    self.assertTrue(statuses['build1'].Inflight())
+    self.assertTrue(statuses['build2'].Passed())
+    self.assertTrue(statuses['build3'].Failed())
+
+  def testGetBuildStatusesWithoutListing(self):
+    """Tests that statuses are fetched one by one if they can't be listed."""
+    self.mox.StubOutWithMock(manifest_version.BuildSpecsManager,
+                             '_ListStatusGenerations')
+    self.mox.StubOutWithMock(manifest_version.BuildSpecsManager,
+                             'GetBuildStatus')
+    status = manifest_version.BuilderStatus('pass', None)
+    manifest_version.BuildSpecsManager._ListStatusGenerations(
+        '1.2.3').AndReturn(None)
+    manifest_version.BuildSpecsManager.GetBuildStatus(
+        'build1', '1.2.3').AndReturn(status)
+    manifest_version.BuildSpecsManager.GetBuildStatus(
+        'build2', '1.2.3').AndReturn(None)
+    self.mox.ReplayAll()
+    statuses = self.manager.GetBuildStatuses(['build1', 'build2'], '1.2.3')
+    self.mox.VerifyAll()
+    self.assertEqual(statuses, {'build1': status, 'build2': None})
+
   def NotestGetNextBuildSpec(self):
     """Meta test.  Re-enable if you want to use it to do a big test."""
     print self.manager.GetNextBuildSpec(retries=0)
@@ -11,6 +11,7 @@ import logging
 import os
 import re
 import shutil
+from xml.dom import minidom
 
 from chromite.buildbot import configure_repo
 from chromite.lib import cros_build_lib
@@ -118,17 +119,10 @@ def ClearBuildRoot(buildroot, preserve_paths=()):
   """Remove and recreate the buildroot while preserving the trybot marker."""
   trybot_root = os.path.exists(GetTrybotMarkerPath(buildroot))
   if os.path.exists(buildroot):
-    cmd = ['find', buildroot, '-mindepth', '1', '-maxdepth', '1']
-
-    ignores = []
-    for path in preserve_paths:
-      if ignores:
-        ignores.append('-a')
-      ignores += ['!', '-name', path]
-    cmd.extend(ignores)
-
-    cmd += ['-exec', 'rm', '-rf', '{}', '+']
-    cros_build_lib.SudoRunCommand(cmd)
+    for name in os.listdir(buildroot):
+      if name not in preserve_paths and name != osutils.TRASH_DIR:
+        osutils.RmDirInBackground(os.path.join(buildroot, name),
+                                  ignore_missing=True, sudo=True)
   else:
     os.makedirs(buildroot)
   if trybot_root:
@@ -154,6 +148,11 @@ class RepoRepository(object):
   # If a repo hasn't been used in the last 5 runs, wipe it.
   LRU_THRESHOLD = 5
 
+  # Where the revision locked manifest of the last completed sync is kept,
+  # relative to .repo; incremental syncs are planned against it.
+  _SYNCED_MANIFEST = 'chromite-synced-manifest.xml'
+  _SHA1_RE = re.compile(r'^[0-9a-f]{40}$')
+
   def __init__(self, repo_url, directory, branch=None, referenced_repo=None,
                manifest=None, depth=None):
     self.repo_url = repo_url
@@ -297,8 +296,158 @@ class RepoRepository(object):
         ['git', 'config', '--file', self._ManifestConfig, 'repo.reference',
          self._referenced_repo])
 
+  @property
+  def _SyncedManifestPath(self):
+    return os.path.join(self.directory, '.repo', self._SYNCED_MANIFEST)
+
+  def _RecordSyncedManifest(self, manifest=None):
+    """Record what the checkout was just synced to, for incremental syncs.
+
+    Args:
+      manifest: The revision locked manifest which was synced.  If not given,
+        it is exported from the checkout.
+    """
+    try:
+      if manifest is None:
+        osutils.WriteFile(self._SyncedManifestPath, self.ExportManifest(),
+                          atomic=True)
+      else:
+        shutil.copyfile(manifest, self._SyncedManifestPath)
+    except Exception as e:
+      # This is only an optimization for the next sync, so don't fail this
+      # one over it.
+      logging.warning('Failed recording the synced manifest; the next sync '
+                      'will not be incremental: %s', e)
+      osutils.SafeUnlink(self._SyncedManifestPath)
+
+  def _GetProjectHeads(self, paths):
+    """Returns a dict mapping each of |paths| to the sha1 checked out there.
+
+    Paths which aren't usable git checkouts are left out.
+    """
+    heads = {}
+    for path in paths:
+      git_repo = self.GetRelativePath(path)
+      if not os.path.isdir(git_repo):
+        continue
+      try:
+        # Read HEAD via the shared GitBatch, rather than forking git for it.
+        head = git.GetGitBatch(git_repo).ResolveRevision('HEAD')
+      except (cros_build_lib.RunCommandError, EnvironmentError):
+        continue
+      if head is not None:
+        heads[path] = head
+    return heads
+
+  def _GetIncrementalSyncPaths(self, local_manifest):
+    """Work out which projects need syncing to move to |local_manifest|.
+
+    This compares |local_manifest| to the manifest of the last completed
+    sync, and to what each project actually has checked out.
+
+    Args:
+      local_manifest: The manifest that is going to be synced.
+
+    Returns:
+      A sorted list of the paths of the projects whose revision or remote
+      changed, or None if a full sync is needed instead.
+    """
+    if not local_manifest or local_manifest == self.DEFAULT_MANIFEST:
+      return None
+    if not os.path.exists(self._SyncedManifestPath):
+      logging.info('No record of the last sync; doing a full sync.')
+      return None
+
+    try:
+      old = git.Manifest(self._SyncedManifestPath)
+      new = git.Manifest(local_manifest)
+    except Exception as e:
+      logging.warning('Failed comparing the manifests; doing a full sync: %s',
+                      e)
+      return None
+
+    def _ProjectLayout(manifest):
+      return dict((x['path'], x['name']) for x in manifest.projects.values())
+
+    if _ProjectLayout(old) != _ProjectLayout(new):
+      logging.info('Projects were added, removed or moved; doing a full sync.')
+      return None
+
+    new_revisions = dict((x['path'], x['revision'])
+                         for x in new.projects.itervalues())
+    if not all(self._SHA1_RE.match(x) for x in new_revisions.itervalues()):
+      logging.info('%s is not revision locked; doing a full sync.',
+                   local_manifest)
+      return None
+
+    heads = self._GetProjectHeads(new_revisions.keys())
+    if len(heads) != len(new_revisions):
+      logging.info('Some projects are not checked out; doing a full sync.')
+      return None
+
+    def _RemoteUrls(manifest):
+      return dict((x['path'], manifest.remotes[x['remote']].get('fetch'))
+                  for x in manifest.projects.itervalues())
+
+    old_remotes = _RemoteUrls(old)
+    new_remotes = _RemoteUrls(new)
+    # Projects might also have moved on from the last sync, e.g. by having
+    # patches applied to them; repo resets those too.
+    return sorted(path for path, revision in new_revisions.iteritems()
+                  if heads[path] != revision or
+                  old_remotes[path] != new_remotes[path])
+
+  def _IncrementalSync(self, local_manifest, jobs=None, all_branches=False):
+    """Sync only the projects that changed since the last sync.
+
+    Args:
+      local_manifest: The revision locked manifest to sync to.
+      jobs: The most projects to fetch at once.  Defaults to the manifest's
+        sync-j.
+      all_branches: See Sync().
+
+    Returns:
+      True if the incremental sync succeeded, or False if a full sync is
+      needed.
+    """
+    paths = self._GetIncrementalSyncPaths(local_manifest)
+    if paths is None:
+      return False
+
+    # If anything goes wrong from here, the checkout no longer matches it.
+    osutils.SafeUnlink(self._SyncedManifestPath)
+    logging.info('Incrementally syncing %d changed projects: %s', len(paths),
+                 ' '.join(paths))
+    if paths:
+      if not jobs:
+        jobs = git.Manifest(local_manifest).default.get('sync-j', 1)
+      # There's no point starting more jobs than there are projects.
+      jobs = max(1, min(int(jobs), len(paths)))
+      cmd = ['repo', '--time', 'sync', '--jobs', str(jobs)]
+      if not all_branches:
+        cmd.append('-c')
+      try:
+        cros_build_lib.RunCommandWithRetries(
+            constants.SYNC_RETRIES, cmd + ['-n'] + paths, cwd=self.directory)
+        cros_build_lib.RunCommand(cmd + ['-l'] + paths, cwd=self.directory)
+      except cros_build_lib.RunCommandError as e:
+        logging.warning('Incremental sync failed; doing a full sync: %s',
+                        e.Stringify(error=False, output=False))
+        return False
+
+      revisions = dict((x['path'], x['revision']) for x in
+                       git.Manifest(local_manifest).projects.itervalues())
+      heads = self._GetProjectHeads(paths)
+      if any(heads.get(x) != revisions[x] for x in paths):
+        logging.warning('Incremental sync did not check out the expected '
+                        'revisions; doing a full sync.')
+        return False
+
+    self._RecordSyncedManifest(local_manifest)
+    return True
+
   def Sync(self, local_manifest=None, jobs=None, cleanup=True,
-           all_branches=False, network_only=False):
+           all_branches=False, network_only=False, incremental=False):
     """Sync/update the source.  Changes manifest if specified.
 
     Args:
@@ -317,6 +466,9 @@ class RepoRepository(object):
         if the manifest has bad copyfile statements, via skipping checkout
         the broken copyfile tag won't be spotted), or of use when the
         invoking code is fine w/ operating on bare repos, ie .repo/projects/*.
+      incremental: If true, and local_manifest is revision locked, only fetch
+        and check out the projects that changed since the last sync.  Falls
+        back to a full sync if that can't safely be done.
     """
     try:
       # Always re-initialize to the current branch.
@@ -327,6 +479,12 @@ class RepoRepository(object):
       if cleanup:
         configure_repo.FixBrokenExistingRepos(self.directory)
 
+      if (incremental and not network_only and
+          self._IncrementalSync(local_manifest, jobs=jobs,
+                                all_branches=all_branches)):
+        return
+
+      osutils.SafeUnlink(self._SyncedManifestPath)
       cmd = ['repo', '--time', 'sync']
       if jobs:
         cmd += ['--jobs', str(jobs)]
@@ -352,8 +510,9 @@ class RepoRepository(object):
         if not targets:
           # No directories to wipe, thus nothing we can fix.
           raise
-        cros_build_lib.SudoRunCommand(['rm', '-rf'] + sorted(targets),
-                                      cwd=self.directory)
+        for target in sorted(targets):
+          osutils.RmDirInBackground(self.GetRelativePath(target),
+                                    ignore_missing=True, sudo=True)
 
         # Retry the sync now; if it fails, let the exception propagate.
         cros_build_lib.RunCommand(cmd + ['-l'], cwd=self.directory)
@@ -366,6 +525,7 @@ class RepoRepository(object):
       # same cleanup- we however kick it erring on the side of caution.
       self._EnsureMirroring(True)
       self._DoCleanup()
+      self._RecordSyncedManifest()
 
     except cros_build_lib.RunCommandError, e:
       err_msg = e.Stringify(error=False, output=False)
@@ -399,8 +559,9 @@ class RepoRepository(object):
     # Finally... wipe anything that's greater than our threshold.
     wipes = [k for k, v in data.iteritems() if v > self.LRU_THRESHOLD]
     if wipes:
-      cros_build_lib.SudoRunCommand(
-          ['rm', '-rf'] + [os.path.join(repo_path, proj) for proj in wipes])
+      for proj in wipes:
+        osutils.RmDirInBackground(os.path.join(repo_path, proj),
+                                  ignore_missing=True, sudo=True)
       map(data.pop, wipes)
 
     osutils.WriteFile(path, "\n".join('%s %i' % x for x in data.iteritems()))
@@ -409,6 +570,38 @@ class RepoRepository(object):
     """Returns full path including source directory of path in repo."""
     return os.path.join(self.directory, path)
 
+  def _PinManifest(self, output):
+    """Returns the manifest |output| with each project pinned to its HEAD.
+
+    This is what `repo manifest -r` does, but without running git for every
+    project; see ManifestCheckout.ResolveRevisions.  As with repo, the
+    revision a project followed is kept as its upstream attribute.
+
+    Returns:
+      The pinned manifest, or None if it couldn't be pinned (the checkout
+      couldn't be read, or a project's HEAD couldn't be resolved).
+    """
+    try:
+      manifest = git.ManifestCheckout.Cached(self.directory)
+      heads = manifest.ResolveRevisions(refresh=True)
+    except (cros_build_lib.RunCommandError, EnvironmentError) as e:
+      logging.warning('Failed to read the checkout: %s', e)
+      return None
+
+    dom = minidom.parseString(output)
+    for element in dom.getElementsByTagName('project'):
+      name = element.getAttribute('name')
+      project = manifest.projects.get(name)
+      if project is None or heads.get(name) is None:
+        logging.warning('Failed to resolve HEAD of %s', name)
+        return None
+      upstream = str(project['revision'])
+      element.setAttribute('revision', heads[name])
+      if upstream != heads[name]:
+        element.setAttribute('upstream', upstream)
+    return '<?xml version="1.0" encoding="UTF-8"?>\n%s\n' % (
+        dom.documentElement.toxml(encoding='UTF-8'),)
+
   def ExportManifest(self, mark_revision=False, revisions=True):
     """Export the revision locked manifest
 
@@ -423,11 +616,17 @@ class RepoRepository(object):
       The manifest as a string.
     """
     cmd = ['repo', 'manifest', '-o', '-']
-    if revisions:
-      cmd += ['-r']
     output = cros_build_lib.RunCommandCaptureOutput(
         cmd, cwd=self.directory, print_cmd=False,
         extra_env={'PAGER':'cat'}).output
+    if revisions:
+      pinned = self._PinManifest(output)
+      if pinned is None:
+        # Let repo do it the slow way, and raise if it can't either.
+        pinned = cros_build_lib.RunCommandCaptureOutput(
+            cmd + ['-r'], cwd=self.directory, print_cmd=False,
+            extra_env={'PAGER':'cat'}).output
+      output = pinned
 
     if not mark_revision:
       return output
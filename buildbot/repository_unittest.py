@@ -10,9 +10,12 @@ import sys
 
 import constants
 sys.path.insert(0, constants.SOURCE_ROOT)
+from chromite.buildbot import configure_repo
 from chromite.buildbot import repository
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_test_lib
+from chromite.lib import git
+from chromite.lib import osutils
 
 # pylint: disable=W0212,R0904,E1101,W0613
 class RepositoryTests(cros_test_lib.MoxTestCase):
@@ -83,5 +86,166 @@ class RepoInitChromeBotTests(RepoInitTests):
     os.putenv('GIT_AUTHOR_EMAIL', 'chrome-bot@chromium.org')
 
 
+class RepoIncrementalSyncTests(cros_test_lib.MoxTempDirTestCase):
+  """Tests for incrementally syncing to a new manifest."""
+
+  PROJECTS = ('a', 'b/c')
+
+  def setUp(self):
+    for path in ('repo', 'manifests'):
+      osutils.SafeMakedirs(os.path.join(self.tempdir, '.repo', path))
+
+    # Give each project two commits to move between.
+    self.revisions = {}
+    for path in self.PROJECTS:
+      project_dir = os.path.join(self.tempdir, path)
+      osutils.SafeMakedirs(project_dir)
+      git.RunGit(project_dir, ['init'])
+      for message in ('first', 'second'):
+        git.RunGit(project_dir, ['commit', '--allow-empty', '-m', message])
+        self.revisions.setdefault(path, []).append(git.RunGit(
+            project_dir, ['rev-parse', 'HEAD']).output.strip())
+      self._Checkout(path, 0)
+
+    self.repo = repository.RepoRepository('fake url', self.tempdir)
+    self.manifest = os.path.join(self.tempdir, 'manifest.xml')
+    self._WriteManifest(self.repo._SyncedManifestPath, a=0, b=0)
+
+  def _Checkout(self, path, index, run=cros_build_lib.RunCommand):
+    run(['git', 'checkout', '-q', self.revisions[path][index]],
+        cwd=os.path.join(self.tempdir, path), print_cmd=False)
+
+  def _WriteManifest(self, manifest, a, b, fetch='https://fake', extra=''):
+    """Write a manifest with the given revisions of projects a and b/c."""
+    revisions = dict(a=a, b=b)
+    for key, index in revisions.iteritems():
+      if isinstance(index, int):
+        revisions[key] = self.revisions['a' if key == 'a' else 'b/c'][index]
+    osutils.WriteFile(manifest, """<?xml version="1.0" encoding="UTF-8"?>
+<manifest>
+  <remote fetch="%s" name="cros"/>
+  <default remote="cros" revision="refs/heads/master" sync-j="8"/>
+  <project name="proj/a" path="a" revision="%s"/>
+  <project name="proj/b" path="b/c" revision="%s"/>
+  %s
+</manifest>
+""" % (fetch, revisions['a'], revisions['b'], extra))
+
+  def testChangedProjects(self):
+    """Tests that only projects with new revisions or remotes are synced."""
+    self._WriteManifest(self.manifest, a=1, b=0)
+    self.assertEqual(self.repo._GetIncrementalSyncPaths(self.manifest), ['a'])
+
+    # A project which moved since the last sync (e.g. had patches applied)
+    # must be reset.
+    self._Checkout('b/c', 1)
+    self.assertEqual(self.repo._GetIncrementalSyncPaths(self.manifest),
+                     ['a', 'b/c'])
+
+    self._WriteManifest(self.manifest, a=0, b=1, fetch='https://moved')
+    self.assertEqual(self.repo._GetIncrementalSyncPaths(self.manifest),
+                     ['a', 'b/c'])
+
+  def testExportManifest(self):
+    """Verify projects are pinned to what is checked out, as repo would."""
+    manifests = os.path.join(self.tempdir, '.repo', 'manifests')
+    git.RunGit(manifests, ['init'])
+    git.RunGit(manifests, ['commit', '--allow-empty', '-m', 'manifests'])
+    git.RunGit(manifests, ['checkout', '-q', '-b', 'default'])
+    git.RunGit(manifests, ['config', 'branch.default.remote', 'origin'])
+    git.RunGit(manifests, ['config', 'branch.default.merge', 'master'])
+    os.symlink(os.path.join(manifests, '.git'), manifests + '.git')
+    checkout_manifest = os.path.join(self.tempdir, '.repo', 'manifest.xml')
+    self._WriteManifest(checkout_manifest, a='refs/heads/master', b=1)
+    self._Checkout('b/c', 1)
+    capture = cros_build_lib.RunCommandCaptureOutput
+
+    def _RunCommandCaptureOutput(cmd, **kwargs):
+      # Stand in for `repo manifest`, which emits the unpinned manifest.
+      if cmd[0] == 'repo':
+        return cros_build_lib.CommandResult(
+            output=osutils.ReadFile(checkout_manifest))
+      return capture(cmd, **kwargs)
+
+    self.mox.stubs.Set(cros_build_lib, 'RunCommandCaptureOutput',
+                       _RunCommandCaptureOutput)
+    osutils.WriteFile(self.manifest, self.repo.ExportManifest())
+    projects = git.Manifest(self.manifest).projects
+    self.assertEqual(projects['proj/a']['revision'], self.revisions['a'][0])
+    self.assertEqual(projects['proj/a']['upstream'], 'refs/heads/master')
+    self.assertEqual(projects['proj/b']['revision'], self.revisions['b/c'][1])
+    self.assertFalse('upstream' in projects['proj/b'])
+
+  def testExportManifestFallback(self):
+    """Verify repo pins the manifest when the checkout can't be read."""
+    # There's no manifests checkout, so the checkout can't be read.
+    calls = []
+
+    def _RunCommandCaptureOutput(cmd, **_kwargs):
+      calls.append(cmd)
+      return cros_build_lib.CommandResult(output='-r' in cmd and 'pinned')
+
+    self.mox.stubs.Set(cros_build_lib, 'RunCommandCaptureOutput',
+                       _RunCommandCaptureOutput)
+    self.assertEqual(self.repo.ExportManifest(), 'pinned')
+    self.assertEqual(calls, [['repo', 'manifest', '-o', '-'],
+                             ['repo', 'manifest', '-o', '-', '-r']])
+
+  def testRecordSyncedManifestFailure(self):
+    """Verify failing to record the synced manifest only drops the record."""
+    def _ExportManifest():
+      raise repository.SrcCheckOutException('failed')
+
+    self.mox.stubs.Set(self.repo, 'ExportManifest', _ExportManifest)
+    self.repo._RecordSyncedManifest()
+    self.assertFalse(os.path.exists(self.repo._SyncedManifestPath))
+
+  def testFallBackToFullSync(self):
+    """Tests that inconsistencies fall back to a full sync."""
+    self.assertEqual(self.repo._GetIncrementalSyncPaths(
+        repository.RepoRepository.DEFAULT_MANIFEST), None)
+
+    # Not revision locked.
+    self._WriteManifest(self.manifest, a=1, b='refs/heads/master')
+    self.assertEqual(self.repo._GetIncrementalSyncPaths(self.manifest), None)
+
+    # A new project.
+    self._WriteManifest(self.manifest, a=1, b=0,
+                        extra='<project name="proj/d" path="d"/>')
+    self.assertEqual(self.repo._GetIncrementalSyncPaths(self.manifest), None)
+
+    # A project which isn't checked out.
+    self._WriteManifest(self.manifest, a=1, b=0)
+    osutils.RmDir(os.path.join(self.tempdir, 'b'))
+    self.assertEqual(self.repo._GetIncrementalSyncPaths(self.manifest), None)
+
+    # No record of the last sync.
+    osutils.SafeUnlink(self.repo._SyncedManifestPath)
+    self.assertEqual(self.repo._GetIncrementalSyncPaths(self.manifest), None)
+
+  def testIncrementalSync(self):
+    """Tests that an incremental sync only runs repo on changed projects."""
+    self._WriteManifest(self.manifest, a=1, b=0)
+    self.mox.StubOutWithMock(repository.RepoRepository, 'Initialize')
+    self.mox.StubOutWithMock(configure_repo, 'FixBrokenExistingRepos')
+    self.mox.StubOutWithMock(cros_build_lib, 'RunCommandWithRetries')
+    real_run = cros_build_lib.RunCommand
+    self.mox.StubOutWithMock(cros_build_lib, 'RunCommand')
+
+    cmd = ['repo', '--time', 'sync', '--jobs', '1', '-c']
+    self.repo.Initialize(self.manifest)
+    configure_repo.FixBrokenExistingRepos(self.tempdir)
+    cros_build_lib.RunCommandWithRetries(
+        constants.SYNC_RETRIES, cmd + ['-n', 'a'], cwd=self.tempdir)
+    cros_build_lib.RunCommand(cmd + ['-l', 'a'], cwd=self.tempdir
+        ).WithSideEffects(lambda *_args, **_kwargs: self._Checkout(
+            'a', 1, run=real_run))
+    self.mox.ReplayAll()
+    self.repo.Sync(self.manifest, incremental=True)
+    self.mox.VerifyAll()
+    self.assertEqual(osutils.ReadFile(self.repo._SyncedManifestPath),
+                     osutils.ReadFile(self.manifest))
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
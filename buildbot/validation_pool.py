@@ -9,9 +9,14 @@ ready for the commit queue to try.
 """
 
 import contextlib
+import cPickle
+import functools
+import itertools
 import logging
+import os
 import sys
 import time
+import traceback
 import urllib
 from xml.dom import minidom
 
@@ -22,6 +27,8 @@ from chromite.buildbot import portage_utilities
 from chromite.lib import cros_build_lib
 from chromite.lib import gerrit
 from chromite.lib import git
+from chromite.lib import osutils
+from chromite.lib import parallel
 from chromite.lib import patch as cros_patch
 
 _BUILD_DASHBOARD = 'http://build.chromium.org/p/chromiumos'
@@ -167,6 +174,39 @@ class HelperPool(object):
       if helper:
         yield helper
 
+  def Query(self, query, max_parallel=None, **kwds):
+    """Run a query against all of our helpers at once.
+
+    Args:
+      query: The query to run; either a string to ask every helper, or a
+        dict of remote to the query to ask that remote's helper.
+      max_parallel: See gerrit.RunQueries.
+      kwds: Passed to each GerritHelper.Query.
+
+    Returns:
+      A tuple of two dicts, keyed by remote: the results from each remote
+      queried successfully, and the sys.exc_info() of the exception each
+      other one failed with.
+    """
+    if isinstance(query, basestring):
+      queries = [(helper, query) for helper in self]
+    else:
+      queries = [(self.GetHelper(remote), remote_query)
+                 for remote, remote_query in query.iteritems()]
+
+    results, errors = {}, {}
+    outcomes = gerrit.RunQueries(
+        [(helper, remote_query, kwds) for helper, remote_query in queries],
+        max_parallel=max_parallel)
+    for (helper, _), (result, error) in zip(queries, outcomes):
+      if error is None:
+        results[helper.remote] = result
+      else:
+        logging.warning('Querying the %s gerrit failed: %s', helper.remote,
+                        error[1], exc_info=error)
+        errors[helper.remote] = error
+    return results, errors
+
 
 def _PatchWrapException(functor):
   """Decorator to intercept patch exceptions and wrap them.
@@ -197,6 +237,14 @@ def _PatchWrapException(functor):
 class PatchSeries(object):
   """Class representing a set of patches applied to a single git repository."""
 
+  # The most groups of transactions to apply at once with parallel_apply.
+  MAX_PARALLEL_APPLY = 8
+
+  # What fetching and applying a change records on it; this is copied back
+  # from the processes applying transactions in parallel.
+  _APPLY_STATE = ('sha1', 'change_id', 'id', 'commit_message',
+                  '_subject_line', '_is_fetched')
+
   def __init__(self, path, helper_pool=None, force_content_merging=False,
                forced_manifest=None, deps_filter_fn=None):
 
@@ -294,6 +342,20 @@ class PatchSeries(object):
           self.GetTrackingBranchForChange(change, True),
           query_text)
     change = helper.QuerySingleRecord(query_text, must_match=True)
+    return self._CacheGerritPatch(query, change, parent_lookup=parent_lookup)
+
+  def _CacheGerritPatch(self, query, change, parent_lookup=False):
+    """Record a change pulled from gerrit in our caches.
+
+    Args:
+      query: The (external form) dependency that was queried for.
+      change: The cros_patch.GerritPatch gerrit returned for it.
+      parent_lookup: See _GetGerritPatch.
+
+    Returns:
+      The change to use for |query|; this is an existing change if we
+      already had it.
+    """
     # If the query was a gerrit number based query, check the projects/change-id
     # to see if we already have it locally, but couldn't map it since we didn't
     # know the gerrit number at the time of the initial injection.
@@ -315,6 +377,70 @@ class PatchSeries(object):
       self.InjectCommittedPatches([change])
     return change
 
+  def _PrefetchDependencies(self, changes, limit_to=None):
+    """Look up the dependencies of |changes| from gerrit in bulk.
+
+    The dependency graph is walked breadth first.  At each level, every
+    dependency not already in our caches is gathered up and looked up with a
+    single QueryMultipleCurrentPatchset per gerrit instance, with the
+    results going into the lookup cache.  This way, resolving the changes
+    afterwards finds them there rather than querying gerrit for each in
+    turn.
+
+    Anything that can't be looked up this way- sha1 dependencies, or a level
+    where one of the queries fails- is left for that resolution to look up,
+    and report on, as usual.
+
+    Args:
+      changes: A sequence of cros_patch.GitRepoPatch instances.
+      limit_to: See _LookupUncommittedChanges; dependencies outside of this
+        won't be resolved further, so neither are their dependencies.
+    """
+    seen = cros_patch.PatchCache()
+    pending = list(changes)
+    while pending:
+      queries = {}
+      for change in pending:
+        if change in seen:
+          continue
+        seen.Inject(change)
+        try:
+          deps = self._GetDepsForChange(change)
+        except cros_patch.PatchException:
+          continue
+        for dep in itertools.chain(*deps):
+          if dep in self._committed_cache or dep in self._lookup_cache:
+            continue
+          try:
+            query = cros_patch.FormatPatchDep(dep, force_external=True,
+                                              sha1=False)
+          except ValueError:
+            continue
+          remote = constants.EXTERNAL_REMOTE
+          if dep.startswith('*'):
+            remote = constants.INTERNAL_REMOTE
+          queries.setdefault(remote, set()).add(query)
+
+      pending = []
+      for remote, remote_queries in queries.iteritems():
+        helper = self._helper_pool.GetHelper(remote)
+        try:
+          results = list(helper.QueryMultipleCurrentPatchset(
+              sorted(remote_queries)))
+        except gerrit.GerritException as e:
+          logging.info('Bulk lookup of %s failed; falling back to looking '
+                       'them up individually: %s',
+                       ', '.join(sorted(remote_queries)), e)
+          continue
+        for query, change in results:
+          change = self._CacheGerritPatch(query, change)
+          if getattr(change, 'IsAlreadyMerged', lambda: False)():
+            continue
+          elif limit_to is None or change in limit_to:
+            pending.append(change)
+      # Finding their dependencies requires the changes themselves.
+      self.FetchChanges(pending)
+
   @_PatchWrapException
   def _LookupUncommittedChanges(self, parent, deps, parent_lookup=False,
                                 limit_to=None):
@@ -428,10 +554,17 @@ class PatchSeries(object):
     val = self._change_deps_cache.get(change)
     if val is None:
       git_repo = self.GetGitRepoForChange(change)
-      val = self._change_deps_cache[change] = (
-          change.GerritDependencies(
-              git_repo, self.GetTrackingBranchForChange(change)),
-          change.PaladinDependencies(git_repo))
+      try:
+        val = (change.GerritDependencies(
+                   git_repo, self.GetTrackingBranchForChange(change)),
+               change.PaladinDependencies(git_repo))
+      except cros_patch.PatchException:
+        # Remember the failure too; the metadata won't change on a retry.
+        val = sys.exc_info()
+      self._change_deps_cache[change] = val
+    if len(val) == 3:
+      # The exc_info of an earlier failure.
+      raise val[0], val[1], val[2]
     return val
 
   def _PerformResolveChange(self, change, plan, stack, limit_to=None):
@@ -473,8 +606,8 @@ class PatchSeries(object):
     self._lookup_cache.Inject(*changes)
 
   def FetchChanges(self, changes):
-    for change in changes:
-      change.Fetch(self.GetGitRepoForChange(change))
+    cros_patch.FetchPatches(
+        [(change, self.GetGitRepoForChange(change)) for change in changes])
 
   def _ApplyDecorator(functor):
     """Decorator for Apply that does appropriate self.manifest manipulation.
@@ -510,7 +643,7 @@ class PatchSeries(object):
 
   @_ApplyDecorator
   def Apply(self, changes, dryrun=False, frozen=True,
-            honor_ordering=False, changes_filter=None):
+            honor_ordering=False, changes_filter=None, parallel_apply=False):
     """Applies changes from pool into the build root specified by the manifest.
 
     This method resolves each given change down into a set of transactions-
@@ -545,6 +678,9 @@ class PatchSeries(object):
         changes being inspected, and expand the changes if necessary.
         Primarily this is of use for cbuildbot patching when dealing w/
         uploaded/remote patches.
+      parallel_apply: If True, transactions that touch disjoint sets of
+        repositories are applied concurrently.  The result is the same as
+        applying them one after another.
     Returns:
       A tuple of changes-applied, Exceptions for the changes that failed
       against ToT, and Exceptions that failed inflight;  These exceptions
@@ -559,6 +695,7 @@ class PatchSeries(object):
 
     self.InjectLookupCache(changes)
     allowed_changes = cros_patch.PatchCache(changes) if frozen else None
+    self._PrefetchDependencies(changes, limit_to=allowed_changes)
     resolved, applied, failed = [], [], []
     for change in changes:
       try:
@@ -586,21 +723,15 @@ class PatchSeries(object):
         return -len(ids), position[data[0]]
       resolved.sort(key=mk_key)
 
-    for inducing_change, transaction_changes in resolved:
-      try:
-        with self._Transaction(transaction_changes):
-          logging.debug("Attempting transaction for %s: changes: %s",
-                        inducing_change,
-                        ', '.join(map(str, transaction_changes)))
-          self._ApplyChanges(inducing_change, transaction_changes,
-                             dryrun=dryrun)
-      except cros_patch.PatchException, e:
-        logging.info("Failed applying transaction for %s: %s",
-                     inducing_change, e)
-        failed.append(e)
-      else:
+    if parallel_apply:
+      errors = self._ApplyTransactionsInParallel(resolved, dryrun=dryrun)
+    else:
+      errors = self._ApplyTransactions(resolved, dryrun=dryrun)
+    for (_, transaction_changes), error in zip(resolved, errors):
+      if error is None:
         applied.extend(transaction_changes)
-        self.InjectCommittedPatches(transaction_changes)
+      else:
+        failed.append(error)
 
     # Uniquify while maintaining order.
     def _uniq(l):
@@ -617,6 +748,147 @@ class PatchSeries(object):
     failed_inflight = [x for x in failed if x.inflight]
     return applied, failed_tot, failed_inflight
 
+  def _ApplyTransactions(self, transactions, dryrun=False):
+    """Apply the given transactions in order.
+
+    Args:
+      transactions: A sequence of (inducing change, changes) pairs.
+      dryrun: See Apply.
+
+    Returns:
+      A list with, for each transaction, None if it was applied, or the
+      cros_patch.PatchException it failed with.
+    """
+    errors = []
+    for inducing_change, transaction_changes in transactions:
+      try:
+        with self._Transaction(transaction_changes):
+          logging.debug("Attempting transaction for %s: changes: %s",
+                        inducing_change,
+                        ', '.join(map(str, transaction_changes)))
+          self._ApplyChanges(inducing_change, transaction_changes,
+                             dryrun=dryrun)
+      except cros_patch.PatchException, e:
+        logging.info("Failed applying transaction for %s: %s",
+                     inducing_change, e)
+        errors.append(e)
+      else:
+        errors.append(None)
+        self.InjectCommittedPatches(transaction_changes)
+    return errors
+
+  def _PartitionTransactions(self, transactions):
+    """Group transactions so that no two groups share a repository.
+
+    Transactions already include their cross project dependencies, and a
+    change can only be in two transactions if both touch its repository;
+    thus transactions in different groups can't affect each other.
+
+    Args:
+      transactions: A sequence of (inducing change, changes) pairs.
+
+    Returns:
+      A list of groups, each a list of indexes into |transactions| in their
+      original order.
+    """
+    group_repos, group_members = {}, {}
+    for idx, (_, changes) in enumerate(transactions):
+      repos = set(self.GetGitRepoForChange(change) for change in changes)
+      members = [idx]
+      for group, other_repos in group_repos.items():
+        if repos & other_repos:
+          repos |= group_repos.pop(group)
+          members += group_members.pop(group)
+      group_repos[idx], group_members[idx] = repos, sorted(members)
+    return sorted(group_members.values())
+
+  def _ApplyTransactionsInParallel(self, transactions, dryrun=False):
+    """Like _ApplyTransactions, but applying independent groups in parallel.
+
+    Each group of transactions sharing repositories is applied by its own
+    process, in order.  The outcome, what failed_tot and the committed
+    cache record, and the state the changes picked up while being fetched
+    and applied are then merged back as if they had been applied serially.
+
+    Raises:
+      The exception a group failed with, if it wasn't a PatchException; if
+      several groups failed so, the first group's is raised once all of
+      their tracebacks have been logged.
+    """
+    groups = self._PartitionTransactions(transactions)
+    if len(groups) < 2:
+      return self._ApplyTransactions(transactions, dryrun=dryrun)
+
+    # Results refer to our changes by id() rather than copying them, so that
+    # the changes in the results are the very ones we were given; forked
+    # children see the same ids.
+    changes = dict((id(change), change) for _, transaction_changes
+                   in transactions for change in transaction_changes)
+
+    def _PersistentId(obj):
+      return str(id(obj)) if id(obj) in changes else None
+
+    def _Dump(path, result):
+      with open(path, 'wb') as f:
+        pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = _PersistentId
+        pickler.dump(result)
+
+    def _ApplyGroup(group, path):
+      failed_tot = self.failed_tot.copy()
+      group_changes = set(change for idx in group
+                          for change in transactions[idx][1])
+      try:
+        errors = self._ApplyTransactions([transactions[x] for x in group],
+                                         dryrun=dryrun)
+      except Exception, e:
+        # Hand the exception itself back so the parent can raise it as is,
+        # rather than as a BackgroundFailure.
+        tb = traceback.format_exc()
+        try:
+          _Dump(path, (None, None, None, (e, tb)))
+        except (cPickle.PicklingError, TypeError):
+          _Dump(path, (None, None, None, (parallel.BackgroundFailure(tb), tb)))
+        return
+      new_failures = dict((k, v) for k, v in self.failed_tot.iteritems()
+                          if failed_tot.get(k) is not v)
+      state = [(change, dict((attr, getattr(change, attr))
+                             for attr in self._APPLY_STATE
+                             if hasattr(change, attr)))
+               for change in group_changes]
+      _Dump(path, (errors, new_failures, state, None))
+
+    errors = [None] * len(transactions)
+    unexpected = []
+    with osutils.TempDirContextManager() as tempdir:
+      paths = [os.path.join(tempdir, str(idx)) for idx in xrange(len(groups))]
+      steps = [functools.partial(_ApplyGroup, group, path)
+               for group, path in zip(groups, paths)]
+      parallel.RunParallelSteps(steps, max_parallel=self.MAX_PARALLEL_APPLY)
+
+      for group, path in zip(groups, paths):
+        with open(path, 'rb') as f:
+          unpickler = cPickle.Unpickler(f)
+          unpickler.persistent_load = lambda key: changes[int(key)]
+          group_errors, new_failures, state, failure = unpickler.load()
+        if failure is not None:
+          unexpected.append(failure)
+          continue
+        for change, attrs in state:
+          for attr, value in attrs.iteritems():
+            setattr(change, attr, value)
+        self.failed_tot.update(new_failures)
+        for idx, error in zip(group, group_errors):
+          errors[idx] = error
+          if error is None:
+            self.InjectCommittedPatches(transactions[idx][1])
+
+    for _, tb in unexpected:
+      logging.error('Failed applying transactions:\n%s', tb)
+    if unexpected:
+      raise unexpected[0][0]
+    return errors
+
   @contextlib.contextmanager
   def _Transaction(self, commits):
     """ContextManager used to rollback changes to a build root if necessary.
@@ -966,9 +1238,17 @@ class ValidationPool(object):
       # Only master configurations should call this method.
       pool = ValidationPool(overlays, build_root, build_number, builder_name,
                             True, dryrun)
-      # Iterate through changes from all gerrit instances we care about.
-      for helper in cls.GetGerritHelpersForOverlays(overlays):
-        raw_changes = helper.Query(changes_query, sort='lastUpdated')
+      # Query all gerrit instances we care about at once, then iterate
+      # through their changes.
+      helpers = cls.GetGerritHelpersForOverlays(overlays)
+      results, errors = helpers.Query(changes_query, sort='lastUpdated',
+                                      incremental=True)
+      if errors:
+        # Query logged each failure; raise the same one whatever the order.
+        exc_type, exc, tb = errors[min(errors)]
+        raise exc_type, exc, tb
+      for helper in helpers:
+        raw_changes = results[helper.remote]
         raw_changes.reverse()
 
         changes, non_manifest_changes = ValidationPool._FilterNonCrosProjects(
@@ -1115,7 +1395,8 @@ class ValidationPool(object):
     try:
       # pylint: disable=E1123
       applied, failed_tot, failed_inflight = self._patch_series.Apply(
-          self.changes, dryrun=self.dryrun, manifest=manifest)
+          self.changes, dryrun=self.dryrun, manifest=manifest,
+          parallel_apply=True)
     except (KeyboardInterrupt, RuntimeError, SystemExit):
       raise
     except Exception, e:
@@ -315,8 +315,7 @@ class TestPatchSeries(base):
     self.SetPatchApply(patch1)
     self.SetPatchApply(patch3)
 
-    self._SetQuery(series, patch2, query=patch2.gerrit_number,
-        is_parent=False).AndReturn(patch2)
+    self._SetBulkQuery(series, [patch2], queries=[patch2.gerrit_number])
 
     self.mox.ReplayAll()
     applied = self.assertResults(series, [patch1, patch3], [patch3, patch1])[0]
@@ -359,6 +358,17 @@ class TestPatchSeries(base):
           change.project, os.path.basename(change.tracking_branch), query)
     return helper.QuerySingleRecord(query, must_match=True)
 
+  @staticmethod
+  def _SetBulkQuery(series, changes, queries=None, error=None,
+                    remote=constants.EXTERNAL_REMOTE):
+    helper = series._helper_pool.GetHelper(remote)
+    if queries is None:
+      queries = [change.id for change in changes]
+    call = helper.QueryMultipleCurrentPatchset(sorted(queries))
+    if error is not None:
+      return call.AndRaise(error)
+    return call.AndReturn(zip(queries, changes))
+
   def testApplyMissingDep(self):
     """Test that we don't try to apply a change without met dependencies.
 
@@ -370,6 +380,22 @@ class TestPatchSeries(base):
     patch1, patch2 = self.GetPatches(2)
 
     self.SetPatchDeps(patch2, [patch1.id])
+    self._SetBulkQuery(series, [patch1])
+
+    self.mox.ReplayAll()
+    self.assertResults(series, [patch2],
+                       [], [patch2])
+    self.mox.VerifyAll()
+
+  def testBulkLookupFallback(self):
+    """Verify deps are looked up individually if the bulk lookup fails."""
+    series = self.GetPatchSeries()
+
+    patch1, patch2 = self.GetPatches(2)
+
+    self.SetPatchDeps(patch2, [patch1.id])
+    self._SetBulkQuery(series, [patch1],
+                       error=gerrit.GerritException('bad query'))
     self._SetQuery(series, patch1, is_parent=True).AndReturn(patch1)
 
     self.mox.ReplayAll()
@@ -386,14 +412,13 @@ class TestPatchSeries(base):
     patch2 = self.GetPatches(1)
 
     self.SetPatchDeps(patch2, [patch1.id])
-    self._SetQuery(series, patch1, is_parent=True).AndReturn(patch1)
     self.SetPatchApply(patch2)
 
     # Used to ensure that an uncommitted change put in the lookup cache
     # isn't invalidly pulled into the graph...
     patch3, patch4, patch5 = self.GetPatches(3)
 
-    self._SetQuery(series, patch3, is_parent=True).AndReturn(patch3)
+    self._SetBulkQuery(series, [patch1, patch3])
     self.SetPatchDeps(patch4, [patch3.id])
     self.SetPatchDeps(patch5, [patch3.id])
 
@@ -513,6 +538,152 @@ class TestPatchSeries(base):
     self.assertResults(series, patches, patches)
     self.mox.VerifyAll()
 
+  def testPartitionTransactions(self):
+    """Verify transactions are only grouped when they share a repository."""
+    series = self.GetPatchSeries()
+    series.manifest = MockManifest(self.build_root)
+    a1, a2 = self.GetPatches(2, project='a')
+    b1 = self.GetPatches(1, project='b')
+    c1 = self.GetPatches(1, project='c')
+    d1 = self.GetPatches(1, project='d')
+    transactions = [(a1, [a1]), (b1, [b1]), (c1, [b1, c1]), (a2, [a2]),
+                    (d1, [d1])]
+    self.assertEqual(series._PartitionTransactions(transactions),
+                     [[0, 3], [1, 2], [4]])
+
+  def testApplyTransactionsInParallel(self):
+    """Verify parallel application matches serial application."""
+    patches = (self.GetPatches(2, project='a') +
+               self.GetPatches(2, project='b') +
+               [self.GetPatches(1, project='c')])
+    a2, b1 = patches[1], patches[2]
+    transactions = [(x, [x]) for x in patches]
+
+    def _ApplyChanges(_inducing_change, changes, dryrun=False):
+      # pylint: disable=W0613
+      for change in changes:
+        if change in (a2, b1):
+          error = cros_patch.ApplyPatchException(change)
+          series.failed_tot[change.id] = error
+          raise error
+
+    results = []
+    for parallel_apply in (False, True):
+      series = self.GetPatchSeries()
+      series.manifest = MockManifest(self.build_root)
+      series._ApplyChanges = _ApplyChanges
+      if parallel_apply:
+        errors = series._ApplyTransactionsInParallel(transactions)
+      else:
+        errors = series._ApplyTransactions(transactions)
+      results.append((
+          [e and e.patch for e in errors],
+          sorted((k, v.patch) for k, v in series.failed_tot.iteritems()),
+          [x in series._committed_cache for x in patches]))
+
+    self.assertEqual(results[0], results[1])
+    self.assertEqual(results[1][0], [None, a2, b1, None, None])
+    self.assertEqual(results[1][2], [True, False, False, True, True])
+
+  def testApplyTransactionsInParallelState(self):
+    """Verify what the changes pick up in the children comes back."""
+    patches = [self.GetPatches(1, project='a'), self.GetPatches(1, project='b')]
+    transactions = [(x, [x]) for x in patches]
+
+    def _ApplyChanges(_inducing_change, changes, dryrun=False):
+      # pylint: disable=W0613
+      for change in changes:
+        change.commit_message = 'applied %s' % change.project
+
+    series = self.GetPatchSeries()
+    series.manifest = MockManifest(self.build_root)
+    series._ApplyChanges = _ApplyChanges
+    self.assertEqual(series._ApplyTransactionsInParallel(transactions),
+                     [None, None])
+    self.assertEqual([x.commit_message for x in patches],
+                     ['applied a', 'applied b'])
+
+  def testApplyTransactionsInParallelUnexpected(self):
+    """Verify unexpected exceptions in the children are raised as is."""
+    patches = [self.GetPatches(1, project='a'), self.GetPatches(1, project='b')]
+    transactions = [(x, [x]) for x in patches]
+
+    def _ApplyChanges(_inducing_change, changes, dryrun=False):
+      # pylint: disable=W0613
+      raise ValueError(changes[0].project)
+
+    series = self.GetPatchSeries()
+    series.manifest = MockManifest(self.build_root)
+    series._ApplyChanges = _ApplyChanges
+    try:
+      series._ApplyTransactionsInParallel(transactions)
+    except ValueError, e:
+      self.assertEqual(str(e), 'a')
+    else:
+      self.fail('ValueError was not raised')
+
+
+def _Tracebacks(tb):
+  """Returns the chain of traceback objects starting at |tb|."""
+  tbs = []
+  while tb is not None:
+    tbs.append(tb)
+    tb = tb.tb_next
+  return tbs
+
+
+# pylint: disable=R0904
+class TestHelperPool(base):
+  """Tests for querying all the helpers of a HelperPool at once."""
+
+  def testQuery(self):
+    """Verify results and errors are split up per remote."""
+    helper_pool = self.MakeHelper(cros_internal=True, cros=True)
+    external = helper_pool.GetHelper(constants.EXTERNAL_REMOTE)
+    internal = helper_pool.GetHelper(constants.INTERNAL_REMOTE)
+    error = (gerrit.GerritException, gerrit.GerritException('bad query'),
+             None)
+    self.mox.StubOutWithMock(gerrit, 'RunQueries')
+    gerrit.RunQueries(
+        [(external, 'foo', {'raw': True})], max_parallel=None).AndReturn(
+            [(['results'], None)])
+    gerrit.RunQueries(
+        mox.SameElementsAs([(external, 'foo', {}), (internal, 'foo', {})]),
+        max_parallel=2).AndReturn([(None, error), (None, error)])
+    self.mox.ReplayAll()
+    self.assertEqual(
+        helper_pool.Query({constants.EXTERNAL_REMOTE: 'foo'}, raw=True),
+        ({constants.EXTERNAL_REMOTE: ['results']}, {}))
+    self.assertEqual(
+        helper_pool.Query('foo', max_parallel=2),
+        ({}, {constants.EXTERNAL_REMOTE: error,
+              constants.INTERNAL_REMOTE: error}))
+    self.mox.VerifyAll()
+
+  def testAcquirePoolErrors(self):
+    """Verify a failed query is raised as is, the same one every time."""
+    errors = {}
+    for remote in (constants.INTERNAL_REMOTE, constants.EXTERNAL_REMOTE):
+      try:
+        raise gerrit.GerritException(remote)
+      except gerrit.GerritException:
+        errors[remote] = sys.exc_info()
+    self.mox.StubOutWithMock(validation_pool.HelperPool, 'Query')
+    validation_pool.HelperPool.Query(
+        mox.IgnoreArg(), sort='lastUpdated', incremental=True).AndReturn(
+            ({}, errors))
+    self.mox.ReplayAll()
+    try:
+      validation_pool.ValidationPool.AcquirePool(
+          constants.BOTH_OVERLAYS, self.build_root, 1, 'foon', dryrun=True)
+    except gerrit.GerritException:
+      exc, tb = sys.exc_info()[1:]
+    else:
+      self.fail('GerritException was not raised')
+    self.assertEqual(str(exc), min(errors))
+    self.assertTrue(errors[min(errors)][2] in _Tracebacks(tb))
+    self.mox.VerifyAll()
+
 
 # pylint: disable=W0212,R0904
 class TestCoreLogic(base):
@@ -551,7 +722,7 @@ class TestCoreLogic(base):
     inflight = [self.MakeFailure(x, inflight=True) for x in inflight]
     # pylint: disable=E1123
     pool._patch_series.Apply(
-        changes, dryrun=dryrun, manifest=mox.IgnoreArg()
+        changes, dryrun=dryrun, manifest=mox.IgnoreArg(), parallel_apply=True
         ).AndReturn((applied, tot, inflight))
 
     for patch in applied:
@@ -754,8 +925,8 @@ class TestCoreLogic(base):
     self.mox.StubOutWithMock(pool._patch_series, 'Apply')
     # pylint: disable=E1123
     pool._patch_series.Apply(
-        patches, dryrun=False, manifest=mox.IgnoreArg()).AndRaise(
-        MyException)
+        patches, dryrun=False, manifest=mox.IgnoreArg(),
+        parallel_apply=True).AndRaise(MyException)
 
     def _ValidateExceptioN(changes):
       for patch in changes:
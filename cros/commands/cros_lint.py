@@ -14,30 +14,43 @@ from chromite.lib import git
 from chromite import cros
 
 
-def _GetProjectPath(path, absolute):
-  """Get the project path for a given project."""
-  manifest = git.ManifestCheckout.Cached(path)
-  project = manifest.FindProjectFromPath(path)
-  if project is not None:
-    return manifest.GetProjectPath(project, absolute=absolute)
+def _GetProjectPaths(paths, absolute):
+  """Get the project paths for the given paths, as a dict."""
+  # Look up the paths of each checkout in its own manifest.
+  roots = {}
+  groups = {}
+  for path in paths:
+    parent = os.path.dirname(path)
+    if parent not in roots:
+      roots[parent] = git.FindRepoCheckoutRoot(parent)
+    groups.setdefault(roots[parent], []).append(path)
+
+  project_paths = {}
+  for group in groups.itervalues():
+    manifest = git.ManifestCheckout.Cached(group[0])
+    for path, project in manifest.FindProjectsFromPaths(group).iteritems():
+      if project is not None:
+        project = manifest.GetProjectPath(project, absolute=absolute)
+      project_paths[path] = project
+  return project_paths
 
 
 def _GetPylintGroups(paths):
   """Return a dictionary mapping pylintrc files to lists of paths."""
   groups = {}
+  paths = [os.path.realpath(x) for x in paths if x.endswith('.py')]
+  project_paths = _GetProjectPaths(paths, absolute=True)
   for path in paths:
-    if path.endswith('.py'):
-      path = os.path.realpath(path)
-      project_path = _GetProjectPath(path, absolute=True)
-      parent = os.path.dirname(path)
-      while project_path and parent.startswith(project_path):
-        pylintrc = os.path.join(parent, 'pylintrc')
-        if os.path.isfile(pylintrc):
-          break
-        parent = os.path.dirname(parent)
-      if project_path is None or not os.path.isfile(pylintrc):
-        pylintrc = os.path.join(constants.SOURCE_ROOT, 'chromite', 'pylintrc')
-      groups.setdefault(pylintrc, []).append(path)
+    project_path = project_paths[path]
+    parent = os.path.dirname(path)
+    while project_path and parent.startswith(project_path):
+      pylintrc = os.path.join(parent, 'pylintrc')
+      if os.path.isfile(pylintrc):
+        break
+      parent = os.path.dirname(parent)
+    if project_path is None or not os.path.isfile(pylintrc):
+      pylintrc = os.path.join(constants.SOURCE_ROOT, 'chromite', 'pylintrc')
+    groups.setdefault(pylintrc, []).append(path)
   return groups
 
 
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+
+# Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""This module tests the cros lint command."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath('%s/../../..' % os.path.dirname(__file__)))
+from chromite.cros.commands import cros_lint
+from chromite.lib import cros_test_lib
+from chromite.lib import git
+
+# pylint: disable=W0212
+
+
+class FakeManifest(object):
+  """A manifest with one project at the root of the checkout."""
+
+  def __init__(self, root):
+    self.root = root
+
+  def FindProjectsFromPaths(self, paths):
+    return dict((x, 'project') for x in paths)
+
+  def GetProjectPath(self, _project, absolute=False):
+    return self.root if absolute else '.'
+
+
+class GetProjectPathsTest(cros_test_lib.MockTestCase):
+  """Tests for looking up the projects of the paths to lint."""
+
+  def _Cached(self, path):
+    return FakeManifest(os.path.dirname(os.path.dirname(path)))
+
+  def testCheckouts(self):
+    """Verify paths are looked up in the manifest of their own checkout."""
+    self.PatchObject(git, 'FindRepoCheckoutRoot', side_effect=os.path.dirname)
+    cached = self.PatchObject(git.ManifestCheckout, 'Cached',
+                              side_effect=self._Cached)
+    paths = ['/a/x/1.py', '/a/x/2.py', '/b/y/3.py']
+    self.assertEqual(cros_lint._GetProjectPaths(paths, absolute=True),
+                     {'/a/x/1.py': '/a', '/a/x/2.py': '/a', '/b/y/3.py': '/b'})
+    self.assertEqual(cached.call_count, 2)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -0,0 +1,517 @@
+# Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Long lived helper for running commands inside the chroot.
+
+Every RunCommand(..., enter_chroot=True) normally goes through cros_sdk, which
+pays for sudo, the mount checks and the environment setup on each call.  A
+ChrootServer instead enters the chroot once, and leaves a server running in
+there that accepts commands over a unix socket.  While it is running,
+RunCommand routes enter_chroot calls through this module's client mode, which
+takes the same [VAR=value ...] -- cmd arguments as cros_sdk, relays
+stdin/stdout/stderr and the exit code, and falls back to cros_sdk if the
+server cannot be reached.
+
+The protocol is a single JSON request line from the client, followed by
+frames of (type, length, payload) in both directions; see _WriteFrame.
+
+Note this module is also executed directly, both inside the chroot (server)
+and as the per-command client; keep its import footprint small.
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+# TODO(build): Fix this.
+# This should be absolute import, but that requires fixing all
+# relative imports first.
+_path = os.path.realpath(__file__)
+_path = os.path.normpath(os.path.join(os.path.dirname(_path), '..', '..'))
+sys.path.insert(0, _path)
+from chromite.buildbot import constants
+# Now restore it so that relative scripts don't get cranky.
+sys.path.pop(0)
+del _path
+
+
+# Frame types sent by the client.
+_STDIN = 'i'
+_STDIN_EOF = 'I'
+# Frame types sent by the server.
+_STDOUT = 'o'
+_STDERR = 'e'
+_EXIT = 'x'
+
+_HEADER = struct.Struct('!cI')
+_BUFSIZE = 65536
+
+# How long the server gives a command to exit after SIGTERM when its client
+# goes away, before it resorts to SIGKILL.
+_KILL_TIMEOUT = 5
+
+
+class ChrootServerError(Exception):
+  """Raised when the chroot server cannot be started."""
+
+
+def GetSocketPath(chroot):
+  """Returns the path (outside the chroot) of |chroot|'s server socket."""
+  return os.path.join(chroot, constants.CHROOT_SERVER_SOCKET)
+
+
+def _WriteFrame(sock, kind, payload=''):
+  """Send one frame: a 1 byte type, 4 byte length, then the payload."""
+  sock.sendall(_HEADER.pack(kind, len(payload)) + payload)
+
+
+class _FrameReader(object):
+  """Incrementally decodes the request line and frames from a socket."""
+
+  def __init__(self, sock):
+    self._sock = sock
+    self._buf = ''
+
+  def ReadRequest(self):
+    """Block until the JSON request line arrives, and return it (or None)."""
+    while '\n' not in self._buf:
+      data = self._sock.recv(_BUFSIZE)
+      if not data:
+        return None
+      self._buf += data
+    line, self._buf = self._buf.split('\n', 1)
+    return json.loads(line)
+
+  def Read(self):
+    """Read what's available and return the complete frames received.
+
+    Returns:
+      A list of (type, payload) tuples, or None if the peer hung up.
+    """
+    data = self._sock.recv(_BUFSIZE)
+    if not data:
+      return None
+    self._buf += data
+    return self.Pending()
+
+  def Pending(self):
+    """Return the complete frames already buffered."""
+    frames = []
+    while len(self._buf) >= _HEADER.size:
+      kind, length = _HEADER.unpack(self._buf[:_HEADER.size])
+      end = _HEADER.size + length
+      if len(self._buf) < end:
+        break
+      frames.append((kind, self._buf[_HEADER.size:end]))
+      self._buf = self._buf[end:]
+    return frames
+
+
+def _SetNonBlocking(fd):
+  """Make writes to |fd| return EAGAIN rather than block."""
+  fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+def _Write(fd, data):
+  """Write all of |data| to |fd|."""
+  while data:
+    data = data[os.write(fd, data):]
+
+
+def _HandleCommand(conn, reader, request, source_root):
+  """Run the command a client asked for, relaying its io.  Runs in a fork."""
+  env = os.environ.copy()
+  env.update(request.get('env', {}))
+  cwd = None
+  if request.get('cwd') is not None:
+    cwd = os.path.join(source_root, request['cwd'])
+    if not os.path.isdir(cwd):
+      cwd = None
+
+  try:
+    proc = subprocess.Popen(request['argv'], cwd=cwd, env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, close_fds=True,
+                            preexec_fn=os.setsid)
+  except OSError as e:
+    _WriteFrame(conn, _STDERR, '%s: %s\n' % (request['argv'][0], e))
+    # Mirror what a shell reports for missing/unexecutable programs.
+    _WriteFrame(conn, _EXIT, '127' if e.errno == errno.ENOENT else '126')
+    return
+
+  # Input is queued and written as the command accepts it, so that a command
+  # blocked writing output never stops us from relaying it.
+  stdin_fd = proc.stdin.fileno()
+  _SetNonBlocking(stdin_fd)
+  pending_input = []
+  input_eof = [False]
+
+  def _QueueInput(frames):
+    for kind, payload in frames:
+      if kind == _STDIN:
+        pending_input.append(payload)
+      elif kind == _STDIN_EOF:
+        input_eof[0] = True
+
+  outputs = {proc.stdout.fileno(): _STDOUT, proc.stderr.fileno(): _STDERR}
+  poller = select.poll()
+  poller.register(conn, select.POLLIN)
+  for fd in outputs:
+    poller.register(fd, select.POLLIN)
+  # Registered with an empty mask until there is input for it, so that it can
+  # always be unregistered once the input is done.
+  poller.register(stdin_fd, 0)
+
+  _QueueInput(reader.Pending())
+  client_alive = True
+  while outputs and client_alive:
+    if stdin_fd is not None:
+      if pending_input:
+        poller.register(stdin_fd, select.POLLOUT)
+      elif input_eof[0]:
+        poller.unregister(stdin_fd)
+        proc.stdin.close()
+        stdin_fd = None
+      else:
+        poller.register(stdin_fd, 0)
+
+    try:
+      events = poller.poll()
+    except select.error as e:
+      if e.args[0] == errno.EINTR:
+        continue
+      raise
+
+    for fd, _event in events:
+      if fd == stdin_fd:
+        if not pending_input:
+          # With nothing to write, we're only told of errors; the command
+          # has closed its input, so stop offering it any.
+          input_eof[0] = True
+          continue
+        try:
+          written = os.write(fd, pending_input[0])
+          pending_input[0] = pending_input[0][written:]
+          if not pending_input[0]:
+            pending_input.pop(0)
+        except EnvironmentError as e:
+          if e.errno == errno.EAGAIN:
+            continue
+          elif e.errno != errno.EPIPE:
+            raise
+          # Like communicate(), ignore the command not reading its input.
+          del pending_input[:]
+          input_eof[0] = True
+        continue
+      elif fd in outputs:
+        data = os.read(fd, _BUFSIZE)
+        if data:
+          _WriteFrame(conn, outputs[fd], data)
+        else:
+          poller.unregister(fd)
+          del outputs[fd]
+        continue
+
+      frames = reader.Read()
+      if frames is None:
+        client_alive = False
+        break
+      _QueueInput(frames)
+
+  if not client_alive:
+    # Our client was killed; take the command (and its children) with it,
+    # just as RunCommand would when interrupted.
+    os.killpg(proc.pid, signal.SIGTERM)
+    deadline = time.time() + _KILL_TIMEOUT
+    while proc.poll() is None and time.time() < deadline:
+      time.sleep(0.1)
+    if proc.poll() is None:
+      os.killpg(proc.pid, signal.SIGKILL)
+    proc.wait()
+    return
+
+  _WriteFrame(conn, _EXIT, str(proc.wait()))
+
+
+def Serve(socket_path, source_root):
+  """Accept and run commands until asked to shut down.  Runs in the chroot.
+
+  Args:
+    socket_path: Where to listen.
+    source_root: The root of the source checkout; relative cwds sent by
+      clients are interpreted against it.
+  """
+  try:
+    os.unlink(socket_path)
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
+
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  old_umask = os.umask(0177)
+  try:
+    server.bind(socket_path)
+  finally:
+    os.umask(old_umask)
+  server.listen(64)
+
+  # Each connection is handled in its own fork, so that a client that is slow
+  # to send its request never holds up the others.  A fork that is asked to
+  # shut down the server tells us so over this pipe.
+  shutdown_r, shutdown_w = os.pipe()
+
+  # Let the kernel reap the forks.
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+  try:
+    while True:
+      try:
+        readable, _, _ = select.select([server, shutdown_r], [], [])
+        if shutdown_r in readable:
+          break
+        conn, _ = server.accept()
+      except (select.error, socket.error) as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+
+      if os.fork() == 0:
+        server.close()
+        os.close(shutdown_r)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        request = None
+        try:
+          reader = _FrameReader(conn)
+          request = reader.ReadRequest()
+          if request is not None and request.get('shutdown'):
+            os.write(shutdown_w, 'x')
+          elif request is not None:
+            _HandleCommand(conn, reader, request, source_root)
+        except Exception:
+          logging.exception('chroot server: failed handling %r', request)
+        finally:
+          # pylint: disable=W0212
+          os._exit(0)
+      conn.close()
+  finally:
+    server.close()
+    os.close(shutdown_r)
+    os.close(shutdown_w)
+    try:
+      os.unlink(socket_path)
+    except OSError:
+      pass
+
+
+def _Fallback(env_args, argv):
+  """Run the command via cros_sdk, as if the server never existed."""
+  cmd = ['cros_sdk'] + env_args + ['--'] + argv
+  os.execvp(cmd[0], cmd)
+
+
+def RunClient(chroot, args):
+  """Run a command through |chroot|'s server, returning its exit code.
+
+  Args:
+    chroot: The chroot (outside path) the server is running in.
+    args: Arguments in the same form cros_sdk takes: [VAR=val ...] -- cmd.
+  """
+  split = args.index('--')
+  env_args, argv = args[:split], args[split + 1:]
+  env = dict(x.split('=', 1) for x in env_args)
+  for key in constants.CHROOT_ENVIRONMENT_WHITELIST:
+    if key not in env and key in os.environ:
+      env[key] = os.environ[key]
+
+  # The server translates our cwd to the same place in its source root.
+  source_root = os.path.dirname(os.path.abspath(chroot))
+  cwd = os.path.relpath(os.getcwd(), source_root)
+  if cwd.startswith(os.pardir):
+    cwd = None
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(GetSocketPath(chroot))
+  except socket.error:
+    _Fallback(env_args, argv)
+  sock.sendall(json.dumps({'argv': argv, 'env': env, 'cwd': cwd}) + '\n')
+
+  # A terminal isn't ours to read from; the command gets no input then.
+  stdin_fd = None if os.isatty(0) else 0
+  outgoing = ''
+  if stdin_fd is None:
+    outgoing = _HEADER.pack(_STDIN_EOF, 0)
+
+  # Never block sending input, else we could stop draining the output the
+  # server is blocked sending us.
+  sock.setblocking(0)
+  reader = _FrameReader(sock)
+  outputs = {_STDOUT: sys.stdout.fileno(), _STDERR: sys.stderr.fileno()}
+  while True:
+    rlist = [sock]
+    if stdin_fd is not None and len(outgoing) < _BUFSIZE:
+      rlist.append(stdin_fd)
+    wlist = [sock] if outgoing else []
+    try:
+      readable, writable, _ = select.select(rlist, wlist, [])
+    except select.error as e:
+      if e.args[0] == errno.EINTR:
+        continue
+      raise
+
+    if stdin_fd in readable:
+      data = os.read(stdin_fd, _BUFSIZE)
+      if data:
+        outgoing += _HEADER.pack(_STDIN, len(data)) + data
+      else:
+        outgoing += _HEADER.pack(_STDIN_EOF, 0)
+        stdin_fd = None
+
+    if writable:
+      try:
+        outgoing = outgoing[sock.send(outgoing):]
+      except socket.error as e:
+        if e.args[0] not in (errno.EAGAIN, errno.EPIPE):
+          raise
+
+    if sock in readable:
+      frames = reader.Read()
+      if frames is None:
+        sys.stderr.write('chroot server went away while running %r\n' % argv)
+        return 1
+      for kind, payload in frames:
+        if kind == _EXIT:
+          returncode = int(payload)
+          # Report signal deaths the way a shell (and so cros_sdk) would.
+          return 128 - returncode if returncode < 0 else returncode
+        _Write(outputs[kind], payload)
+
+
+def RequestShutdown(chroot):
+  """Ask |chroot|'s server to exit."""
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(GetSocketPath(chroot))
+    sock.sendall(json.dumps({'shutdown': True}) + '\n')
+  finally:
+    sock.close()
+
+
+class ChrootServer(object):
+  """Run a chroot server for the lifetime of this object's context.
+
+  While active, RunCommand(..., enter_chroot=True) calls without chroot_args
+  whose cwd is within this chroot's source checkout go through the server.
+
+  Example:
+    with ChrootServer(os.path.join(buildroot, 'chroot')):
+      cros_build_lib.RunCommand(['./build_packages'], enter_chroot=True, ...)
+  """
+
+  # How long to wait for the server to come up.
+  STARTUP_TIMEOUT = 120
+
+  def __init__(self, chroot):
+    self.chroot = os.path.abspath(chroot)
+    self.source_root = os.path.dirname(self.chroot)
+    self._proc = None
+    self._old_env = None
+
+  def _InsidePath(self, path):
+    """Return where |path| in the source checkout is seen inside the chroot."""
+    rel = os.path.relpath(os.path.realpath(path), self.source_root)
+    if rel.startswith(os.pardir):
+      raise ChrootServerError('%s is not visible inside %s'
+                              % (path, self.chroot))
+    return os.path.join('/home', os.environ['USER'], 'trunk', rel)
+
+  def Start(self):
+    """Enter the chroot, start the server, and route RunCommand through it."""
+    socket_path = GetSocketPath(self.chroot)
+    inside_socket = '/' + constants.CHROOT_SERVER_SOCKET
+    cmd = ['cros_sdk', '--chroot', self.chroot, '--',
+           'python', self._InsidePath(os.path.abspath(__file__)),
+           '--serve', inside_socket, '--source-root',
+           self._InsidePath(self.source_root)]
+    # This outlives any single RunCommand, thus Popen rather than RunCommand.
+    self._proc = subprocess.Popen(cmd, cwd=self.source_root, close_fds=True)
+
+    deadline = time.time() + self.STARTUP_TIMEOUT
+    while not self._Connectable(socket_path):
+      if self._proc.poll() is not None:
+        raise ChrootServerError('chroot server exited with %i during startup'
+                                % self._proc.returncode)
+      if time.time() > deadline:
+        self.Stop()
+        raise ChrootServerError('chroot server failed to start in %is'
+                                % self.STARTUP_TIMEOUT)
+      time.sleep(0.5)
+
+    self._old_env = os.environ.get(constants.CHROOT_SERVER_ENVVAR)
+    os.environ[constants.CHROOT_SERVER_ENVVAR] = self.chroot
+
+  @staticmethod
+  def _Connectable(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(socket_path)
+      return True
+    except socket.error:
+      return False
+    finally:
+      sock.close()
+
+  def Stop(self):
+    """Stop routing through the server, and shut it down."""
+    if self._old_env is None:
+      os.environ.pop(constants.CHROOT_SERVER_ENVVAR, None)
+    else:
+      os.environ[constants.CHROOT_SERVER_ENVVAR] = self._old_env
+    self._old_env = None
+
+    if self._proc is None:
+      return
+    try:
+      RequestShutdown(self.chroot)
+    except EnvironmentError as e:
+      logging.warning('Failed requesting chroot server shutdown: %s', e)
+    deadline = time.time() + _KILL_TIMEOUT
+    while self._proc.poll() is None and time.time() < deadline:
+      time.sleep(0.1)
+    if self._proc.poll() is None:
+      logging.warning('chroot server did not shut down; leaving it to '
+                      'cros_sdk cleanup.')
+    self._proc = None
+
+  def __enter__(self):
+    self.Start()
+    return self
+
+  def __exit__(self, _type, _value, _traceback):
+    self.Stop()
+
+
+def main(argv):
+  if argv[:1] == ['--serve']:
+    # --serve <socket> --source-root <dir>
+    Serve(argv[1], argv[3])
+    return 0
+  elif argv[:1] == ['--chroot']:
+    # --chroot <chroot> [VAR=val ...] -- cmd
+    return RunClient(argv[1], argv[2:])
+  sys.stderr.write('usage: %s --chroot <chroot> [VAR=val ...] -- cmd\n'
+                   % sys.argv[0])
+  return 1
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
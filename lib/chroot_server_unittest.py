@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for chroot_server.py."""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from chromite.buildbot import constants
+from chromite.lib import chroot_server
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+
+# pylint: disable=W0212
+
+
+class ChrootServerTest(cros_test_lib.TempDirTestCase):
+  """Tests running commands through a server.
+
+  The server runs in a plain directory rather than a real chroot; the
+  protocol and RunCommand integration are the same either way.
+  """
+
+  def setUp(self):
+    self.chroot = os.path.join(self.tempdir, 'chroot')
+    self.scripts = os.path.join(self.tempdir, 'src', 'scripts')
+    osutils.SafeMakedirs(os.path.join(self.chroot, 'tmp'))
+    osutils.SafeMakedirs(self.scripts)
+    self.socket = chroot_server.GetSocketPath(self.chroot)
+    self.server = subprocess.Popen(
+        [sys.executable, chroot_server.__file__.replace('.pyc', '.py'),
+         '--serve', self.socket, '--source-root', self.tempdir])
+    for _ in xrange(100):
+      if chroot_server.ChrootServer._Connectable(self.socket):
+        break
+      time.sleep(0.1)
+    self.old_env = os.environ.get(constants.CHROOT_SERVER_ENVVAR)
+    os.environ[constants.CHROOT_SERVER_ENVVAR] = self.chroot
+
+  def tearDown(self):
+    if self.old_env is None:
+      os.environ.pop(constants.CHROOT_SERVER_ENVVAR)
+    else:
+      os.environ[constants.CHROOT_SERVER_ENVVAR] = self.old_env
+    chroot_server.RequestShutdown(self.chroot)
+    self.server.wait()
+    self.assertFalse(os.path.exists(self.socket))
+
+  def testRunCommand(self):
+    """Verify env, cwd, output and exit codes are relayed."""
+    result = cros_build_lib.RunCommand(
+        ['sh', '-c', 'echo $FOO; pwd; echo err >&2; exit 3'],
+        enter_chroot=True, cwd=self.scripts, extra_env={'FOO': 'bar'},
+        redirect_stdout=True, redirect_stderr=True, error_code_ok=True)
+    self.assertTrue(result.cmd[1].endswith('chroot_server.py'))
+    self.assertEqual(result.cmd[2:4], ['--chroot', self.chroot])
+    self.assertEqual(result.returncode, 3)
+    self.assertEqual(result.output, 'bar\n%s\n' % self.scripts)
+    self.assertEqual(result.error, 'err\n')
+
+  def testInput(self):
+    """Verify input is relayed to the command."""
+    data = 'x' * 200000
+    result = cros_build_lib.RunCommand(
+        ['cat'], enter_chroot=True, cwd=self.scripts, input=data,
+        redirect_stdout=True)
+    self.assertEqual(result.output, data)
+
+  def testMissingCommand(self):
+    """Verify commands that can't be run fail like they would in a shell."""
+    result = cros_build_lib.RunCommand(
+        ['/does/not/exist'], enter_chroot=True, cwd=self.scripts,
+        redirect_stderr=True, error_code_ok=True)
+    self.assertEqual(result.returncode, 127)
+
+  def testBuildroot(self):
+    """Verify commands run from the root of the checkout use the server."""
+    cmd, _ = cros_build_lib._PrepareCommand(
+        ['ls'], False, True, None, None, None, self.tempdir)
+    self.assertEqual(cmd[0], sys.executable)
+
+  def testStalledClient(self):
+    """Verify a client that never sends its request doesn't block others."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self.socket)
+      result = cros_build_lib.RunCommand(
+          ['echo', 'ok'], enter_chroot=True, cwd=self.scripts,
+          redirect_stdout=True)
+      self.assertEqual(result.output, 'ok\n')
+    finally:
+      sock.close()
+
+  def testInputClosedEarly(self):
+    """Verify a command closing its input while none is queued is fine."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self.socket)
+      # No input (nor its end) is sent, so the server is still waiting for
+      # some when the command closes its stdin.
+      sock.sendall(json.dumps({
+          'argv': ['sh', '-c', 'exec 0<&-; sleep 0.2; echo done'],
+          'cwd': None}) + '\n')
+      reader = chroot_server._FrameReader(sock)
+      frames = []
+      while not frames or frames[-1][0] != chroot_server._EXIT:
+        received = reader.Read()
+        self.assertTrue(received is not None, 'Server went away')
+        frames.extend(received)
+    finally:
+      sock.close()
+    self.assertEqual(frames, [(chroot_server._STDOUT, 'done\n'),
+                              (chroot_server._EXIT, '0')])
+
+  def testNotUsed(self):
+    """Verify cros_sdk is still used when the server doesn't apply."""
+    for kwargs in (dict(chroot_args=['--chrome_root', '/foo']),
+                   dict(cwd='/')):
+      cmd, _ = cros_build_lib._PrepareCommand(
+          ['ls'], False, True, kwargs.get('chroot_args'), None, None,
+          kwargs.get('cwd', self.scripts))
+      self.assertEqual(cmd[0], 'cros_sdk')
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -4,6 +4,7 @@
 
 """Common python commands used by various build scripts."""
 
+import collections
 import contextlib
 from datetime import datetime
 from email.utils import formatdate
@@ -11,8 +12,11 @@ import errno
 import functools
 import json
 import logging
+import multiprocessing
 import os
+import pipes
 import re
+import select
 import signal
 import socket
 import subprocess
@@ -35,6 +39,10 @@ del _path
 
 STRICT_SUDO = False
 
+# How much captured output RunCommand holds in memory per stream when reading
+# from pipes before spilling the rest to a temporary file.
+DEFAULT_CAPTURE_MEMORY_LIMIT = 16 * 1024 * 1024
+
 
 logger = logging.getLogger('chromite')
 
@@ -217,6 +225,9 @@ class _Popen(subprocess.Popen):
   has knowingly been waitpid'd already.
   """
 
+  # The resource usage of the child; only collected by _StatsPopen.
+  rusage = None
+
   def send_signal(self, signum):
     if self.returncode is not None:
       # The original implementation in Popen would allow signaling whatever
@@ -251,6 +262,349 @@ class _Popen(subprocess.Popen):
         raise
 
 
+class _StatsPopen(_Popen):
+  """_Popen that reaps the child via wait4 rather than waitpid.
+
+  This makes the resource usage of the child available afterwards as the
+  rusage attribute.  It is only used while command stats are recorded.
+  """
+
+  def _Reap(self, flags, _wait4=os.wait4, _EINTR=errno.EINTR,
+            _ECHILD=errno.ECHILD):
+    """Reap the child via wait4, recording its rusage.  Returns True if reaped.
+
+    Errors are handled the same as the stock Popen does.  Like the stock
+    implementation, this can be reached from __del__ during interpreter
+    shutdown, thus what we need from other modules is bound as defaults.
+    """
+    try:
+      pid, sts, rusage = _wait4(self.pid, flags)
+    except OSError as e:
+      if e.errno == _EINTR:
+        return False
+      if e.errno != _ECHILD:
+        raise
+      # This happens if SIGCLD is set to be ignored or waiting for child
+      # processes has otherwise been disabled for our process.  This child
+      # is dead, we can't get the status.
+      pid, sts, rusage = self.pid, 0, None
+    if pid != self.pid:
+      return False
+    self.rusage = rusage
+    self._handle_exitstatus(sts)
+    return True
+
+  # pylint: disable=W0221
+  def _internal_poll(self, _deadstate=None, _WNOHANG=os.WNOHANG):
+    if self.returncode is None:
+      try:
+        self._Reap(_WNOHANG)
+      except EnvironmentError:
+        # Same as the stock Popen; notably, __del__ passes a _deadstate.
+        if _deadstate is not None:
+          self.returncode = _deadstate
+    return self.returncode
+
+  def wait(self):
+    while self.returncode is None:
+      self._Reap(0)
+    return self.returncode
+
+
+def _GetPopen():
+  """Returns the Popen class RunCommand should use."""
+  if os.environ.get(constants.RUNCOMMAND_STATS_ENVVAR):
+    return _StatsPopen
+  return _Popen
+
+
+def _ChrootServerWrapper(cwd):
+  """Returns the wrapper to run a command via the chroot server, if possible.
+
+  See lib/chroot_server.py.  The server is only used if it is running for the
+  checkout |cwd| is in.
+
+  This is internal to RunCommand.  No other code should use this.
+  """
+  chroot = os.environ.get(constants.CHROOT_SERVER_ENVVAR)
+  if not chroot:
+    return None
+  source_root = os.path.dirname(chroot)
+  cwd = os.path.abspath(cwd or os.getcwd())
+  if cwd != source_root and not cwd.startswith(source_root + os.sep):
+    return None
+  if not os.path.exists(os.path.join(chroot, constants.CHROOT_SERVER_SOCKET)):
+    return None
+  client = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        'chroot_server.py')
+  return [sys.executable, client, '--chroot', chroot]
+
+
+def _PrepareCommand(cmd, shell, enter_chroot, chroot_args, env, extra_env,
+                    cwd):
+  """Returns the (argv, environment) pair RunCommand should execute.
+
+  This is internal to RunCommand.  No other code should use this.
+
+  See RunCommand for the meaning of the arguments.
+  """
+  if isinstance(cmd, basestring):
+    if not shell:
+      raise Exception('Cannot run a string command without a shell')
+    cmd = ['/bin/bash', '-c', cmd]
+  elif shell:
+    raise Exception('Cannot run an array command with a shell')
+
+  # If we are using enter_chroot we need to use enterchroot pass env through
+  # to the final command.
+  env = env.copy() if env is not None else os.environ.copy()
+  if enter_chroot:
+    wrapper = None if chroot_args else _ChrootServerWrapper(cwd)
+    if wrapper is None:
+      wrapper = ['cros_sdk']
+
+    if chroot_args:
+      wrapper += chroot_args
+
+    if extra_env:
+      wrapper.extend('%s=%s' % (k, v) for k, v in extra_env.iteritems())
+
+    cmd = wrapper + ['--'] + cmd
+
+  elif extra_env:
+    env.update(extra_env)
+
+  for var in constants.ENV_PASSTHRU:
+    if var not in env and var in os.environ:
+      env[var] = os.environ[var]
+
+  return cmd, env
+
+
+def _LogCommand(cmd, cwd, debug_level):
+  """Log |cmd| in a form that can be copy/pasted into a terminal."""
+  # Note we reformat the argument into a form that can be directly
+  # copy/pasted into a term- thus the map(repr, cmd) bit needs to stay.
+  if cwd:
+    logger.log(debug_level, 'RunCommand: %s in %s',
+               ' '.join(map(repr, cmd)), cwd)
+  else:
+    logger.log(debug_level, 'RunCommand: %r', ' '.join(map(repr, cmd)))
+
+
+def _FailedCommandMessage(cmd, cwd, extra_env, error_message):
+  """Returns the RunCommandError message for a command that exited non-zero."""
+  msg = 'Failed command "%r", cwd=%s, extra env=%r' % (cmd, cwd, extra_env)
+  if error_message:
+    msg += '\n%s' % error_message
+  return msg
+
+
+def _GetTempFile():
+  """Returns an unbuffered, anonymous temporary file.
+
+  This is internal to RunCommand.  No other code should use this.
+  """
+  try:
+    return tempfile.TemporaryFile(bufsize=0)
+  except EnvironmentError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    # This can occur if we were pointed at a specific location for our
+    # TMP, but that location has since been deleted.  Suppress that issue
+    # in this particular case since our usage gurantees deletion,
+    # and since this is primarily triggered during hard cgroups shutdown.
+    return tempfile.TemporaryFile(bufsize=0, dir='/tmp')
+
+
+def _GetSpoolFile(max_size):
+  """Returns a file that holds up to |max_size| bytes in memory, then spills.
+
+  This is internal to RunCommand.  No other code should use this.
+  """
+  try:
+    return tempfile.SpooledTemporaryFile(max_size=max_size)
+  except EnvironmentError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    # See the comment in _GetTempFile for why we fallback.
+    return tempfile.SpooledTemporaryFile(max_size=max_size, dir='/tmp')
+
+
+def _CommunicateViaPipes(proc, input, memory_limit, line_callback,
+                         retain_stdout):
+  """Feed |input| to |proc| and drain its stdout/stderr pipes as data arrives.
+
+  This is internal to RunCommand.  No other code should use this.
+
+  Args:
+    proc: A _Popen instance; any of stdin/stdout/stderr may be pipes.
+    input: Data to write to the child's stdin, or None.
+    memory_limit: How many bytes of each stream to hold in memory before
+      spilling the rest to a temporary file.
+    line_callback: If set, a functor invoked with each line of stdout
+      (trailing newline stripped) as soon as that line is complete.
+    retain_stdout: Whether stdout should be returned; if False, stdout is
+      only handed to |line_callback| and never accumulated.
+
+  Returns:
+    A tuple of (stdout, stderr) data; an element is None if that stream was
+    not captured.
+  """
+  poller = select.poll()
+  spools = {}
+  readers = {}
+  for name, pipe in (('stdout', proc.stdout), ('stderr', proc.stderr)):
+    if pipe is None:
+      continue
+    if name == 'stderr' or retain_stdout:
+      spools[name] = _GetSpoolFile(memory_limit)
+    readers[pipe.fileno()] = (name, pipe)
+    poller.register(pipe, select.POLLIN | select.POLLPRI)
+
+  stdin_fd, input_offset = None, 0
+  if proc.stdin is not None:
+    if input:
+      stdin_fd = proc.stdin.fileno()
+      poller.register(stdin_fd, select.POLLOUT)
+    else:
+      proc.stdin.close()
+
+  pending_line = ''
+  try:
+    while readers or stdin_fd is not None:
+      try:
+        events = poller.poll()
+      except select.error as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+
+      for fd, _event in events:
+        if fd == stdin_fd:
+          # POLLOUT guarantees at least PIPE_BUF bytes can be written without
+          # blocking.
+          chunk = input[input_offset:input_offset + select.PIPE_BUF]
+          try:
+            input_offset += os.write(fd, chunk)
+          except EnvironmentError as e:
+            if e.errno != errno.EPIPE:
+              raise
+            # The child stopped reading; like communicate(), ignore that.
+            input_offset = len(input)
+          if input_offset >= len(input):
+            poller.unregister(fd)
+            proc.stdin.close()
+            stdin_fd = None
+          continue
+
+        name, pipe = readers[fd]
+        data = os.read(fd, 65536)
+        if not data:
+          poller.unregister(fd)
+          pipe.close()
+          del readers[fd]
+          if name == 'stdout' and line_callback and pending_line:
+            line_callback(pending_line)
+          continue
+
+        if name in spools:
+          spools[name].write(data)
+        if name == 'stdout' and line_callback:
+          lines = (pending_line + data).split('\n')
+          pending_line = lines.pop()
+          for line in lines:
+            line_callback(line)
+
+    proc.wait()
+
+    results = dict.fromkeys(('stdout', 'stderr'))
+    for name, spool in spools.iteritems():
+      spool.seek(0)
+      results[name] = spool.read()
+    return results['stdout'], results['stderr']
+  finally:
+    for spool in spools.itervalues():
+      spool.close()
+
+
+# Wrappers that NormalizeCommand strips off; they always end with a '--'.
+_COMMAND_WRAPPERS = frozenset(['sudo', 'cros_sdk'])
+_SHA1_RE = re.compile(r'^[0-9a-f]{7,40}$')
+_NUMBER_RE = re.compile(r'^[0-9]+$')
+
+
+def NormalizeCommand(cmd):
+  """Returns |cmd| with the run-specific bits replaced by placeholders.
+
+  This is used to group similar invocations when looking at command stats:
+  sudo/cros_sdk wrappers are dropped, the program is reduced to its basename,
+  and arguments that look like sha1s, numbers or paths in the tempdir are
+  replaced with <sha1>, <n> and <tmp> respectively.  The latter also applies
+  to the values of options like ControlPath=<path>.
+  """
+  cmd = list(cmd)
+  while (cmd and os.path.basename(cmd[0]) in _COMMAND_WRAPPERS and
+         '--' in cmd):
+    cmd = cmd[cmd.index('--') + 1:]
+  if not cmd:
+    return cmd
+
+  tmpdir = tempfile.gettempdir().rstrip('/') + '/'
+  normalized = [os.path.basename(cmd[0])]
+  for arg in cmd[1:]:
+    # Numbers are checked first, as long ones also look like short sha1s.
+    if _NUMBER_RE.match(arg):
+      arg = '<n>'
+    elif _SHA1_RE.match(arg):
+      arg = '<sha1>'
+    elif arg.startswith(tmpdir):
+      arg = '<tmp>'
+    elif arg.partition('=')[2].startswith(tmpdir):
+      arg = arg.partition('=')[0] + '=<tmp>'
+    normalized.append(arg)
+  return normalized
+
+
+def _RecordCommandStats(cmd, cwd, proc, wall_time, cmd_result):
+  """Append a record of |proc|'s resource usage to the command stats log.
+
+  This is internal to RunCommand.  No other code should use this.  It is a
+  no-op unless constants.RUNCOMMAND_STATS_ENVVAR is set; the log it names is
+  a file of JSON records, one per line, which any number of processes may
+  append to concurrently.
+  """
+  path = os.environ.get(constants.RUNCOMMAND_STATS_ENVVAR)
+  if not path:
+    return
+
+  record = {
+      'time': time.time() - wall_time,
+      'pid': os.getpid(),
+      'argv0': cmd[0],
+      'argv': NormalizeCommand(cmd),
+      'cwd': os.path.abspath(cwd or os.getcwd()),
+      'wall': wall_time,
+      'returncode': proc.returncode,
+      'stdout_bytes': len(cmd_result.output or ''),
+      'stderr_bytes': len(cmd_result.error or ''),
+  }
+  rusage = proc.rusage
+  if rusage is not None:
+    record.update(utime=rusage.ru_utime, stime=rusage.ru_stime,
+                  maxrss_kb=rusage.ru_maxrss)
+
+  # A single O_APPEND write keeps lines from concurrent writers intact.
+  try:
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+    try:
+      os.write(fd, json.dumps(record) + '\n')
+    finally:
+      os.close(fd)
+  except EnvironmentError as e:
+    Warning('Failed to record command stats to %s: %s', path, e)
+
+
 #pylint: disable=W0622
 def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
                redirect_stdout=False, redirect_stderr=False,
@@ -258,7 +612,8 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
                env=None, extra_env=None, ignore_sigint=False,
                combine_stdout_stderr=False, log_stdout_to_file=None,
                chroot_args=None, debug_level=logging.INFO,
-               error_code_ok=False, kill_timeout=1, log_output=False):
+               error_code_ok=False, kill_timeout=1, log_output=False,
+               capture_memory_limit=None, line_callback=None):
   """Runs a command.
 
   Args:
@@ -272,9 +627,12 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
     redirect_stdout: returns the stdout.
     redirect_stderr: holds stderr output until input is communicated.
     cwd: the working directory to run this cmd.
-    input: input to pipe into this command through stdin.
+    input: input to pipe into this command through stdin.  If a file object or
+      descriptor, stdin is connected to it directly instead.
     enter_chroot: this command should be run from within the chroot.  If set,
-      cwd must point to the scripts directory.
+      cwd must point to the scripts directory.  If a chroot server is running
+      for that checkout (see lib/chroot_server.py) and chroot_args isn't set,
+      the command is run through it rather than via cros_sdk.
     shell: Controls whether we add a shell as a command interpreter.  See cmd
       since it has to agree as to the type.
     env: If non-None, this is the environment for the new process.  If
@@ -289,9 +647,9 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
       Ctrl-C.  If we don't do this, I think we and the child will both get
       Ctrl-C at the same time, which means we'll forcefully kill the child.
     combine_stdout_stderr: Combines stdout and stderr streams into stdout.
-    log_stdout_to_file: If set, redirects stdout to file specified by this path.
-      If combine_stdout_stderr is set to True, then stderr will also be logged
-      to the specified file.
+    log_stdout_to_file: If set, redirects stdout to file specified by this path,
+      or to this file object or descriptor.  If combine_stdout_stderr is set
+      to True, then stderr will also be logged to the specified file.
     chroot_args: An array of arguments for the chroot environment wrapper.
     debug_level: The debug level of RunCommand's output - applies to output
                  coming from subprocess as well.
@@ -302,6 +660,16 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
                   process to shutdown from a SIGTERM before we SIGKILL it.
                   Specified in seconds.
     log_output: Log the command and its output automatically.
+    capture_memory_limit: If set, captured stdout/stderr are read from pipes
+      as the command produces them (rather than from tempfiles once it exits),
+      holding up to this many bytes per stream in memory before spilling the
+      remainder to disk.
+    line_callback: If set, a functor invoked with each line of stdout (minus
+      its trailing newline) as the command produces it.  Implies reading from
+      pipes.  stdout is only accumulated into the result if it would have been
+      captured anyway (e.g. redirect_stdout is set); otherwise it is handed to
+      the callback and then discarded.  Cannot be combined with
+      log_stdout_to_file.
   Returns:
     A CommandResult object.
 
@@ -320,31 +688,32 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
   # a self-explanatory exception will be thrown.
   kill_timeout = float(kill_timeout)
 
-  def _get_tempfile():
-    try:
-      return tempfile.TemporaryFile(bufsize=0)
-    except EnvironmentError as e:
-      if e.errno != errno.ENOENT:
-        raise
-      # This can occur if we were pointed at a specific location for our
-      # TMP, but that location has since been deleted.  Suppress that issue
-      # in this particular case since our usage gurantees deletion,
-      # and since this is primarily triggered during hard cgroups shutdown.
-      return tempfile.TemporaryFile(bufsize=0, dir='/tmp')
+  use_pipes = capture_memory_limit is not None or line_callback is not None
+  if use_pipes:
+    if log_stdout_to_file and line_callback is not None:
+      raise ValueError('line_callback cannot be used with log_stdout_to_file')
+    if capture_memory_limit is None:
+      capture_memory_limit = DEFAULT_CAPTURE_MEMORY_LIMIT
+    get_capture = lambda: subprocess.PIPE
+  else:
+    get_capture = _GetTempFile
 
   # Modify defaults based on parameters.
   # Note that tempfiles must be unbuffered else attempts to read
   # what a separate process did to that file can result in a bad
   # view of the file.
-  if log_stdout_to_file:
+  retain_stdout = bool(redirect_stdout or mute_output or log_output)
+  if isinstance(log_stdout_to_file, basestring):
     stdout = open(log_stdout_to_file, 'w+')
-  elif redirect_stdout or mute_output or log_output:
-    stdout = _get_tempfile()
+  elif log_stdout_to_file is not None:
+    stdout = log_stdout_to_file
+  elif retain_stdout or line_callback is not None:
+    stdout = get_capture()
 
   if combine_stdout_stderr:
     stderr = subprocess.STDOUT
   elif redirect_stderr or mute_output or log_output:
-    stderr = _get_tempfile()
+    stderr = get_capture()
 
   # If subprocesses have direct access to stdout or stderr, they can bypass
   # our buffers, so we need to flush to ensure that output is not interleaved.
@@ -352,47 +721,19 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
     sys.stdout.flush()
     sys.stderr.flush()
 
-  if input:
-    stdin = subprocess.PIPE
-
-  if isinstance(cmd, basestring):
-    if not shell:
-      raise Exception('Cannot run a string command without a shell')
-    cmd = ['/bin/bash', '-c', cmd]
-    shell = False
-  elif shell:
-    raise Exception('Cannot run an array command with a shell')
-
-  # If we are using enter_chroot we need to use enterchroot pass env through
-  # to the final command.
-  env = env.copy() if env is not None else os.environ.copy()
-  if enter_chroot:
-    wrapper = ['cros_sdk']
-
-    if chroot_args:
-      wrapper += chroot_args
-
-    if extra_env:
-      wrapper.extend('%s=%s' % (k, v) for k, v in extra_env.iteritems())
-
-    cmd = wrapper + ['--'] + cmd
-
-  elif extra_env:
-    env.update(extra_env)
+  if isinstance(input, basestring):
+    if input:
+      stdin = subprocess.PIPE
+  elif input is not None:
+    stdin = input
+    input = None
 
-  for var in constants.ENV_PASSTHRU:
-    if var not in env and var in os.environ:
-      env[var] = os.environ[var]
+  cmd, env = _PrepareCommand(cmd, shell, enter_chroot, chroot_args, env,
+                             extra_env, cwd)
 
   # Print out the command before running.
   if print_cmd or log_output:
-    # Note we reformat the argument into a form that can be directly
-    # copy/pasted into a term- thus the map(repr, cmd) bit needs to stay.
-    if cwd:
-      logger.log(debug_level, 'RunCommand: %s in %s',
-                 ' '.join(map(repr, cmd)), cwd)
-    else:
-      logger.log(debug_level, 'RunCommand: %r', ' '.join(map(repr, cmd)))
+    _LogCommand(cmd, cwd, debug_level)
 
   cmd_result.cmd = cmd
 
@@ -401,10 +742,11 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
   # upon invocation of getsignal.  See signals.SignalModuleUsable for the
   # details and upstream python bug.
   use_signals = signals.SignalModuleUsable()
+  start_time = time.time()
   try:
-    proc = _Popen(cmd, cwd=cwd, stdin=stdin, stdout=stdout,
-                  stderr=stderr, shell=False, env=env,
-                  close_fds=True)
+    proc = _GetPopen()(cmd, cwd=cwd, stdin=stdin, stdout=stdout,
+                       stderr=stderr, shell=False, env=env,
+                       close_fds=True)
 
     if use_signals:
       if ignore_sigint:
@@ -421,21 +763,28 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
                                       cmd, old_sigterm))
 
     try:
-      (cmd_result.output, cmd_result.error) = proc.communicate(input)
+      if use_pipes:
+        (cmd_result.output, cmd_result.error) = _CommunicateViaPipes(
+            proc, input, capture_memory_limit, line_callback, retain_stdout)
+      else:
+        (cmd_result.output, cmd_result.error) = proc.communicate(input)
     finally:
       if use_signals:
         signal.signal(signal.SIGINT, old_sigint)
         signal.signal(signal.SIGTERM, old_sigterm)
 
-      if stdout and not log_stdout_to_file:
-        stdout.seek(0)
-        cmd_result.output = stdout.read()
-        stdout.close()
+      # When reading from pipes, _CommunicateViaPipes has already collected
+      # the output; there are no tempfiles to read back.
+      if not use_pipes:
+        if stdout and not log_stdout_to_file:
+          stdout.seek(0)
+          cmd_result.output = stdout.read()
+          stdout.close()
 
-      if stderr and stderr != subprocess.STDOUT:
-        stderr.seek(0)
-        cmd_result.error = stderr.read()
-        stderr.close()
+        if stderr and stderr != subprocess.STDOUT:
+          stderr.seek(0)
+          cmd_result.error = stderr.read()
+          stderr.close()
 
     cmd_result.returncode = proc.returncode
 
@@ -451,10 +800,9 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
                      "with args=%r", cmd)
 
     if not error_ok and not error_code_ok and proc.returncode:
-      msg = 'Failed command "%r", cwd=%s, extra env=%r' % (cmd, cwd, extra_env)
-      if error_message:
-        msg += '\n%s' % error_message
-      raise RunCommandError(msg, cmd_result)
+      raise RunCommandError(
+          _FailedCommandMessage(cmd, cwd, extra_env, error_message),
+          cmd_result)
   # TODO(sosa): is it possible not to use the catch-all Exception here?
   except OSError as e:
     estr = str(e)
@@ -474,6 +822,8 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
     if proc is not None:
       # Ensure the process is dead.
       _KillChildProcess(proc, kill_timeout, cmd, None, None, None)
+      _RecordCommandStats(cmd, cwd, proc, time.time() - start_time,
+                          cmd_result)
 
   return cmd_result
 
@@ -482,6 +832,300 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
 DebugRunCommand = functools.partial(RunCommand, debug_level=logging.DEBUG)
 
 
+class CommandFuture(object):
+  """A handle to a command launched by a CommandPool.
+
+  Use done() to check whether the command has finished, and result() to wait
+  for it and get its CommandResult.
+  """
+
+  def __init__(self, pool, cmd, print_cmd=True, error_message=None,
+               redirect_stdout=False, redirect_stderr=False, cwd=None,
+               input=None, enter_chroot=False, shell=False, env=None,
+               extra_env=None, combine_stdout_stderr=False,
+               log_stdout_to_file=None, chroot_args=None,
+               debug_level=logging.INFO, error_code_ok=False, kill_timeout=1,
+               log_output=False):
+    """Initialize.  See RunCommand for the meaning of the arguments."""
+    self._pool = pool
+    self.cmd, self._env = _PrepareCommand(cmd, shell, enter_chroot,
+                                          chroot_args, env, extra_env, cwd)
+    self._print_cmd = print_cmd or log_output
+    self._error_message = error_message
+    self._cwd = cwd
+    self._input = input
+    self._extra_env = extra_env
+    self._log_stdout_to_file = log_stdout_to_file
+    self._debug_level = debug_level
+    self._error_code_ok = error_code_ok
+    self._log_output = log_output
+    self.kill_timeout = float(kill_timeout)
+
+    mute_output = logger.getEffectiveLevel() > debug_level
+    self._capture_stdout = redirect_stdout or mute_output or log_output
+    self._capture_stderr = ((redirect_stderr or mute_output or log_output) and
+                            not combine_stdout_stderr)
+    self._combine_stdout_stderr = combine_stdout_stderr
+
+    self.proc = None
+    self._start_time = None
+    self._stdout = self._stderr = None
+    self._result = None
+    self._exception = None
+
+  def _Launch(self):
+    """Start the command.  Only the owning CommandPool should call this."""
+    stdin = stdout = stderr = None
+    # The files we open here, which the child keeps its own copies of.
+    opened = []
+    if isinstance(self._input, basestring):
+      if self._input:
+        # Feed input from a file rather than a pipe, so that the pool never
+        # has to block writing to any one child.
+        stdin = _GetTempFile()
+        stdin.write(self._input)
+        stdin.seek(0)
+        opened.append(stdin)
+    elif self._input is not None:
+      stdin = self._input
+    if isinstance(self._log_stdout_to_file, basestring):
+      stdout = open(self._log_stdout_to_file, 'w+')
+      opened.append(stdout)
+    elif self._log_stdout_to_file is not None:
+      stdout = self._log_stdout_to_file
+    elif self._capture_stdout:
+      stdout = self._stdout = _GetTempFile()
+    if self._combine_stdout_stderr:
+      stderr = subprocess.STDOUT
+    elif self._capture_stderr:
+      stderr = self._stderr = _GetTempFile()
+
+    if stdout is None or stderr is None:
+      sys.stdout.flush()
+      sys.stderr.flush()
+
+    if self._print_cmd:
+      _LogCommand(self.cmd, self._cwd, self._debug_level)
+
+    self._start_time = time.time()
+    try:
+      self.proc = _GetPopen()(self.cmd, cwd=self._cwd, stdin=stdin,
+                              stdout=stdout, stderr=stderr, shell=False,
+                              env=self._env, close_fds=True)
+    except OSError as e:
+      estr = str(e)
+      if e.errno == errno.EACCES:
+        estr += '; does the program need `chmod a+x`?'
+      self._exception = RunCommandError(estr, CommandResult(cmd=self.cmd),
+                                        exception=e)
+      self._CloseFiles()
+    finally:
+      for f in opened:
+        f.close()
+
+  def _Cancel(self):
+    """Mark this never-launched command as failed.  Only for CommandPool."""
+    self._exception = RunCommandError('Command was cancelled',
+                                      CommandResult(cmd=self.cmd))
+
+  def _CloseFiles(self):
+    for f in (self._stdout, self._stderr):
+      if f is not None:
+        f.close()
+    self._stdout = self._stderr = None
+
+  def _Finish(self):
+    """Collect the result of the exited command.  Only for CommandPool."""
+    result = CommandResult(cmd=self.cmd, returncode=self.proc.returncode)
+    for f, attr in ((self._stdout, 'output'), (self._stderr, 'error')):
+      if f is not None:
+        f.seek(0)
+        setattr(result, attr, f.read())
+    self._CloseFiles()
+    _RecordCommandStats(self.cmd, self._cwd, self.proc,
+                        time.time() - self._start_time, result)
+
+    if self._log_output:
+      if result.output:
+        logger.log(self._debug_level, '(stdout):\n%s' % result.output)
+      if result.error:
+        logger.log(self._debug_level, '(stderr):\n%s' % result.error)
+
+    self._result = result
+    if result.returncode and not self._error_code_ok:
+      self._exception = RunCommandError(
+          _FailedCommandMessage(self.cmd, self._cwd, self._extra_env,
+                                self._error_message),
+          result)
+
+  def running(self):
+    """Returns True if the command has been launched and hasn't exited."""
+    return self.proc is not None and not self.done()
+
+  def done(self):
+    """Returns True if the command has finished (or failed to launch)."""
+    return self._result is not None or self._exception is not None
+
+  def result(self):
+    """Wait for the command to finish, and return its CommandResult.
+
+    Raises:
+      RunCommandError if the command could not be run, or if it exited
+      non-zero and error_code_ok wasn't set.
+    """
+    self._pool.Wait(self)
+    if self._exception is not None:
+      raise self._exception
+    return self._result
+
+
+class CommandPool(object):
+  """Run many commands concurrently from this process, a bounded few at a time.
+
+  This is a lightweight alternative to parallel.RunTasksInProcessPool for the
+  common case where each task is just a command: no extra python processes
+  are forked, and each command gets RunCommand semantics (error_code_ok,
+  enter_chroot, kill_timeout, output capturing, etc).
+
+  While the pool is active, SIGINT/SIGTERM terminate all running commands
+  (escalating to SIGKILL after their kill_timeout) before being relayed to
+  the original handlers, just like RunCommand does for a single command.
+  Exiting the context waits for all commands; if the context is exiting
+  because of an exception, the remaining commands are killed instead.
+
+  Example:
+    with cros_build_lib.CommandPool(max_parallel=4) as pool:
+      futures = [pool.RunCommand(['git', 'fetch'], cwd=x) for x in projects]
+    outputs = [f.result().output for f in futures]
+  """
+
+  # How long to sleep between checks on running commands.
+  _POLL_INTERVAL = 0.05
+
+  def __init__(self, max_parallel=None):
+    """Initialize.
+
+    Args:
+      max_parallel: The maximum number of commands to run at once.  Defaults
+        to the number of cpus.
+    """
+    if max_parallel is None:
+      max_parallel = multiprocessing.cpu_count()
+    self.max_parallel = max(1, max_parallel)
+    self._pending = collections.deque()
+    self._running = []
+    self._old_handlers = None
+
+  def RunCommand(self, cmd, **kwds):
+    """Queue |cmd| to be run, and return a CommandFuture for it.
+
+    Args:
+      cmd: The command to run.
+      kwds: See RunCommand; the supported options are those of CommandFuture.
+    """
+    future = CommandFuture(self, cmd, **kwds)
+    self._pending.append(future)
+    self._Poll()
+    return future
+
+  def _Poll(self):
+    """Reap any exited commands, and launch pending ones into free slots."""
+    # pylint: disable=W0212
+    for future in self._running[:]:
+      if future.proc.poll() is not None:
+        self._running.remove(future)
+        future._Finish()
+
+    while self._pending and len(self._running) < self.max_parallel:
+      future = self._pending.popleft()
+      future._Launch()
+      if future.proc is not None:
+        self._running.append(future)
+
+  def Wait(self, future=None):
+    """Wait for |future| to finish, or for all commands if it's None."""
+    def _Finished():
+      if future is not None:
+        return future.done()
+      return not (self._pending or self._running)
+
+    self._Poll()
+    while not _Finished():
+      time.sleep(self._POLL_INTERVAL)
+      self._Poll()
+
+  def WaitAny(self, futures):
+    """Wait for at least one of |futures| to finish.
+
+    Returns:
+      The list of |futures| that are done.
+    """
+    self._Poll()
+    while futures and not any(f.done() for f in futures):
+      time.sleep(self._POLL_INTERVAL)
+      self._Poll()
+    return [f for f in futures if f.done()]
+
+  def _KillAll(self):
+    """Terminate all running commands, and discard pending ones."""
+    # pylint: disable=W0212
+    while self._pending:
+      self._pending.popleft()._Cancel()
+    running, self._running = self._running, []
+    for future in running:
+      future.proc.terminate()
+    for future in running:
+      _KillChildProcess(future.proc, future.kill_timeout, future.cmd,
+                        None, None, None)
+      future._Finish()
+
+  def _SignalHandler(self, original_handler, signum, frame):
+    """Kill our children when signaled, then relay to |original_handler|."""
+    signal.signal(signum, signal.SIG_IGN)
+    self._KillAll()
+    if not signals.RelaySignal(original_handler, signum, frame):
+      # Mock up our own, matching exit code for signaling.
+      cmd_result = CommandResult(returncode=signum << 8)
+      raise TerminateRunCommandError('Received signal %i' % signum, cmd_result)
+
+  def __enter__(self):
+    if signals.SignalModuleUsable():
+      self._old_handlers = {}
+      for signum in (signal.SIGINT, signal.SIGTERM):
+        old = self._old_handlers[signum] = signal.getsignal(signum)
+        signal.signal(signum, functools.partial(self._SignalHandler, old))
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    try:
+      if exc_type is None:
+        self.Wait()
+      else:
+        self._KillAll()
+    finally:
+      if self._old_handlers is not None:
+        for signum, handler in self._old_handlers.iteritems():
+          signal.signal(signum, handler)
+        self._old_handlers = None
+
+
+def RunCommands(cmds, max_parallel=None, **kwds):
+  """Run |cmds| concurrently, and return their CommandResults in order.
+
+  Args:
+    cmds: A list of commands to run.
+    max_parallel: See CommandPool.
+    kwds: Options applied to every command; see CommandPool.RunCommand.
+
+  Raises:
+    RunCommandError for the first command (in |cmds| order) that failed, once
+    all the commands have finished.
+  """
+  with CommandPool(max_parallel=max_parallel) as pool:
+    futures = [pool.RunCommand(cmd, **kwds) for cmd in cmds]
+  return [future.result() for future in futures]
+
+
 class DieSystemExit(SystemExit):
   """Custom Exception used so we can intercept this if necessary."""
 
@@ -806,13 +1450,42 @@ COMP_NONE = 0
 COMP_GZIP = 1
 COMP_BZIP2 = 2
 COMP_XZ = 3
+
+# Named speed/ratio tradeoffs callers can request from the compressors.
+COMP_PROFILE_FAST = 'fast'
+COMP_PROFILE_DEFAULT = 'default'
+COMP_PROFILE_BEST = 'best'
+COMP_PROFILES = (COMP_PROFILE_FAST, COMP_PROFILE_DEFAULT, COMP_PROFILE_BEST)
+
+# The arguments each profile adds to the compressor.  These are understood by
+# both the standard and parallel implementations.
+_COMPRESSION_PROFILE_ARGS = {
+    COMP_PROFILE_FAST: {
+        COMP_GZIP: ['-1'],
+        COMP_BZIP2: ['-1'],
+        COMP_XZ: ['-1'],
+    },
+    COMP_PROFILE_DEFAULT: {},
+    COMP_PROFILE_BEST: {
+        COMP_GZIP: ['-9'],
+        COMP_BZIP2: ['-9'],
+        COMP_XZ: ['-9', '-e'],
+    },
+}
+
+# At -9, each xz thread needs about 700 MiB to compress, so pixz is held to
+# this many threads for the best profile (and skips -e, which costs a lot of
+# time for little gain).
+_PIXZ_BEST_THREADS = 4
+
+
 def FindCompressor(compression, chroot=None):
   """Locate a compressor utility program (possibly in a chroot).
 
   Since we compress/decompress a lot, make it easy to locate a
   suitable utility program in a variety of locations.  We favor
-  the one in the chroot over /, and the parallel implementation
-  over the single threaded one.
+  the parallel implementations over the single threaded one, and
+  the one in the chroot over /.
 
   Arguments:
     compression: The type of compression desired.
@@ -823,14 +1496,11 @@ def FindCompressor(compression, chroot=None):
     ValueError: If compression is unknown.
   """
   if compression == COMP_GZIP:
-    std = 'gzip'
-    para = 'pigz'
+    progs = ['pigz', 'gzip']
   elif compression == COMP_BZIP2:
-    std = 'bzip2'
-    para = 'pbzip2'
+    progs = ['lbzip2', 'pbzip2', 'bzip2']
   elif compression == COMP_XZ:
-    std = 'xz'
-    para = 'xz'
+    progs = ['pixz', 'xz']
   elif compression == COMP_NONE:
     return 'cat'
   else:
@@ -841,18 +1511,41 @@ def FindCompressor(compression, chroot=None):
     roots.append(chroot)
   roots.append('/')
 
-  for prog in [para, std]:
+  for prog in progs:
     for root in roots:
       for subdir in ['', 'usr']:
         path = os.path.join(root, subdir, 'bin', prog)
         if os.path.exists(path):
           return path
 
-  return std
+  return progs[-1]
+
+
+def GetCompressorCommand(compression, chroot=None,
+                         profile=COMP_PROFILE_DEFAULT):
+  """Return the command to compress with, for the given profile.
+
+  Arguments:
+    compression: The type of compression desired.
+    chroot: See FindCompressor().
+    profile: One of COMP_PROFILES.
+  Returns:
+    A list of the compressor and its arguments.
+  Raises:
+    ValueError: If compression or profile is unknown.
+  """
+  if profile not in _COMPRESSION_PROFILE_ARGS:
+    raise ValueError('unknown compression profile %r' % (profile,))
+  prog = FindCompressor(compression, chroot=chroot)
+  if os.path.basename(prog) == 'pixz' and profile == COMP_PROFILE_BEST:
+    threads = min(multiprocessing.cpu_count(), _PIXZ_BEST_THREADS)
+    return [prog, '-9', '-p', str(threads)]
+  return [prog] + _COMPRESSION_PROFILE_ARGS[profile].get(compression, [])
 
 
 def CreateTarball(target, cwd, sudo=False, compression=COMP_XZ, chroot=None,
-                  inputs=None, extra_args=None, **kwds):
+                  inputs=None, extra_args=None, profile=COMP_PROFILE_DEFAULT,
+                  **kwds):
   """Create a tarball.  Executes 'tar' on the commandline.
 
   Arguments:
@@ -865,6 +1558,7 @@ def CreateTarball(target, cwd, sudo=False, compression=COMP_XZ, chroot=None,
     inputs: A list of files or directories to add to the tarball.  If unset,
       defaults to ".".
     extra_args: Extra args to pass to "tar".
+    profile: The speed/ratio tradeoff to compress with; one of COMP_PROFILES.
     kwds: Any RunCommand options/overrides to use.
 
   Returns:
@@ -876,8 +1570,15 @@ def CreateTarball(target, cwd, sudo=False, compression=COMP_XZ, chroot=None,
     extra_args = []
   kwds.setdefault('debug_level', logging.DEBUG)
 
-  comp = FindCompressor(compression, chroot=chroot)
-  cmd = ['tar'] + extra_args + ['-I', comp, '-cf', target] + inputs
+  comp = GetCompressorCommand(compression, chroot=chroot, profile=profile)
+  if len(comp) == 1:
+    cmd = ['tar'] + extra_args + ['-I', comp[0], '-cf', target] + inputs
+  else:
+    # Before 1.27, tar takes only a program name for -I, so the compressor
+    # needs a pipe to be given arguments.
+    script = 'set -o pipefail; tar "$@" | %s > %s' % (
+        ' '.join(pipes.quote(x) for x in comp), pipes.quote(target))
+    cmd = ['bash', '-c', script, 'tar'] + extra_args + ['-cf', '-'] + inputs
   rc_func = SudoRunCommand if sudo else RunCommand
   return rc_func(cmd, cwd=cwd, **kwds)
 
@@ -17,6 +17,7 @@ import logging
 import mox
 import signal
 import StringIO
+import tempfile
 import time
 import urllib
 import __builtin__
@@ -105,6 +106,43 @@ class TestRunCommandNoMock(cros_test_lib.TestCase):
     self.assertRaises(cros_build_lib.RunCommandError, cros_build_lib.RunCommand,
                       ['/does/not/exist'])
 
+  def testPipeCaptureSpillsToDisk(self):
+    """Verify pipe capture returns everything, even past the memory limit."""
+    cmd = 'seq 1 20000; echo oops >&2; exit 3'
+    result = cros_build_lib.RunCommand(
+        cmd, shell=True, redirect_stdout=True, redirect_stderr=True,
+        error_code_ok=True, capture_memory_limit=1024)
+    self.assertEqual(result.returncode, 3)
+    self.assertEqual(result.output,
+                     ''.join('%i\n' % i for i in xrange(1, 20001)))
+    self.assertEqual(result.error, 'oops\n')
+
+  def testPipeCaptureInput(self):
+    """Verify input is fed to the command when reading via pipes."""
+    data = 'x' * 100000 + '\ny\n'
+    result = cros_build_lib.RunCommand(
+        ['cat'], input=data, redirect_stdout=True, capture_memory_limit=0)
+    self.assertEqual(result.output, data)
+
+  def testLineCallback(self):
+    """Verify line_callback sees each stdout line as it's produced."""
+    lines = []
+    result = cros_build_lib.RunCommand(
+        'printf "a\\nbb\\n\\nccc"; echo err >&2', shell=True,
+        redirect_stderr=True, line_callback=lines.append)
+    self.assertEqual(lines, ['a', 'bb', '', 'ccc'])
+    # stdout wasn't requested, so it's only handed to the callback.
+    self.assertEqual(result.output, None)
+    self.assertEqual(result.error, 'err\n')
+
+  def testLineCallbackRedirectStdout(self):
+    """Verify line_callback and redirect_stdout can be used together."""
+    lines = []
+    result = cros_build_lib.RunCommand(
+        ['echo', 'foo'], redirect_stdout=True, line_callback=lines.append)
+    self.assertEqual(lines, ['foo'])
+    self.assertEqual(result.output, 'foo\n')
+
 
 def _ForceLoggingLevel(functor):
   def inner(*args, **kwds):
@@ -471,6 +509,114 @@ class TestRunCommandLogging(cros_test_lib.TempDirTestCase):
     self.assertEqual(osutils.ReadFile(log), 'monkeys4\nmonkeys5\n')
 
 
+class TestCommandPool(cros_test_lib.TestCase):
+  """Tests for CommandPool, using real commands."""
+
+  def testResults(self):
+    """Verify each future gets its own command's results."""
+    with cros_build_lib.CommandPool(max_parallel=2) as pool:
+      futures = [pool.RunCommand(['echo', str(i)], redirect_stdout=True)
+                 for i in xrange(5)]
+      err = pool.RunCommand('echo foo >&2; exit 2', shell=True,
+                            redirect_stderr=True, error_code_ok=True)
+      data = pool.RunCommand(['cat'], input='some input',
+                             redirect_stdout=True)
+    self.assertEqual([f.result().output for f in futures],
+                     ['%i\n' % i for i in xrange(5)])
+    self.assertEqual(err.result().returncode, 2)
+    self.assertEqual(err.result().error, 'foo\n')
+    self.assertEqual(data.result().output, 'some input')
+
+  def testPipe(self):
+    """Verify commands can be connected by descriptors."""
+    read_fd, write_fd = os.pipe()
+    with cros_build_lib.CommandPool(max_parallel=2) as pool:
+      pool.RunCommand(['echo', 'piped'], log_stdout_to_file=write_fd)
+      os.close(write_fd)
+      data = pool.RunCommand(['cat'], input=read_fd, redirect_stdout=True)
+      os.close(read_fd)
+    self.assertEqual(data.result().output, 'piped\n')
+
+  def testBoundedConcurrency(self):
+    """Verify no more than max_parallel commands run at once."""
+    with cros_build_lib.CommandPool(max_parallel=2) as pool:
+      futures = [pool.RunCommand(['sleep', '0.2']) for _ in xrange(5)]
+      while not all(f.done() for f in futures):
+        self.assertTrue(sum(f.running() for f in futures) <= 2)
+        pool.Wait(futures[-1])
+
+  def testWaitAny(self):
+    """Verify WaitAny returns as soon as one of the commands is done."""
+    with cros_build_lib.CommandPool(max_parallel=2) as pool:
+      slow = pool.RunCommand(['sleep', '60'], kill_timeout=0.1,
+                             error_code_ok=True)
+      fast = pool.RunCommand(['true'])
+      self.assertEqual(pool.WaitAny([slow, fast]), [fast])
+      self.assertEqual(pool.WaitAny([]), [])
+      slow.proc.terminate()
+
+  def testErrors(self):
+    """Verify failures are raised from result()."""
+    with cros_build_lib.CommandPool() as pool:
+      failed = pool.RunCommand(['false'])
+      missing = pool.RunCommand(['/does/not/exist'])
+    self.assertRaises(cros_build_lib.RunCommandError, failed.result)
+    self.assertRaises(cros_build_lib.RunCommandError, missing.result)
+    self.assertRaises(cros_build_lib.RunCommandError,
+                      cros_build_lib.RunCommands, [['true'], ['false']])
+
+  def testEnterChroot(self):
+    """Verify enter_chroot wraps the command like RunCommand does."""
+    pool = cros_build_lib.CommandPool()
+    future = cros_build_lib.CommandFuture(pool, ['ls'], enter_chroot=True,
+                                          extra_env={'FOO': 'bar'})
+    self.assertEqual(future.cmd, ['cros_sdk', 'FOO=bar', '--', 'ls'])
+
+  def testExceptionKillsCommands(self):
+    """Verify an exception inside the pool kills the running commands."""
+    futures = []
+    def _Run():
+      with cros_build_lib.CommandPool(max_parallel=1) as pool:
+        futures.append(pool.RunCommand(['sleep', '60'], kill_timeout=0.1,
+                                       error_code_ok=True))
+        futures.append(pool.RunCommand(['sleep', '60']))
+        raise ValueError()
+    start = time.time()
+    self.assertRaises(ValueError, _Run)
+    self.assertTrue(time.time() - start < 30)
+    self.assertEqual(futures[0].result().returncode, -signal.SIGTERM)
+    self.assertRaises(cros_build_lib.RunCommandError, futures[1].result)
+
+
+class TestNormalizeCommand(cros_test_lib.TestCase):
+  """Tests for NormalizeCommand."""
+
+  def testNormalize(self):
+    cmd = ['sudo', 'FOO=bar', '--', 'cros_sdk', '--', '/usr/bin/git',
+           'checkout', '0123456789abcdef0123', '42', 'origin']
+    self.assertEqual(cros_build_lib.NormalizeCommand(cmd),
+                     ['git', 'checkout', '<sha1>', '<n>', 'origin'])
+
+  def testLongNumbers(self):
+    """Verify build and change numbers aren't taken for sha1s."""
+    cmd = ['gerrit', 'query', '1234567', 'deadbeef']
+    self.assertEqual(cros_build_lib.NormalizeCommand(cmd),
+                     ['gerrit', 'query', '<n>', '<sha1>'])
+
+  def testNormalizeOptionPaths(self):
+    path = os.path.join(tempfile.gettempdir(), 'gerrit-ssh.1234', 'sock')
+    cmd = ['ssh', '-p', '29418', '-o', 'ControlPath=%s' % path, 'host']
+    self.assertEqual(cros_build_lib.NormalizeCommand(cmd),
+                     ['ssh', '-p', '<n>', '-o', 'ControlPath=<tmp>', 'host'])
+
+  def testStatsPopen(self):
+    """Verify wait4 is only used while command stats are recorded."""
+    os.environ.pop(constants.RUNCOMMAND_STATS_ENVVAR, None)
+    self.assertTrue(cros_build_lib._GetPopen() is cros_build_lib._Popen)
+    os.environ[constants.RUNCOMMAND_STATS_ENVVAR] = '/dev/null'
+    self.assertTrue(cros_build_lib._GetPopen() is cros_build_lib._StatsPopen)
+
+
 class TestRetries(cros_test_lib.MoxTestCase):
 
   def testRetryReturn(self):
@@ -622,6 +768,85 @@ class TestListFiles(cros_test_lib.TempDirTestCase):
       self.assertEqual(err.errno, errno.ENOENT)
 
 
+class TestCompressors(cros_test_lib.TempDirTestCase):
+  """Tests for FindCompressor and friends."""
+
+  def setUp(self):
+    self.chroot = os.path.join(self.tempdir, 'chroot')
+
+  def _MakeProgs(self, *progs):
+    for prog in progs:
+      osutils.Touch(os.path.join(self.chroot, prog), makedirs=True)
+
+  def testParallelPreferred(self):
+    """Verify parallel compressors win, wherever they are."""
+    self._MakeProgs('bin/bzip2', 'usr/bin/pbzip2', 'bin/xz', 'usr/bin/pixz')
+    self.assertEqual(
+        cros_build_lib.FindCompressor(cros_build_lib.COMP_BZIP2,
+                                      chroot=self.chroot),
+        os.path.join(self.chroot, 'usr/bin/pbzip2'))
+    self.assertEqual(
+        cros_build_lib.FindCompressor(cros_build_lib.COMP_XZ,
+                                      chroot=self.chroot),
+        os.path.join(self.chroot, 'usr/bin/pixz'))
+    self._MakeProgs('bin/lbzip2')
+    self.assertEqual(
+        cros_build_lib.FindCompressor(cros_build_lib.COMP_BZIP2,
+                                      chroot=self.chroot),
+        os.path.join(self.chroot, 'bin/lbzip2'))
+    self.assertEqual(
+        cros_build_lib.FindCompressor(cros_build_lib.COMP_NONE), 'cat')
+    self.assertRaises(ValueError, cros_build_lib.FindCompressor, 42)
+
+  def testProfiles(self):
+    """Verify profiles add the right compression levels."""
+    self._MakeProgs('bin/pigz')
+    pigz = os.path.join(self.chroot, 'bin/pigz')
+    self.assertEqual(
+        cros_build_lib.GetCompressorCommand(
+            cros_build_lib.COMP_GZIP, chroot=self.chroot),
+        [pigz])
+    self.assertEqual(
+        cros_build_lib.GetCompressorCommand(
+            cros_build_lib.COMP_GZIP, chroot=self.chroot,
+            profile=cros_build_lib.COMP_PROFILE_FAST),
+        [pigz, '-1'])
+    self.assertRaises(ValueError, cros_build_lib.GetCompressorCommand,
+                      cros_build_lib.COMP_GZIP, profile='bogus')
+
+  def testPixzBest(self):
+    """Verify pixz keeps its memory use bounded for the best profile."""
+    self._MakeProgs('bin/pixz')
+    cmd = cros_build_lib.GetCompressorCommand(
+        cros_build_lib.COMP_XZ, chroot=self.chroot,
+        profile=cros_build_lib.COMP_PROFILE_BEST)
+    self.assertEqual(cmd[:3], [os.path.join(self.chroot, 'bin/pixz'), '-9',
+                               '-p'])
+    self.assertTrue(int(cmd[3]) <= cros_build_lib._PIXZ_BEST_THREADS)
+
+  def testCreateTarball(self):
+    """Verify tarballs made with a profile can be read back."""
+    src = os.path.join(self.tempdir, 'src')
+    osutils.WriteFile(os.path.join(src, 'foo.txt'), 'foo' * 1000,
+                      makedirs=True)
+    target = os.path.join(self.tempdir, 'out.tar.gz')
+    result = cros_build_lib.CreateTarball(
+        target, src, compression=cros_build_lib.COMP_GZIP,
+        profile=cros_build_lib.COMP_PROFILE_BEST)
+    cros_test_lib.VerifyTarball(target, ['./', 'foo.txt'])
+    # Old versions of tar can't take compressor arguments via -I.
+    self.assertFalse('-I' in result.cmd)
+
+  def testCreateTarballFailure(self):
+    """Verify tar failing fails the pipe through the compressor."""
+    target = os.path.join(self.tempdir, 'out.tar.gz')
+    self.assertRaises(
+        cros_build_lib.RunCommandError, cros_build_lib.CreateTarball,
+        target, self.tempdir, inputs=['missing'],
+        compression=cros_build_lib.COMP_GZIP,
+        profile=cros_build_lib.COMP_PROFILE_BEST)
+
+
 class HelperMethodSimpleTests(cros_test_lib.TestCase):
   """Tests for various helper methods without using mox."""
 
@@ -962,6 +1187,307 @@ class TestTreeStatus(cros_test_lib.MoxTestCase):
                                'open', True, retries_500=2)
 
 
+class TestFindProjectFromPath(cros_test_lib.TempDirTestCase):
+  """Tests for ManifestCheckout.FindProjectFromPath."""
+
+  PROJECTS = ('chromite', 'src/platform/dev', 'src/platform/dev/nested',
+              'src/third_party/kernel')
+
+  def setUp(self):
+    # Skip __init__; it needs a real repo checkout.
+    self.manifest = git.ManifestCheckout.__new__(git.ManifestCheckout)
+    self.manifest.root = self.tempdir
+    self.manifest._path_index = None
+    self.manifest.projects = dict(
+        ('name/%s' % path, {'path': path,
+                            'local_path': os.path.join(self.tempdir, path)})
+        for path in self.PROJECTS)
+
+  def testFind(self):
+    """Verify paths map to the deepest project containing them."""
+    expected = {
+        'chromite': 'name/chromite',
+        'chromite/lib/git.py': 'name/chromite',
+        os.path.join(self.tempdir, 'chromite/lib'): 'name/chromite',
+        'chromite-other/foo': None,
+        'src/platform/dev/foo.py': 'name/src/platform/dev',
+        'src/platform/dev/nested/foo.py': 'name/src/platform/dev/nested',
+        'src/platform': None,
+        'src/third_party/kernel/../kernel/Makefile':
+            'name/src/third_party/kernel',
+        '/': None,
+    }
+    for path, project in expected.iteritems():
+      self.assertEqual(self.manifest.FindProjectFromPath(path), project, path)
+    self.assertEqual(self.manifest.FindProjectsFromPaths(expected), expected)
+
+
+class TestProjectWideLookups(cros_test_lib.TempDirTestCase):
+  """Tests for resolving things across every project of a manifest."""
+
+  def setUp(self):
+    manifest = os.path.join(self.tempdir, 'manifest.xml')
+    osutils.WriteFile(manifest, """
+        <manifest>
+          <remote name="cros" fetch="http://localhost" />
+          <remote name="other" fetch="http://localhost" />
+          <default remote="cros" revision="refs/heads/master" />
+          <project name="pushable" />
+          <project name="unpushable" remote="other" />
+          <project name="pinned" revision="1234" />
+        </manifest>""")
+    # Skip the rest of __init__; it needs a real repo checkout.
+    self.manifest = git.ManifestCheckout.__new__(git.ManifestCheckout)
+    self.manifest.root = self.tempdir
+    self.manifest._revisions = {}
+    git.Manifest.__init__(self.manifest, manifest)
+
+  def _Commit(self, project, message):
+    """Commit to |project|, creating it if needed, and return the sha1."""
+    path = os.path.join(self.tempdir, project)
+    if not os.path.isdir(path):
+      git.RunGit(self.tempdir, ['init', project])
+      git.RunGit(path, ['config', 'user.email', 'nobody@chromium.org'])
+      git.RunGit(path, ['config', 'user.name', 'nobody'])
+    git.RunGit(path, ['commit', '--allow-empty', '-m', message])
+    return git.RunGit(path, ['rev-parse', 'HEAD']).output.strip()
+
+  def testTrackingBranches(self):
+    """Verify tracking branches match the per-project lookups."""
+    self.assertEqual(self.manifest.GetTrackingBranches(), {
+        'pushable': ('cros', 'refs/remotes/cros/master'),
+        'unpushable': ('other', 'refs/remotes/other/master'),
+        'pinned': ('cros', '1234'),
+    })
+    self.assertEqual(self.manifest.GetTrackingBranches(for_checkout=False), {
+        'pushable': ('cros', 'refs/heads/master'),
+        'unpushable': ('other', 'refs/heads/master'),
+        'pinned': None,
+    })
+    self.assertEqual(self.manifest.GetTrackingBranches(for_push=True), {
+        'pushable': ('gerrit', 'refs/remotes/gerrit/master'),
+        'unpushable': None,
+        'pinned': ('gerrit', '1234'),
+    })
+    self.assertTrue(self.manifest.GetTrackingBranches() is
+                    self.manifest.GetTrackingBranches())
+
+  def testResolveRevisions(self):
+    """Verify revisions are resolved in each project, and cached."""
+    first = self._Commit('pushable', 'first')
+    pinned = self._Commit('pinned', 'first')
+    git.RunGit(os.path.join(self.tempdir, 'pushable'),
+               ['update-ref', 'refs/remotes/cros/master', first])
+    expected = {'pushable': first, 'unpushable': None, 'pinned': pinned}
+    self.assertEqual(self.manifest.ResolveRevisions(), expected)
+
+    second = self._Commit('pushable', 'second')
+    self.assertEqual(self.manifest.ResolveRevisions(), expected)
+    expected['pushable'] = second
+    self.assertEqual(self.manifest.ResolveRevisions(refresh=True), expected)
+
+    self.assertEqual(self.manifest.ResolveRevisions(None), {
+        'pushable': first, 'unpushable': None, 'pinned': None})
+
+
+class TestManifestDiskCache(cros_test_lib.TempDirTestCase):
+  """Tests for caching parsed manifests on disk."""
+
+  class _CountingManifest(git.Manifest):
+    """A Manifest that counts how often it really parses."""
+    parses = 0
+
+    def _RunParser(self, source, finalize=True):
+      if finalize:
+        self.__class__.parses += 1
+      return git.Manifest._RunParser(self, source, finalize=finalize)
+
+  def setUp(self):
+    self.old_env = os.environ.get(constants.SHARED_CACHE_ENVVAR)
+    os.environ[constants.SHARED_CACHE_ENVVAR] = os.path.join(
+        self.tempdir, 'cache')
+    self.manifest_dir = os.path.join(self.tempdir, 'manifests')
+    self.manifest = os.path.join(self.manifest_dir, 'default.xml')
+    self.include = os.path.join(self.manifest_dir, 'remotes.xml')
+    osutils.WriteFile(self.manifest, """
+        <manifest>
+          <include name="remotes.xml" />
+          <default remote="foon" revision="refs/heads/master" />
+          <project name="monkeys" groups="minilayout" />
+        </manifest>""", makedirs=True)
+    self._WriteInclude('http://localhost')
+    self._CountingManifest.parses = 0
+
+  def tearDown(self):
+    if self.old_env is None:
+      os.environ.pop(constants.SHARED_CACHE_ENVVAR, None)
+    else:
+      os.environ[constants.SHARED_CACHE_ENVVAR] = self.old_env
+
+  def _WriteInclude(self, fetch):
+    osutils.WriteFile(self.include, """
+        <manifest>
+          <remote name="foon" fetch="%s" />
+        </manifest>""" % fetch)
+
+  def _Parse(self):
+    return self._CountingManifest(self.manifest,
+                                  manifest_include_dir=self.manifest_dir)
+
+  def testCacheReused(self):
+    """Verify the cached data matches a fresh parse."""
+    first = self._Parse()
+    second = self._Parse()
+    self.assertEqual(self._CountingManifest.parses, 1)
+    for attr in ('default', 'projects', 'remotes', 'includes', 'revision'):
+      self.assertEqual(getattr(first, attr), getattr(second, attr))
+    self.assertEqual(second.projects['monkeys']['groups'],
+                     frozenset(['default', 'minilayout']))
+
+  def testIncludeChanged(self):
+    """Verify changing an include invalidates the cache."""
+    self._Parse()
+    self._WriteInclude('http://elsewhere')
+    manifest = self._Parse()
+    self.assertEqual(self._CountingManifest.parses, 2)
+    self.assertEqual(manifest.remotes['foon']['fetch'], 'http://elsewhere')
+
+  def testIncludeDeleted(self):
+    """Verify deleting an include invalidates the cache."""
+    manifest = self._Parse()
+    path = manifest._GetDiskCachePath(self.manifest)
+    os.unlink(self.include)
+    self.assertFalse(manifest._ReadDiskCache(path))
+
+  def testCorruptCache(self):
+    """Verify a corrupt cache entry is ignored."""
+    manifest = self._Parse()
+    path = manifest._GetDiskCachePath(self.manifest)
+    osutils.WriteFile(path, 'garbage')
+    self.assertEqual(self._Parse().projects, manifest.projects)
+    self.assertEqual(self._CountingManifest.parses, 2)
+
+  def testNoCacheDir(self):
+    """Verify nothing is cached without a cache dir."""
+    os.environ.pop(constants.SHARED_CACHE_ENVVAR)
+    self._Parse()
+    self._Parse()
+    self.assertEqual(self._CountingManifest.parses, 2)
+
+
+class TestGitBatch(cros_test_lib.MockTempDirTestCase):
+  """Tests for answering git lookups through GitBatch."""
+
+  def setUp(self):
+    git.CloseGitBatches()
+    git.RunGit(self.tempdir, ['init'])
+    git.RunGit(self.tempdir, ['config', 'user.email', 'nobody@chromium.org'])
+    git.RunGit(self.tempdir, ['config', 'user.name', 'nobody'])
+    git.RunGit(self.tempdir, ['commit', '--allow-empty', '-m', 'first'])
+    self.sha1 = git.RunGit(self.tempdir, ['rev-parse', 'HEAD']).output.strip()
+
+  def tearDown(self):
+    git.CloseGitBatches()
+
+  def testResolveRevision(self):
+    """Verify revisions resolve like rev-parse, and missing ones to None."""
+    batch = git.GetGitBatch(self.tempdir)
+    self.assertTrue(batch is git.GetGitBatch(self.tempdir))
+    self.assertEqual(batch.ResolveRevision('HEAD'), self.sha1)
+    self.assertEqual(batch.ResolveRevision('refs/heads/master'), self.sha1)
+    self.assertEqual(batch.ResolveRevision('does-not-exist'), None)
+    self.assertEqual(batch.ResolveRevision('--foo'), None)
+    self.assertEqual(git.GetGitRepoRevision(self.tempdir), self.sha1)
+    self.assertTrue(git.DoesCommitExistInRepo(self.tempdir, self.sha1))
+    self.assertFalse(git.DoesCommitExistInRepo(self.tempdir, '0' * 40))
+    self.assertRaises(cros_build_lib.RunCommandError,
+                      git.GetGitRepoRevision, self.tempdir, 'does-not-exist')
+
+  def testHead(self):
+    """Verify HEAD is read without cat-file, unless its ref is packed."""
+    batch = git.GetGitBatch(self.tempdir)
+    self.assertEqual(batch.ResolveRevision('HEAD'), self.sha1)
+    git.RunGit(self.tempdir, ['checkout', self.sha1])
+    self.assertEqual(batch.ResolveRevision('HEAD'), self.sha1)
+    self.assertEqual(batch._proc, None)
+
+    git.RunGit(self.tempdir, ['checkout', 'master'])
+    git.RunGit(self.tempdir, ['pack-refs', '--all', '--prune'])
+    self.assertEqual(batch.ResolveRevision('HEAD'), self.sha1)
+    self.assertNotEqual(batch._proc, None)
+
+  def testCurrentBranch(self):
+    """Verify the branch is found, and detached HEADs give None."""
+    git.RunGit(self.tempdir, ['checkout', '-b', 'foo'])
+    self.assertEqual(git.GetCurrentBranch(self.tempdir), 'foo')
+    git.RunGit(self.tempdir, ['checkout', self.sha1])
+    self.assertEqual(git.GetCurrentBranch(self.tempdir), None)
+
+  def testConfigChanged(self):
+    """Verify tracking branches are reread when the config changes."""
+    self.assertEqual(
+        git.GetTrackingBranchViaGitConfig(self.tempdir, 'master'), None)
+    git.RunGit(self.tempdir, ['config', 'branch.master.remote', 'cros'])
+    git.RunGit(self.tempdir, ['config', 'branch.master.merge',
+                              'refs/heads/master'])
+    self.assertEqual(
+        git.GetTrackingBranchViaGitConfig(self.tempdir, 'master'),
+        ('cros', 'refs/remotes/cros/master'))
+
+  def testConfigWorktree(self):
+    """Verify the config of a worktree is found in the shared git dir."""
+    worktree = os.path.join(self.tempdir, 'worktree')
+    git.RunGit(self.tempdir, ['worktree', 'add', '-b', 'foo', worktree])
+    batch = git.GetGitBatch(worktree)
+    self.assertEqual(batch.GetConfig()['user.name'][-1], 'nobody')
+    git.RunGit(self.tempdir, ['config', 'user.name', 'somebody'])
+    self.assertEqual(batch.GetConfig()['user.name'][-1], 'somebody')
+
+  def testForked(self):
+    """Verify a forked child doesn't share its parent's cat-file process."""
+    batch = git.GetGitBatch(self.tempdir)
+    batch.ResolveRevision('master')
+    parent_proc = batch._proc
+    pid = os.fork()
+    if pid == 0:
+      try:
+        ok = (batch.ResolveRevision('master') == self.sha1 and
+              batch._proc is not parent_proc)
+        batch.Close()
+      finally:
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    self.assertEqual(status, 0)
+    self.assertTrue(batch._proc is parent_proc)
+    self.assertEqual(batch.ResolveRevision('master'), self.sha1)
+
+  def testGitDir(self):
+    """Verify the git dir is found without running git."""
+    run_git = self.PatchObject(git, 'RunGit')
+    git_dir = os.path.join(self.tempdir, '.git')
+    self.assertEqual(git.GitBatch(self.tempdir).git_dir, git_dir)
+    worktree = os.path.join(self.tempdir, 'worktree')
+    osutils.WriteFile(os.path.join(worktree, '.git'), 'gitdir: %s\n' % git_dir,
+                      makedirs=True)
+    self.assertEqual(git.GitBatch(worktree).git_dir, git_dir)
+    self.assertEqual(git.GitBatch(git_dir).git_dir, git_dir)
+    self.assertFalse(run_git.called)
+
+  def testLimit(self):
+    """Verify the least recently used instances are shut down."""
+    self.PatchObject(git, '_MAX_GIT_BATCHES', 2)
+    repos = [os.path.join(self.tempdir, str(i)) for i in xrange(3)]
+    batches = []
+    for repo in repos:
+      git.RunGit(self.tempdir, ['init', repo])
+      batch = git.GetGitBatch(repo)
+      batch.ResolveRevision('HEAD')
+      batches.append(batch)
+    self.assertEqual(batches[0]._proc, None)
+    self.assertNotEqual(batches[2]._proc, None)
+    self.assertEqual(len(git._git_batches), 2)
+
+
 class Test_iflatten_instance(cros_test_lib.TestCase):
 
   def test_it(self):
@@ -4,16 +4,176 @@
 
 """Module containing helper class and methods for interacting with Gerrit."""
 
+import atexit
 import itertools
 import json
 import logging
 import operator
+import os
+import Queue
+import sys
+import tempfile
+import threading
+import time
 
 from chromite.buildbot import constants
 from chromite.lib import cros_build_lib
+from chromite.lib import osutils
 from chromite.lib import patch as cros_patch
 
 
+# How long, in seconds, an idle ssh master connection to gerrit is kept.
+_SSH_CONTROL_PERSIST = 600
+# Unix socket paths are limited to ~108 bytes, and ssh needs some slack for
+# the temporary name it binds first.
+_SSH_CONTROL_PATH_MAX = 80
+
+# Cached query results are always fully refetched after this many seconds.
+_QUERY_CACHE_MAX_AGE = 3600
+# Cached queries with more changes than this are fully refetched rather than
+# incrementally updated, since each of them is named in the update query.
+_QUERY_INCREMENTAL_MAX_CHANGES = 200
+# How far, in seconds, our clock may be behind gerrit's.
+_QUERY_CLOCK_SLACK = 300
+
+# The cached results of queries; see GerritHelper.Query.
+_query_cache = {}
+
+# The directory holding our control sockets, the pid of the process that
+# owns it, and the control socket for each (host, port, user) we've connected
+# to; None if starting a master connection for it failed.  Only the process
+# that imported this module starts master connections, so that nothing is
+# left behind by forked children, which never run atexit handlers.
+_ssh_control_dir = None
+_ssh_control_pid = os.getpid()
+_ssh_masters = {}
+
+
+def _StartSshMaster(host, port, user, path):
+  """Start a background master connection listening on |path|.
+
+  Returns:
+    True if the master is up, False otherwise.
+  """
+  cmd = ['ssh', '-p', str(port), '-o', 'ControlMaster=yes',
+         '-o', 'ControlPath=%s' % path,
+         '-o', 'ControlPersist=%i' % _SSH_CONTROL_PERSIST, '-N', '-f', host]
+  if user:
+    cmd.extend(['-l', user])
+  # The master outlives this call; it must not hold onto any pipes of ours,
+  # else we'd wait on it for EOF.
+  result = cros_build_lib.RunCommand(
+      cmd, print_cmd=False, error_code_ok=True, log_stdout_to_file=os.devnull,
+      combine_stdout_stderr=True)
+  return result.returncode == 0 and os.path.exists(path)
+
+
+def GetSshControlPath(host, port, user=None):
+  """Get the control socket of the master ssh connection to |host|, if any.
+
+  Args:
+    host: The host to connect to.
+    port: The ssh port to connect to.
+    user: If given, the user to connect as.
+
+  Returns:
+    The path of the control socket, or None if no master connection is up;
+    in that case, connect directly.
+  """
+  path = _ssh_masters.get((host, int(port), user))
+  if path is not None and os.path.exists(path):
+    return path
+  return None
+
+
+def StartSshMaster(host, port, user=None):
+  """Start a master ssh connection to |host|, unless one is already up.
+
+  Master connections are shared by all GerritHelpers in this process (and
+  its children) talking to the same host as the same user, so that each
+  gerrit command skips the ssh handshake.  One is started on first use, and
+  again if the previous one went away after being idle.  Forked children
+  only use the connections their parent started.
+
+  Args:
+    host: The host to connect to.
+    port: The ssh port to connect to.
+    user: If given, the user to connect as.
+
+  Returns:
+    See GetSshControlPath.
+  """
+  global _ssh_control_dir
+  key = (host, int(port), user)
+  path = _ssh_masters.get(key, '')
+  if (path is None or (path and os.path.exists(path)) or
+      _ssh_control_pid != os.getpid()):
+    return GetSshControlPath(host, port, user)
+
+  if _ssh_control_dir is None:
+    _ssh_control_dir = tempfile.mkdtemp(prefix='gerrit-ssh.')
+  path = os.path.join(_ssh_control_dir, '%s@%s:%i' % (user or '', host, port))
+  if len(path) > _SSH_CONTROL_PATH_MAX:
+    logging.warning('Not multiplexing ssh to %s; %s is too long.', host, path)
+    path = None
+  elif not _StartSshMaster(host, port, user, path):
+    logging.warning('Failed starting an ssh master connection to %s; '
+                    'connecting directly instead.', host)
+    path = None
+  _ssh_masters[key] = path
+  return path
+
+
+class _QueryCacheEntry(object):
+  """The cached results of a query; see GerritHelper.Query.
+
+  Attributes:
+    changes: The raw results, keyed by change number.
+    mark: The newest lastUpdated timestamp seen for the query; if there were
+      no results, when they were fetched.
+    created: When the results were fully fetched.
+    updated: When the results were last brought up to date.
+  """
+
+  def __init__(self, results, now):
+    self.changes = {}
+    self.mark = 0
+    self.created = now
+    self.Merge(results, now)
+    if not results:
+      self.mark = now
+
+  def Merge(self, results, now):
+    """Add or replace the given raw results."""
+    for change in results:
+      self.changes[change['number']] = change
+      self.mark = max(self.mark, change['lastUpdated'])
+    self.updated = now
+
+  def GetResults(self):
+    """Return the results, in the order gerrit would: most recent first."""
+    return sorted(self.changes.itervalues(), key=operator.itemgetter('sortKey'),
+                  reverse=True)
+
+
+@atexit.register
+def CloseSshMasters():
+  """Shut down the master ssh connections this process started."""
+  global _ssh_control_dir
+  # Forked children use, but don't own, their parent's connections.
+  if _ssh_control_dir is None or _ssh_control_pid != os.getpid():
+    return
+  while _ssh_masters:
+    (host, port, _), path = _ssh_masters.popitem()
+    if path is not None:
+      cros_build_lib.RunCommand(
+          ['ssh', '-p', str(port), '-o', 'ControlPath=%s' % path,
+           '-O', 'exit', host], print_cmd=False, error_code_ok=True,
+          redirect_stdout=True, redirect_stderr=True)
+  osutils.RmDir(_ssh_control_dir, ignore_missing=True)
+  _ssh_control_dir = None
+
+
 class GerritException(Exception):
   "Base exception, thrown for gerrit failures"""
 
@@ -31,13 +191,17 @@ class FailedToReachGerrit(GerritException):
   """Exception thrown if we failed to contact the Gerrit server."""
 
 
+class _QueryStopped(Exception):
+  """Raised to stop a query whose results are no longer wanted."""
+
+
 class GerritHelper(object):
   """Helper class to manage interaction with Gerrit server."""
 
   _GERRIT_MAX_QUERY_RETURN = 500
 
   def __init__(self, host, remote, ssh_port=29418, ssh_user=None, suexec=None,
-               print_cmd=True):
+               print_cmd=True, ssh_multiplex=True):
     """Initializes variables for interaction with a gerrit server.
 
     Args:
@@ -49,6 +213,8 @@ class GerritHelper(object):
         commands.  Used only by maintenance accounts.
       print_cmd: This is passed to all RunCommand invocations; set it
         to False if you want things quiet.
+      ssh_multiplex: If True, run ssh commands over a shared master
+        connection; see StartSshMaster.
     """
     self.host = host
     self.remote = remote
@@ -56,7 +222,11 @@ class GerritHelper(object):
     self.ssh_user = ssh_user
     self.suexec = suexec
     self.print_cmd = bool(print_cmd)
+    self.ssh_multiplex = bool(ssh_multiplex)
     self._version = None
+    # The number of gerrit ssh commands run, and the seconds spent in them.
+    self.ssh_calls = 0
+    self.ssh_seconds = 0.0
 
   @classmethod
   def FromRemote(cls, remote, **kwds):
@@ -97,9 +267,22 @@ class GerritHelper(object):
     s = '%s@%s' % (self.ssh_user, self.host) if self.ssh_user else self.host
     return "ssh://%s:%i" % (s, self.ssh_port)
 
+  def StartSshMaster(self):
+    """Start the master ssh connection for this helper; see StartSshMaster.
+
+    Commands are run over it from then on, unless it goes away.
+    """
+    if self.ssh_multiplex:
+      StartSshMaster(self.host, self.ssh_port, self.ssh_user)
+
   @property
   def base_ssh_prefix(self):
-    l = ['ssh', '-p', str(self.ssh_port), self.host]
+    l = ['ssh', '-p', str(self.ssh_port)]
+    if self.ssh_multiplex:
+      path = GetSshControlPath(self.host, self.ssh_port, self.ssh_user)
+      if path is not None:
+        l += ['-o', 'ControlMaster=no', '-o', 'ControlPath=%s' % path]
+    l.append(self.host)
     if self.ssh_user:
       l.extend(['-l', self.ssh_user])
     return l
@@ -117,6 +300,30 @@ class GerritHelper(object):
   def ssh_prefix(self):
     return self.GetSshPrefix()
 
+  def _RunSshCommand(self, cmd, capture_output=False, **kwds):
+    """Run a gerrit ssh command, accounting for the time it took.
+
+    Args:
+      cmd: The gerrit command to run, e.g. ['gerrit', 'version'].
+      capture_output: If True, use RunCommandCaptureOutput.
+      kwds: Passed to RunCommand.
+    """
+    if capture_output:
+      func = cros_build_lib.RunCommandCaptureOutput
+    else:
+      func = cros_build_lib.RunCommand
+    self.StartSshMaster()
+    start = time.time()
+    try:
+      return func(self.ssh_prefix + cmd, **kwds)
+    finally:
+      elapsed = time.time() - start
+      self.ssh_calls += 1
+      self.ssh_seconds += elapsed
+      logging.debug('%s to %s took %.2fs (%i calls, %.2fs total)',
+                    ' '.join(cmd[:2]), self.host, elapsed,
+                    self.ssh_calls, self.ssh_seconds)
+
   def SetReviewers(self, change, add=(), remove=(), project=None):
     """Adjust the reviewers list for a given change.
 
@@ -140,7 +347,7 @@ class GerritHelper(object):
     if not add and not remove:
       raise ValueError('Either add or remove must be non empty')
 
-    command = self.ssh_prefix + ['gerrit', 'set-reviewers']
+    command = ['gerrit', 'set-reviewers']
     command.extend(cros_build_lib.iflatten_instance(
         [('--add', x) for x in cros_build_lib.iflatten_instance(add)] +
         [('--remove', x) for x in cros_build_lib.iflatten_instance(remove)]))
@@ -150,7 +357,8 @@ class GerritHelper(object):
     # point, with gerrit complaining of duplicates when there aren't.
     # Yes kiddies, gerrit can be retarded; this being one of those cases.
     command.append(str(change))
-    cros_build_lib.RunCommandCaptureOutput(command, print_cmd=self.print_cmd)
+    self._RunSshCommand(command, capture_output=True,
+                        print_cmd=self.print_cmd)
 
   def GetGerritReviewCommand(self, command_list):
     """Returns array corresponding to Gerrit Review command.
@@ -159,6 +367,7 @@ class GerritHelper(object):
     scores, abandon, restore or submit it.  Pass in |command|.
     """
     assert isinstance(command_list, list), 'Review command must be list.'
+    self.StartSshMaster()
     return self.ssh_prefix + ['gerrit', 'review'] + command_list
 
   def GrabPatchFromGerrit(self, project, change, commit, must_match=True):
@@ -256,7 +465,7 @@ class GerritHelper(object):
     return results[0]
 
   def Query(self, query, sort=None, current_patch=True, options=(),
-            dryrun=False, raw=False, _resume_sortkey=None):
+            dryrun=False, raw=False, cache_ttl=None, incremental=False):
     """Freeform querying of a gerrit server
 
     Args:
@@ -267,6 +476,12 @@ class GerritHelper(object):
        is set to False, return the raw dictionary.  If False, raw is forced
        to True.
      options: any additional commandline options to pass to gerrit query
+     cache_ttl: If given, reuse the results of the same query (as issued by
+       any GerritHelper for this server) if they're at most this many seconds
+       old.
+     incremental: If True and results of the same query are cached, only
+       fetch the changes updated since then, and merge them into the cache.
+       Use this for queries that are polled.
 
     Returns:
      a sequence of dictionaries from the gerrit server
@@ -274,44 +489,187 @@ class GerritHelper(object):
      RunCommandException if the invocation fails, or GerritException if
      there is something wrong w/ the query parameters given
     """
+    if not current_patch:
+      raw = True
+
+    if dryrun:
+      cmd = self._GetQueryCommand(query, current_patch, options)
+      logging.info('Would have run %s', ' '.join(self.ssh_prefix + cmd))
+      return []
+
+    return _PendingQuery(None, self, query, sort=sort,
+                         current_patch=current_patch, options=options,
+                         raw=raw, cache_ttl=cache_ttl,
+                         incremental=incremental).Run()
 
-    cmd = self.ssh_prefix + ['gerrit', 'query', '--format=JSON']
+  def _FormatResults(self, results, sort, raw):
+    """Sort the raw |results| of a query, and convert them unless |raw|."""
+    if sort:
+      results = sorted(results, key=operator.itemgetter(sort))
+    if not raw:
+      return [cros_patch.GerritPatch(x, self.remote, self.ssh_url)
+              for x in results]
+    return results
+
+  def _GetQueryCommand(self, query, current_patch, options,
+                       resume_sortkey=None):
+    """Returns the gerrit command for one page of results of |query|."""
+    cmd = ['gerrit', 'query', '--format=JSON']
     cmd.extend(options)
     if current_patch:
       cmd.append('--current-patch-set')
-    else:
-      raw = True
 
     # Note we intentionally cap the query to 500; gerrit does so
     # already, but we force it so that if gerrit were to change
     # its return limit, this wouldn't break.
     overrides = ['limit:%i' % self._GERRIT_MAX_QUERY_RETURN]
-    if _resume_sortkey:
-      overrides += ['resume_sortkey:%s' % _resume_sortkey]
+    if resume_sortkey:
+      overrides += ['resume_sortkey:%s' % resume_sortkey]
 
-    cmd.extend(['--', query] + overrides)
+    return cmd + ['--', query] + overrides
 
-    if dryrun:
-      logging.info('Would have run %s', ' '.join(cmd))
-      return []
-    result = cros_build_lib.RunCommand(cmd, redirect_stdout=True,
-                                       print_cmd=self.print_cmd)
-    result = self.InterpretJSONResults(query, result.output)
+  def QueryIter(self, query, current_patch=True, options=(), raw=False):
+    """Like Query, but yields the results one at a time as they arrive.
 
-    if len(result) == self._GERRIT_MAX_QUERY_RETURN:
-      # Gerrit cuts us off at 500; thus go recursive via the sortKey to
-      # get the rest of the results.
-      result += self.Query(query, _resume_sortkey=result[-1]['sortKey'],
-                           current_patch=current_patch,
-                           options=options, dryrun=dryrun, raw=True)
+    Each result is parsed as soon as its line is read from ssh, rather than
+    once the whole page of results is in.  When a page is full, the query
+    for the next one is started right away, so it runs while the caller
+    works through the rest of the current page.
 
-    if sort:
-      result = sorted(result, key=operator.itemgetter(sort))
-    if not raw:
-      return [cros_patch.GerritPatch(x, self.remote, self.ssh_url)
-              for x in result]
+    Args:
+      query: See Query.
+      current_patch: See Query.
+      options: See Query.
+      raw: See Query.
 
-    return result
+    Raises:
+      RunCommandError if an invocation fails, or GerritException if the query
+      is bad.  Either can happen after some results were yielded.
+    """
+    if not current_patch:
+      raw = True
+
+    pages = []
+    try:
+      pages.append(self._StartQueryPage(query, current_patch, options))
+      while pages:
+        lines, _ = pages[0]
+        status = None
+        count = 0
+        for line in iter(lines.get, None):
+          if isinstance(line, Exception):
+            raise line
+          result = json.loads(line)
+          if 'type' in result:
+            status = line
+            continue
+          count += 1
+          if count == self._GERRIT_MAX_QUERY_RETURN:
+            # Gerrit cuts us off at 500; start on the next page via the
+            # sortKey while this one is consumed.
+            pages.append(self._StartQueryPage(
+                query, current_patch, options,
+                resume_sortkey=result['sortKey']))
+          if not raw:
+            result = cros_patch.GerritPatch(result, self.remote, self.ssh_url)
+          yield result
+
+        pages.pop(0)
+        # This raises for anything but a proper stats line.
+        self.InterpretJSONResults(query, status or '{}')
+    finally:
+      # If the caller stopped early, don't leave queries running.
+      for _, stop in pages:
+        stop.set()
+
+  def _StartQueryPage(self, query, current_patch, options,
+                      resume_sortkey=None):
+    """Start the query for one page of results; see QueryIter.
+
+    The query is run by a background thread, which puts each line of output
+    on a queue as soon as it is read.
+
+    Returns:
+      A tuple of the queue, which ends with None, or with the exception the
+      query failed with; and an event which, once set, stops the query at its
+      next line of output.
+    """
+    lines = Queue.Queue()
+    stop = threading.Event()
+    cmd = self._GetQueryCommand(query, current_patch, options,
+                                resume_sortkey=resume_sortkey)
+
+    def _LineCallback(line):
+      if stop.is_set():
+        # RunCommand kills the query on the way out.
+        raise _QueryStopped()
+      lines.put(line)
+
+    def _Run():
+      try:
+        self._RunSshCommand(cmd, line_callback=_LineCallback,
+                            print_cmd=self.print_cmd)
+      except _QueryStopped:
+        pass
+      except Exception as e:
+        lines.put(e)
+      lines.put(None)
+
+    thread = threading.Thread(target=_Run, name='gerrit query')
+    thread.daemon = True
+    thread.start()
+    return lines, stop
+
+  def _PlanQuery(self, query, current_patch, options, cache_ttl,
+                 incremental):
+    """Work out what has to be run against the server to answer |query|.
+
+    This is where the query cache is used; see Query.  Cached results are
+    brought up to date incrementally by fetching the changes updated since
+    the cache's mark: those that still match |query| replace their cached
+    versions, and cached changes that were updated but no longer match are
+    dropped.
+
+    Returns:
+      A tuple of the queries to run, each to completion (any of them may be
+      run concurrently), and a function taking a list of their respective
+      raw results and returning the raw results of |query|.
+    """
+    if cache_ttl is None and not incremental:
+      return [query], operator.itemgetter(0)
+
+    key = (self.host, self.ssh_port, self.ssh_user, self.suexec, query,
+           bool(current_patch), tuple(options))
+    entry = _query_cache.get(key)
+    now = time.time()
+    if entry is not None:
+      if cache_ttl is not None and now - entry.updated <= cache_ttl:
+        return [], lambda _: entry.GetResults()
+      if (incremental and now - entry.created <= _QUERY_CACHE_MAX_AGE and
+          len(entry.changes) <= _QUERY_INCREMENTAL_MAX_CHANGES):
+        # The mark is in the server's time, and we can only ask for changes
+        # updated within the last N seconds; allow for our clocks disagreeing.
+        age = int(now - entry.mark) + _QUERY_CLOCK_SLACK
+        queries = ['( %s ) -age:%is' % (query, age)]
+        if entry.changes:
+          queries.append('( %s ) -age:%is' % (
+              ' OR '.join('change:%s' % x for x in sorted(entry.changes)),
+              age))
+
+        def _Update(results):
+          matching = results[0]
+          for change in itertools.chain(*results[1:]):
+            entry.changes.pop(change['number'], None)
+          entry.Merge(matching, now)
+          logging.debug('Incrementally updated query %r: %i changes updated.',
+                        query, len(matching))
+          return entry.GetResults()
+        return queries, _Update
+
+    def _Store(results):
+      _query_cache[key] = new_entry = _QueryCacheEntry(results[0], now)
+      return new_entry.GetResults()
+    return [query], _Store
 
   def InterpretJSONResults(self, query, result_string, query_type='stats',
                            mode='query'):
@@ -414,8 +772,8 @@ class GerritHelper(object):
     if obj is None:
       # We suppress the gerrit version call's logging; it's basically
       # never useful log wise.
-      obj = cros_build_lib.RunCommandCaptureOutput(
-          self.ssh_prefix + ['gerrit', 'version'],
+      obj = self._RunSshCommand(
+          ['gerrit', 'version'], capture_output=True,
           print_cmd=False).output.strip()
       obj = obj.replace('gerrit version ', '')
       self._version = obj
@@ -440,9 +798,9 @@ class GerritHelper(object):
       logging.info("Would have ran sql query %r", (query,))
       return []
 
-    command = self.ssh_prefix + ['gerrit', 'gsql', '--format=JSON']
-    result = cros_build_lib.RunCommand(command, redirect_stdout=True,
-                                       input=query, print_cmd=self.print_cmd)
+    command = ['gerrit', 'gsql', '--format=JSON']
+    result = self._RunSshCommand(command, redirect_stdout=True,
+                                 input=query, print_cmd=self.print_cmd)
 
     query_type = 'update-stats' if is_command else 'query-stats'
 
@@ -488,6 +846,130 @@ class GerritHelper(object):
     return frozenset(x['columns']['name'] for x in results)
 
 
+class _SerialPage(object):
+  """A page of query results, fetched once asked for; see _PendingQuery."""
+  # pylint: disable=W0212
+
+  def __init__(self, helper, cmd):
+    self.helper = helper
+    self.cmd = cmd
+
+  def result(self):
+    return self.helper._RunSshCommand(self.cmd, redirect_stdout=True,
+                                      print_cmd=self.helper.print_cmd)
+
+
+class _PendingQuery(object):
+  """A GerritHelper.Query, following its pages of results.
+
+  Pages are run through a CommandPool if given one (see RunQueries), and
+  otherwise from this process, one at a time (see Run).
+  """
+  # pylint: disable=W0212
+
+  def __init__(self, pool, helper, query, sort=None, current_patch=True,
+               options=(), raw=False, cache_ttl=None, incremental=False):
+    self.pool = pool
+    self.helper = helper
+    self.sort = sort
+    self.current_patch = current_patch
+    self.options = options
+    self.raw = raw or not current_patch
+    self.error = None
+
+    self.queries, self.finish = helper._PlanQuery(
+        query, current_patch, options, cache_ttl, incremental)
+    self.results = [[] for _ in self.queries]
+    # The future for the page being fetched of each of the queries, or None
+    # once it has been fully fetched.
+    self.futures = [self._StartPage(x) for x in self.queries]
+
+  def _StartPage(self, query, resume_sortkey=None):
+    cmd = self.helper._GetQueryCommand(
+        query, self.current_patch, self.options, resume_sortkey=resume_sortkey)
+    if self.pool is None:
+      return _SerialPage(self.helper, cmd)
+    self.helper.StartSshMaster()
+    return self.pool.RunCommand(self.helper.ssh_prefix + cmd,
+                                redirect_stdout=True,
+                                print_cmd=self.helper.print_cmd)
+
+  def Advance(self, done):
+    """Handle the futures in |done|, starting on any pages that follow."""
+    for idx, future in enumerate(self.futures):
+      if future is None or future not in done:
+        continue
+      self.futures[idx] = None
+      try:
+        page = self.helper.InterpretJSONResults(self.queries[idx],
+                                                future.result().output)
+      except (GerritException, cros_build_lib.RunCommandError):
+        # Let the rest of this query's pages run out; they're ignored.
+        self.error = sys.exc_info()
+        continue
+      self.results[idx] += page
+      if len(page) == self.helper._GERRIT_MAX_QUERY_RETURN:
+        self.futures[idx] = self._StartPage(self.queries[idx],
+                                            resume_sortkey=page[-1]['sortKey'])
+
+  def Run(self):
+    """Run the query to completion, a page at a time, and return Result()."""
+    futures = self.futures
+    while futures:
+      self.Advance(futures)
+      futures = [x for x in self.futures if x is not None]
+    return self.Result()
+
+  def Result(self):
+    """Returns the results, or raises the error, of the finished query."""
+    if self.error is not None:
+      raise self.error[0], self.error[1], self.error[2]
+    return self.helper._FormatResults(self.finish(self.results), self.sort,
+                                      self.raw)
+
+
+def RunQueries(queries, max_parallel=None):
+  """Run the given queries concurrently, from this process.
+
+  This is for asking several gerrit servers (or one server several things)
+  at once, so that the time taken is that of the slowest query rather than
+  the sum of them all.  Queries are run as GerritHelper.Query would, results
+  caching included, but any one failing doesn't affect the others.
+
+  Args:
+    queries: A sequence of (helper, query, kwds) tuples, kwds being a dict of
+      keyword arguments for helper.Query; dryrun isn't supported.
+    max_parallel: The most ssh commands to run at once; defaults to all.
+
+  Returns:
+    A list with a (results, exc_info) tuple for each query.  Exactly one of
+    them is None; exc_info, if set, is the sys.exc_info() of the
+    GerritException or RunCommandError the query failed with.
+  """
+  queries = list(queries)
+  start = time.time()
+  with cros_build_lib.CommandPool(max_parallel=max_parallel or
+                                  max(2 * len(queries), 1)) as pool:
+    pending = [_PendingQuery(pool, helper, query, **kwds)
+               for helper, query, kwds in queries]
+    futures = [f for x in pending for f in x.futures]
+    while futures:
+      done = pool.WaitAny(futures)
+      for query in pending:
+        query.Advance(done)
+      futures = [f for x in pending for f in x.futures if f is not None]
+
+  results = []
+  for query in pending:
+    try:
+      results.append((query.Result(), None))
+    except (GerritException, cros_build_lib.RunCommandError):
+      results.append((None, sys.exc_info()))
+  logging.debug('Ran %i gerrit queries concurrently in %.2fs', len(queries),
+                time.time() - start)
+  return results
+
+
 def GetGerritPatchInfo(patches):
   """Query Gerrit server for patch information.
 
@@ -6,9 +6,12 @@
 
 """Unittests for GerritHelper.  Needs to have mox installed."""
 
+import json
 import mox
 import os
 import sys
+import threading
+import time
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
     os.path.abspath(__file__)))))
 
@@ -16,12 +19,14 @@ from chromite.buildbot import constants
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_test_lib
 from chromite.lib import gerrit
+from chromite.lib import osutils
 
 
 # pylint: disable=W0212,R0904
 class GerritHelperTest(cros_test_lib.MoxTestCase):
 
   def setUp(self):
+    self.mox.stubs.Set(gerrit, 'StartSshMaster', lambda *args: None)
     self.footer_template = (
       '{"type":"stats","rowCount":%(count)i,"runTimeMilliseconds":205}')
     self.results = (
@@ -255,6 +260,7 @@ class GerritQueryTests(cros_test_lib.MoxTestCase):
              '{"type":"stats","rowCount":1,"runTimeMilliseconds":4}'
     self.result = raw_json + '\n' + self.good_footer
     self.mox.StubOutWithMock(cros_build_lib, 'RunCommand')
+    self.mox.stubs.Set(gerrit, 'StartSshMaster', lambda *args: None)
 
   def testPatchNotFound1(self):
     """Test case where ChangeID isn't found on internal server."""
@@ -371,5 +377,301 @@ class GerritQueryTests(cros_test_lib.MoxTestCase):
     self.mox.VerifyAll()
 
 
+# pylint: disable=W0212,R0904
+class GerritQueryCacheTest(cros_test_lib.MoxTestCase):
+  """Tests for caching and incrementally updating query results."""
+
+  def setUp(self):
+    self.mox.stubs.Set(gerrit, 'StartSshMaster', lambda *args: None)
+    self.mox.stubs.Set(gerrit, '_query_cache', {})
+    self.mox.StubOutWithMock(cros_build_lib, 'RunCommand')
+    self.now = 1000
+    self.mox.stubs.Set(time, 'time', lambda: self.now)
+
+  @staticmethod
+  def _Change(number, last_updated, status='NEW'):
+    return {'project': 'chromiumos/chromite', 'branch': 'master',
+            'id': 'I%s' % str(number).rjust(40, '0'), 'number': str(number),
+            'subject': 'change %s' % number, 'status': status,
+            'owner': {'name': 'Owner', 'email': 'owner@chromium.org'},
+            'url': 'http://gerrit.chromium.org/gerrit/%s' % number,
+            'lastUpdated': last_updated,
+            'sortKey': '%08x%08x' % (last_updated, number),
+            'currentPatchSet': {'number': '1',
+                                'ref': 'refs/changes/%s/1' % number,
+                                'revision': '%040x' % number}}
+
+  def _ExpectQuery(self, query, changes):
+    result = self.mox.CreateMock(cros_build_lib.CommandResult)
+    result.output = '\n'.join(
+        [json.dumps(x) for x in changes] +
+        ['{"type":"stats","rowCount":%i}' % len(changes)])
+    cros_build_lib.RunCommand(mox.In(query), redirect_stdout=True,
+                              print_cmd=True).AndReturn(result)
+
+  def _Query(self, now, **kwds):
+    self.now = now
+    helper = gerrit.GerritHelper.FromRemote(constants.EXTERNAL_REMOTE)
+    return [x['number'] for x in helper.Query('status:open', raw=True, **kwds)]
+
+  def testTTL(self):
+    """Verify fresh enough results are reused."""
+    self._ExpectQuery('status:open', [self._Change(1, 900)])
+    self._ExpectQuery('status:open', [self._Change(2, 1080)])
+    self.mox.ReplayAll()
+    self.assertEqual(self._Query(1000, cache_ttl=60), ['1'])
+    self.assertEqual(self._Query(1050, cache_ttl=60), ['1'])
+    self.assertEqual(self._Query(1100, cache_ttl=60), ['2'])
+    self.mox.VerifyAll()
+
+  def testIncremental(self):
+    """Verify only updated changes are fetched, and merged in."""
+    self._ExpectQuery('status:open', [self._Change(2, 900),
+                                      self._Change(1, 800)])
+    # Change 3 is new, change 1 was updated and change 2 no longer matches.
+    self._ExpectQuery('( status:open ) -age:500s', [self._Change(3, 1090),
+                                                    self._Change(1, 1050)])
+    self._ExpectQuery('( change:1 OR change:2 ) -age:500s',
+                      [self._Change(1, 1050),
+                       self._Change(2, 1060, status='MERGED')])
+    self.mox.ReplayAll()
+    self.assertEqual(self._Query(1000, incremental=True), ['2', '1'])
+    self.assertEqual(self._Query(1100, incremental=True), ['3', '1'])
+    self.mox.VerifyAll()
+
+  def testUncached(self):
+    """Verify results are only cached when asked for."""
+    self._ExpectQuery('status:open', [self._Change(1, 900)])
+    self._ExpectQuery('status:open', [self._Change(1, 900)])
+    self.mox.ReplayAll()
+    self._Query(1000, cache_ttl=60)
+    self._Query(1000)
+    self.mox.VerifyAll()
+
+
+# pylint: disable=W0212,R0904
+class GerritQueryIterTest(cros_test_lib.MoxTempDirTestCase):
+  """Tests for streaming query results."""
+
+  def setUp(self):
+    self.helper = gerrit.GerritHelper.FromRemote(constants.EXTERNAL_REMOTE,
+                                                 print_cmd=False,
+                                                 ssh_multiplex=False)
+    self.helper._GERRIT_MAX_QUERY_RETURN = 2
+    self.mox.stubs.Set(self.helper, 'GetSshPrefix', lambda: [])
+    self.mox.stubs.Set(self.helper, '_GetQueryCommand', self._GetQueryCommand)
+    self.events = []
+    self.pages = {}
+
+  def _GetQueryCommand(self, _query, _current_patch, _options,
+                       resume_sortkey=None):
+    self.events.append('page')
+    path = os.path.join(self.tempdir, str(resume_sortkey))
+    osutils.WriteFile(path, self.pages[resume_sortkey])
+    return ['cat', path]
+
+  def _SetPage(self, resume_sortkey, numbers, status='stats'):
+    self.pages[resume_sortkey] = '\n'.join(
+        [json.dumps(GerritQueryCacheTest._Change(x, 1000 - x))
+         for x in numbers] + ['{"type":"%s"}' % status]) + '\n'
+
+  def testPaging(self):
+    """Verify pages are streamed, and the next one is started early."""
+    self._SetPage(None, [1, 2])
+    self._SetPage('000003e600000002', [3])
+    for change in self.helper.QueryIter('status:open'):
+      self.events.append(int(change.gerrit_number))
+    self.assertEqual(self.events, ['page', 1, 'page', 2, 3])
+    self.assertEqual(self.helper.ssh_calls, 2)
+
+  def testErrors(self):
+    """Verify bad queries and failed commands raise."""
+    self._SetPage(None, [1], status='error')
+    self.assertRaises(gerrit.GerritException, list,
+                      self.helper.QueryIter('status:open', raw=True))
+    self.mox.stubs.Set(self.helper, '_GetQueryCommand',
+                       lambda *args, **kwds: ['false'])
+    self.assertRaises(cros_build_lib.RunCommandError, list,
+                      self.helper.QueryIter('status:open'))
+
+  def testStopEarly(self):
+    """Verify queries still running are killed if the caller stops."""
+    self._SetPage(None, [1, 2])
+    results = self.helper.QueryIter('status:open', raw=True)
+    self.assertEqual(results.next()['number'], '1')
+    # The next page is started along with the second result; it'd never end.
+    self.mox.stubs.Set(self.helper, '_GetQueryCommand', lambda *args, **kwds:
+                       ['sh', '-c', 'while :; do echo {}; sleep 0.1; done'])
+    self.assertEqual(results.next()['number'], '2')
+    start = time.time()
+    results.close()
+    for thread in threading.enumerate():
+      if thread.name == 'gerrit query':
+        thread.join(60)
+        self.assertFalse(thread.is_alive())
+    self.assertTrue(time.time() - start < 60)
+
+
+# pylint: disable=W0212,R0904
+class RunQueriesTest(cros_test_lib.MoxTempDirTestCase):
+  """Tests for running queries concurrently."""
+
+  def setUp(self):
+    self.mox.stubs.Set(gerrit, '_query_cache', {})
+
+  def _GetHelper(self, remote, pages, delay=0):
+    """Get a helper whose queries answer with |pages| after |delay|."""
+    helper = gerrit.GerritHelper.FromRemote(remote, print_cmd=False,
+                                            ssh_multiplex=False)
+    helper._GERRIT_MAX_QUERY_RETURN = 2
+    self.mox.stubs.Set(helper, 'GetSshPrefix', lambda: [])
+    def _GetQueryCommand(_query, _current_patch, _options,
+                         resume_sortkey=None):
+      path = os.path.join(self.tempdir, '%s-%s' % (remote, resume_sortkey))
+      osutils.WriteFile(path, pages[resume_sortkey])
+      return ['sh', '-c', 'sleep %s; cat "$1"' % delay, 'sh', path]
+    self.mox.stubs.Set(helper, '_GetQueryCommand', _GetQueryCommand)
+    return helper
+
+  @staticmethod
+  def _Page(numbers, status='stats'):
+    return '\n'.join(
+        [json.dumps(GerritQueryCacheTest._Change(x, 1000 - x))
+         for x in numbers] + ['{"type":"%s"}' % status]) + '\n'
+
+  def testConcurrent(self):
+    """Verify queries run at once, following pages and keeping order."""
+    external = self._GetHelper(
+        constants.EXTERNAL_REMOTE,
+        {None: self._Page([1, 2]), '000003e600000002': self._Page([3])},
+        delay=1)
+    internal = self._GetHelper(constants.INTERNAL_REMOTE,
+                               {None: self._Page([4])}, delay=1)
+    start = time.time()
+    results = gerrit.RunQueries([
+        (external, 'status:open', {}),
+        (internal, 'status:open', dict(raw=True, sort='number'))])
+    # Each host takes a second per page.
+    self.assertTrue(time.time() - start < 2.8)
+    self.assertEqual([x.gerrit_number for x in results[0][0]],
+                     ['1', '2', '3'])
+    self.assertEqual(results[0][1], None)
+    self.assertEqual([x['number'] for x in results[1][0]], ['4'])
+
+  def testErrors(self):
+    """Verify each query fails on its own."""
+    bad = self._GetHelper(constants.EXTERNAL_REMOTE,
+                          {None: self._Page([1], status='error')})
+    good = self._GetHelper(constants.INTERNAL_REMOTE,
+                           {None: self._Page([2])})
+    results = gerrit.RunQueries([(bad, 'status:open', {}),
+                                 (good, 'status:open', dict(raw=True))])
+    self.assertEqual(results[0][0], None)
+    self.assertTrue(isinstance(results[0][1][1], gerrit.GerritException))
+    self.assertEqual(results[1], ([GerritQueryCacheTest._Change(2, 998)],
+                                  None))
+
+
+# pylint: disable=W0212,R0904
+class GerritSshMultiplexTest(cros_test_lib.MoxTempDirTestCase):
+  """Tests for sharing ssh master connections to gerrit."""
+
+  def setUp(self):
+    self.mox.stubs.Set(gerrit, '_ssh_control_dir', self.tempdir)
+    self.mox.stubs.Set(gerrit, '_ssh_control_pid', os.getpid())
+    self.mox.stubs.Set(gerrit, '_ssh_masters', {})
+    self.mox.StubOutWithMock(gerrit, '_StartSshMaster')
+    self.path = os.path.join(self.tempdir, 'bot@gerrit.chromium.org:29418')
+
+  def _GetHelper(self):
+    return gerrit.GerritHelper('gerrit.chromium.org', constants.EXTERNAL_REMOTE,
+                               ssh_user='bot')
+
+  def _StartMaster(self, host, port, user, path):
+    self.assertEqual((host, port, user, path),
+                     ('gerrit.chromium.org', 29418, 'bot', self.path))
+    osutils.Touch(path)
+    return True
+
+  def testSharedMaster(self):
+    """Verify one master is started, and reused by all helpers."""
+    gerrit._StartSshMaster(mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(),
+                           mox.IgnoreArg()).WithSideEffects(self._StartMaster)
+    self.mox.ReplayAll()
+    for helper in (self._GetHelper(), self._GetHelper()):
+      helper.StartSshMaster()
+      self.assertEqual(
+          helper.ssh_prefix,
+          ['ssh', '-p', '29418', '-o', 'ControlMaster=no',
+           '-o', 'ControlPath=%s' % self.path, 'gerrit.chromium.org',
+           '-l', 'bot'])
+    self.mox.VerifyAll()
+
+  def testRestart(self):
+    """Verify a master that went away is restarted."""
+    for _ in xrange(2):
+      gerrit._StartSshMaster(mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(),
+                             mox.IgnoreArg()).WithSideEffects(self._StartMaster)
+    self.mox.ReplayAll()
+    helper = self._GetHelper()
+    helper.StartSshMaster()
+    self.assertTrue(self.path in ' '.join(helper.ssh_prefix))
+    os.unlink(self.path)
+    self.assertFalse(self.path in ' '.join(helper.ssh_prefix))
+    helper.StartSshMaster()
+    self.assertTrue(self.path in ' '.join(helper.ssh_prefix))
+    self.mox.VerifyAll()
+
+  def testFallback(self):
+    """Verify we connect directly if no master can be started."""
+    gerrit._StartSshMaster(mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(),
+                           mox.IgnoreArg()).AndReturn(False)
+    self.mox.ReplayAll()
+    for _ in xrange(2):
+      helper = self._GetHelper()
+      helper.StartSshMaster()
+      self.assertEqual(helper.ssh_prefix,
+                       ['ssh', '-p', '29418', 'gerrit.chromium.org',
+                        '-l', 'bot'])
+    self.mox.VerifyAll()
+
+  def testPrefixOnly(self):
+    """Verify building a command doesn't start a master."""
+    self.mox.ReplayAll()
+    self.assertEqual(self._GetHelper().ssh_prefix,
+                     ['ssh', '-p', '29418', 'gerrit.chromium.org',
+                      '-l', 'bot'])
+    self.mox.VerifyAll()
+
+  def testChild(self):
+    """Verify forked children use, but never start, masters."""
+    self.mox.stubs.Set(gerrit, '_ssh_control_pid', os.getpid() + 1)
+    self.mox.ReplayAll()
+    helper = self._GetHelper()
+    helper.StartSshMaster()
+    self.assertFalse(self.path in ' '.join(helper.ssh_prefix))
+    osutils.Touch(self.path)
+    gerrit._ssh_masters[('gerrit.chromium.org', 29418, 'bot')] = self.path
+    helper.StartSshMaster()
+    self.assertTrue(self.path in ' '.join(helper.ssh_prefix))
+    self.mox.VerifyAll()
+
+  def testClose(self):
+    """Verify masters are shut down, and their sockets cleaned up."""
+    gerrit._StartSshMaster(mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(),
+                           mox.IgnoreArg()).WithSideEffects(self._StartMaster)
+    self.mox.StubOutWithMock(cros_build_lib, 'RunCommand')
+    cros_build_lib.RunCommand(
+        ['ssh', '-p', '29418', '-o', 'ControlPath=%s' % self.path,
+         '-O', 'exit', 'gerrit.chromium.org'], print_cmd=False,
+        error_code_ok=True, redirect_stdout=True, redirect_stderr=True)
+    self.mox.ReplayAll()
+    self._GetHelper().StartSshMaster()
+    gerrit.CloseSshMasters()
+    self.assertFalse(os.path.exists(self.tempdir))
+    self.assertEqual(gerrit._ssh_masters, {})
+    self.mox.VerifyAll()
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
@@ -4,13 +4,18 @@
 
 """Common functions for interacting with git and repo."""
 
+import atexit
+import collections
+import cPickle
 import errno
 import hashlib
 import logging
 import os
 import re
+import resource
 # pylint: disable=W0402
 import string
+import subprocess
 import sys
 import time
 from xml import sax
@@ -138,7 +143,11 @@ def GetGitRepoRevision(cwd, branch='HEAD'):
 
   Defaults to current branch.
   """
-  return RunGit(cwd, ['rev-parse', branch]).output.strip()
+  revision = GetGitBatch(cwd).ResolveRevision(branch)
+  if revision is None:
+    # Let git report the failure the usual way.
+    revision = RunGit(cwd, ['rev-parse', branch]).output.strip()
+  return revision
 
 
 def DoesCommitExistInRepo(cwd, commit_hash):
@@ -148,8 +157,8 @@ def DoesCommitExistInRepo(cwd, commit_hash):
     cwd: A directory within the project repo.
     commit_hash: The hash of the commit object to look for.
   """
-  return 0 == RunGit(cwd, ['rev-list', '-n1', commit_hash],
-                     error_code_ok=True).returncode
+  rev = '%s^{commit}' % commit_hash
+  return GetGitBatch(cwd).ResolveRevision(rev) is not None
 
 
 def DoesLocalBranchExist(repo_dir, branch):
@@ -166,13 +175,10 @@ def DoesLocalBranchExist(repo_dir, branch):
 
 def GetCurrentBranch(cwd):
   """Returns current branch of a repo, and None if repo is on detached HEAD."""
-  try:
-    ret = RunGit(cwd, ['symbolic-ref', '-q', 'HEAD'])
-    return StripRefsHeads(ret.output.strip(), False)
-  except cros_build_lib.RunCommandError as e:
-    if e.result.returncode != 1:
-      raise
+  ref = GetGitBatch(cwd).GetSymbolicRef()
+  if ref is None:
     return None
+  return StripRefsHeads(ref, False)
 
 
 def StripRefsHeads(ref, strict=True):
@@ -206,6 +212,10 @@ class Manifest(object):
 
   _instance_cache = {}
 
+  # Bump this whenever the parsed data changes shape, or _FinalizeProjectData
+  # computes something new; older on-disk cache entries are then ignored.
+  DISK_CACHE_VERSION = 1
+
   def __init__(self, source, manifest_include_dir=None):
     """Initialize this instance.
 
@@ -221,9 +231,102 @@ class Manifest(object):
     self.includes = []
     self.revision = None
     self.manifest_include_dir = manifest_include_dir
-    self._RunParser(source)
+    self._tracking_branches = {}
+    self._Load(source)
     self.includes = tuple(self.includes)
 
+  def _Load(self, source):
+    """Parse |source|, or load the result of a previous parse from disk.
+
+    Parsing the full manifest (and its includes) is costly enough to show up
+    in the startup time of every script, so the finalized data is saved in
+    the cache dir, keyed on the manifest's md5 and validated against the md5s
+    of its includes.
+    """
+    cache_path = self._GetDiskCachePath(source)
+    if cache_path is not None and self._ReadDiskCache(cache_path):
+      return
+
+    start = time.time()
+    self._RunParser(source)
+    if cache_path is not None:
+      self._WriteDiskCache(cache_path, time.time() - start)
+
+  @staticmethod
+  def _GetDiskCacheDir():
+    """Returns the directory to cache parsed manifests in, if any."""
+    cache_dir = os.environ.get(constants.SHARED_CACHE_ENVVAR)
+    if cache_dir is None:
+      return None
+    return os.path.join(cache_dir, constants.COMMON_CACHE, 'manifests')
+
+  def _GetDiskCacheKey(self, source):
+    """Returns what the parsed data of |source| depends on."""
+    return (self.DISK_CACHE_VERSION, self.__class__.__name__,
+            self._GetManifestHash(source), self.manifest_include_dir)
+
+  def _GetDiskCachePath(self, source):
+    cache_dir = self._GetDiskCacheDir()
+    if cache_dir is None:
+      return None
+    # pylint: disable=E1101
+    key = hashlib.md5(repr(self._GetDiskCacheKey(source))).hexdigest()
+    return os.path.join(cache_dir, key)
+
+  def _ReadDiskCache(self, path):
+    """Load the parsed data from |path|, if it's there and still valid.
+
+    Returns:
+      True if the data was loaded.
+    """
+    start = time.time()
+    try:
+      with open(path, 'rb') as f:
+        data = cPickle.load(f)
+    except EnvironmentError as e:
+      if e.errno != errno.ENOENT:
+        logging.warning('Ignoring unreadable manifest cache %s: %s', path, e)
+      return False
+    except Exception as e:
+      logging.warning('Ignoring corrupt manifest cache %s: %s', path, e)
+      return False
+
+    try:
+      for include_path, include_md5 in data['include_md5s']:
+        if self._GetManifestHash(include_path) != include_md5:
+          return False
+    except Exception as e:
+      # Includes which went away (or can't be read) invalidate it too.
+      logging.debug('Ignoring stale manifest cache %s: %s', path, e)
+      return False
+
+    self.default = data['default']
+    self.projects = data['projects']
+    self.remotes = data['remotes']
+    self.includes = data['includes']
+    self.revision = data['revision']
+    logging.debug('Loaded manifest from %s in %.3fs; parsing took %.3fs.',
+                  path, time.time() - start, data['parse_time'])
+    return True
+
+  def _WriteDiskCache(self, path, parse_time):
+    """Save the parsed data to |path|."""
+    data = {
+        'default': self.default,
+        'projects': self.projects,
+        'remotes': self.remotes,
+        'includes': tuple(self.includes),
+        'include_md5s': [(abspath, self._GetManifestHash(abspath))
+                         for _target, abspath in self.includes],
+        'revision': self.revision,
+        'parse_time': parse_time,
+    }
+    try:
+      osutils.WriteFile(path, cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL),
+                        mode='wb', atomic=True, makedirs=True)
+    except EnvironmentError as e:
+      logging.debug('Failed caching the parsed manifest in %s: %s', path, e)
+
   def _RunParser(self, source, finalize=True):
     parser = sax.make_parser()
     handler = sax.handler.ContentHandler()
@@ -331,6 +434,52 @@ class Manifest(object):
     if not data['pushable']:
       raise AssertionError('Remote %s is not pushable.' % data['remote'])
 
+  @staticmethod
+  def _GetProjectTrackingBranch(data, for_checkout, for_push):
+    """Returns the tracking branch for a project; see GetTrackingBranches."""
+    if for_push:
+      if not data['pushable']:
+        return None
+      remote = data['push_remote']
+    else:
+      remote = data['remote']
+
+    if for_checkout:
+      revision = data['local_revision']
+      if for_push:
+        revision = data['push_remote_local']
+    else:
+      revision = data['revision']
+      if not revision.startswith('refs/heads/'):
+        return None
+
+    return remote, revision
+
+  def GetTrackingBranches(self, for_checkout=True, for_push=False):
+    """Returns the tracking branch of every project.
+
+    The results are computed once per set of arguments, and reused for the
+    lifetime of this object.
+
+    Args:
+      for_checkout: See GetTrackingBranchViaManifest.
+      for_push: See GetTrackingBranchViaManifest.  Projects which aren't
+        pushable map to None.
+
+    Returns:
+      A dict mapping each project to a tuple of its remote and ref, or None
+      if it has no usable tracking branch.
+    """
+    key = (for_checkout, for_push)
+    branches = self._tracking_branches.get(key)
+    if branches is None:
+      branches = dict(
+          (project, self._GetProjectTrackingBranch(data, for_checkout,
+                                                   for_push))
+          for project, data in self.projects.iteritems())
+      self._tracking_branches[key] = branches
+    return branches
+
   @staticmethod
   def _GetManifestHash(source, ignore_missing=False):
     if isinstance(source, basestring):
@@ -383,6 +532,10 @@ class ManifestCheckout(Manifest):
 
   _instance_cache = {}
 
+  # How many projects ResolveRevisions sends lookups to before reading their
+  # answers.
+  _RESOLVE_WINDOW = 32
+
   # pylint: disable=W0221
   def __init__(self, path, manifest_path=None, search=True):
     """Initialize this instance.
@@ -405,10 +558,24 @@ class ManifestCheckout(Manifest):
     self.manifest_branch = self._GetManifestsBranch(self.root)
     self.default_branch = 'refs/remotes/m/%s' % self.manifest_branch
     self._content_merging = {}
+    self._path_index = None
+    self._revisions = {}
     self.configured_groups = self._GetManifestGroups(self.root)
     Manifest.__init__(self, self.manifest_path,
                       manifest_include_dir=manifest_include_dir)
 
+  def _GetDiskCacheDir(self):
+    cache_dir = Manifest._GetDiskCacheDir()
+    if cache_dir is None:
+      # Fall back to the checkout's default cache dir; see commandline.
+      cache_dir = os.path.join(self.root, '.cache', constants.COMMON_CACHE,
+                               'manifests')
+    return cache_dir
+
+  def _GetDiskCacheKey(self, source):
+    # Project data includes local paths, thus is specific to this checkout.
+    return Manifest._GetDiskCacheKey(self, source) + (self.root,)
+
   @staticmethod
   def _NormalizeArgs(path, manifest_path=None, search=True):
     root = FindRepoCheckoutRoot(path)
@@ -459,6 +626,18 @@ class ManifestCheckout(Manifest):
           data['local_path'], data['push_remote'])
     return result
 
+  def _GetPathIndex(self):
+    """Returns a dict mapping each project's local_path to its name."""
+    if self._path_index is None:
+      index = {}
+      for name, data in self.projects.iteritems():
+        # If projects share a path, the greatest name wins; this matches
+        # what sorting the candidates would pick.
+        index[data['local_path']] = max(
+            name, index.get(data['local_path'], name))
+      self._path_index = index
+    return self._path_index
+
   def FindProjectFromPath(self, path):
     """Find the associated projects for a given pathway.
 
@@ -470,19 +649,96 @@ class ManifestCheckout(Manifest):
 
     Returns:
       None if no project is found, else the project."""
+    return self._FindProjectFromPath(path, {})
+
+  def _FindProjectFromPath(self, path, realpaths):
+    """Implementation of FindProjectFromPath.
+
+    Args:
+      path: See FindProjectFromPath.
+      realpaths: A dict used to memoize the realpath of directories.
+    """
     # Realpath everything sans the target to keep people happy about
     # how symlinks are handled; exempt the final node since following
     # through that is unlikely even remotely desired.
     tmp = os.path.join(self.root, os.path.dirname(path))
-    path = os.path.join(os.path.realpath(tmp), os.path.basename(path))
-    path = os.path.normpath(path) + '/'
-    candidates = [(x['path'], name) for name, x in self.projects.iteritems()
-                  if path.startswith(x['local_path'] + '/')]
-    if not candidates:
-      return None
+    if tmp not in realpaths:
+      realpaths[tmp] = os.path.realpath(tmp)
+    path = os.path.join(realpaths[tmp], os.path.basename(path))
+    path = os.path.normpath(path)
     # That which has the greatest common path prefix is the owner of
-    # the given pathway, thus we return that.
-    return sorted(candidates)[-1][1]
+    # the given pathway, thus walk up from the path itself.
+    index = self._GetPathIndex()
+    while True:
+      project = index.get(path)
+      if project is not None:
+        return project
+      parent = os.path.dirname(path)
+      if parent == path:
+        return None
+      path = parent
+
+  def FindProjectsFromPaths(self, paths):
+    """Find the associated projects for many pathways at once.
+
+    Args:
+      paths: An iterable of pathways; see FindProjectFromPath.
+
+    Returns:
+      A dict mapping each of |paths| to its project, or None.
+    """
+    realpaths = {}
+    return dict((path, self._FindProjectFromPath(path, realpaths))
+                for path in paths)
+
+  def ResolveRevisions(self, rev='HEAD', refresh=False):
+    """Resolve a revision in every project of the checkout.
+
+    The lookups go through each project's GitBatch, so HEAD is read straight
+    from the git dir, and other revisions cost at most one cat-file process
+    per project.  Those are fanned out a window of projects at a time: every
+    lookup in the window is sent before any answer is read, so the cat-file
+    processes start up and answer concurrently, while the window stays small
+    enough that none of its GitBatch instances get evicted (and closed)
+    before their answers are in.
+
+    The results are cached for the lifetime of this object; since instances
+    are shared via Cached(), pass refresh if the checkout may have changed
+    since (after a sync, or applying patches, for example).
+
+    Args:
+      rev: The revision to resolve in each project.  If None, each project's
+        tracking branch (its local_revision) is resolved instead.
+      refresh: If True, discard any cached results for |rev|.
+
+    Returns:
+      A dict mapping each project to the sha1 |rev| names in it, or None if
+      the project isn't checked out or doesn't have |rev|.
+    """
+    revisions = None if refresh else self._revisions.get(rev)
+    if revisions is None:
+      revisions = dict.fromkeys(self.projects)
+      projects = [(project, data) for project, data in self.projects.iteritems()
+                  if os.path.isdir(data['local_path'])]
+      window = min(self._RESOLVE_WINDOW, _MAX_GIT_BATCHES)
+      for start in xrange(0, len(projects), window):
+        pending = []
+        for project, data in projects[start:start + window]:
+          target = data['local_revision'] if rev is None else rev
+          if target != 'HEAD':
+            target += '^{commit}'
+          try:
+            pending.append((project, GetGitBatch(
+                data['local_path']).StartResolveRevision(target)))
+          except cros_build_lib.RunCommandError:
+            pass
+        for project, answer in pending:
+          try:
+            revisions[project] = answer()
+          except cros_build_lib.RunCommandError:
+            pass
+      self._revisions[rev] = revisions
+    return dict(revisions)
 
   def _FinalizeProjectData(self, attrs):
     Manifest._FinalizeProjectData(self, attrs)
@@ -645,6 +901,218 @@ def RunGit(git_repo, cmd, **kwds):
                                                 **kwds)
 
 
+class GitBatch(object):
+  """Answers lookups about a git repo without forking git for each one.
+
+  Revisions are resolved through a long lived `git cat-file --batch-check`,
+  HEAD is read straight from the git dir, and the config is listed once and
+  only listed again when the repo's config file changes.
+
+  Use GetGitBatch() rather than creating these directly, so that instances
+  are shared, bounded in number, and cleaned up at exit.
+  """
+
+  def __init__(self, git_repo):
+    self.git_repo = git_repo
+    self.git_dir = self._FindGitDir(git_repo)
+    self._proc = None
+    self._pid = None
+    self._config = None
+    self._config_stat = None
+
+  @staticmethod
+  def _FindGitDir(git_repo):
+    """Returns the git dir of |git_repo|, without forking git if possible."""
+    dot_git = os.path.join(git_repo, '.git')
+    if os.path.isdir(dot_git):
+      return dot_git
+    elif os.path.isfile(dot_git):
+      # A gitfile, as used by submodules and worktrees: "gitdir: <path>".
+      with open(dot_git) as f:
+        content = f.read().strip()
+      if content.startswith('gitdir: '):
+        return os.path.join(git_repo, content[len('gitdir: '):])
+    elif (os.path.isfile(os.path.join(git_repo, 'HEAD')) and
+          os.path.isdir(os.path.join(git_repo, 'objects'))):
+      # A bare repo.
+      return git_repo
+
+    git_dir = RunGit(git_repo, ['rev-parse', '--git-dir']).output.strip()
+    return os.path.join(git_repo, git_dir)
+
+  def _GetCatFile(self):
+    """Returns the cat-file process, starting it if necessary."""
+    if self._proc is not None and self._pid != os.getpid():
+      # We were forked; that process belongs to our parent, and sharing its
+      # pipes would interleave our queries with theirs.
+      self._proc = None
+    if self._proc is None:
+      with open(os.devnull, 'w') as devnull:
+        self._proc = subprocess.Popen(
+            ['git', 'cat-file', '--batch-check'], cwd=self.git_repo,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull,
+            close_fds=True)
+      self._pid = os.getpid()
+    return self._proc
+
+  def _ReadHead(self):
+    """Returns the sha1 HEAD points to, read from the git dir, or None.
+
+    Only detached HEADs and branches with loose refs are handled; anything
+    else (such as packed refs) is left for cat-file.
+    """
+    try:
+      head = osutils.ReadFile(os.path.join(self.git_dir, 'HEAD')).strip()
+      if head.startswith('ref: '):
+        head = osutils.ReadFile(
+            os.path.join(self.git_dir, head[len('ref: '):])).strip()
+    except EnvironmentError:
+      return None
+    return head if IsSHA1(head) else None
+
+  def ResolveRevision(self, rev):
+    """Returns the sha1 of the object |rev| names, or None if it's missing."""
+    return self.StartResolveRevision(rev)()
+
+  def StartResolveRevision(self, rev):
+    """Start resolving |rev|, without waiting for cat-file's answer.
+
+    This lets callers send lookups to many repos before reading any of the
+    answers, so that their cat-file processes work concurrently.  Only one
+    lookup per instance may be outstanding at a time.
+
+    Returns:
+      A function that waits for, and returns, what ResolveRevision would.
+    """
+    if rev == 'HEAD':
+      sha1 = self._ReadHead()
+      if sha1 is not None:
+        return lambda: sha1
+
+    # cat-file reads a name per line, and would take a leading - as a name.
+    if not rev or rev.startswith('-') or any(c.isspace() for c in rev):
+      result = RunGit(self.git_repo, ['rev-parse', '-q', '--verify', rev],
+                      error_code_ok=True)
+      sha1 = result.output.strip() if result.returncode == 0 else None
+      return lambda: sha1
+
+    proc = self._GetCatFile()
+    try:
+      proc.stdin.write(rev + '\n')
+      proc.stdin.flush()
+    except IOError as e:
+      if e.errno != errno.EPIPE:
+        raise
+      # Dealt with when the (missing) answer is read.
+    return lambda: self._ReadRevision(proc)
+
+  def _ReadRevision(self, proc):
+    """Read cat-file's answer to a lookup sent by StartResolveRevision."""
+    line = proc.stdout.readline()
+    if not line:
+      # cat-file died; start afresh next time.
+      self.Close()
+      raise cros_build_lib.RunCommandError(
+          'git cat-file exited unexpectedly in %s' % self.git_repo,
+          cros_build_lib.CommandResult(cmd=['git', 'cat-file',
+                                            '--batch-check']))
+
+    # Found objects are reported as "<sha1> <type> <size>", anything else
+    # as "<rev> missing" (or ambiguous).
+    fields = line.split()
+    if len(fields) == 3 and IsSHA1(fields[0]):
+      return fields[0]
+    return None
+
+  def GetSymbolicRef(self):
+    """Returns the ref HEAD points to, or None if HEAD is detached."""
+    with open(os.path.join(self.git_dir, 'HEAD')) as f:
+      head = f.read().strip()
+    if head.startswith('ref: '):
+      return head[len('ref: '):]
+    return None
+
+  def _GetConfigPath(self):
+    """Returns the path of the repo's config file.
+
+    Worktrees (and submodules using them) have a private git dir, which
+    names the shared git dir the config lives in with its commondir file.
+    """
+    try:
+      common_dir = osutils.ReadFile(
+          os.path.join(self.git_dir, 'commondir')).strip()
+    except EnvironmentError:
+      common_dir = ''
+    return os.path.join(self.git_dir, common_dir, 'config')
+
+  def GetConfig(self):
+    """Returns the config as a dict mapping keys to lists of values."""
+    try:
+      st = os.stat(self._GetConfigPath())
+      config_stat = (st.st_ino, st.st_size, st.st_mtime)
+    except OSError:
+      # Without a config file to watch, list it afresh every time.
+      config_stat = None
+    if (self._config is None or config_stat is None or
+        config_stat != self._config_stat):
+      config = {}
+      output = RunGit(self.git_repo, ['config', '--list', '-z']).output
+      for entry in output.split('\0'):
+        if entry:
+          key, _, value = entry.partition('\n')
+          config.setdefault(key, []).append(value)
+      self._config, self._config_stat = config, config_stat
+    return self._config
+
+  def Close(self):
+    """Shut down the cat-file process, if we started one."""
+    proc, self._proc = self._proc, None
+    if proc is None or self._pid != os.getpid():
+      return
+    try:
+      proc.stdin.close()
+    except IOError:
+      pass
+    proc.stdout.close()
+    proc.wait()
+
+
+def _GetMaxGitBatches():
+  """Returns how many GitBatch instances (cat-file processes) to keep alive.
+
+  Each holds two pipes open, and they may use up to half of our fd limit, so
+  that a whole manifest's worth of projects fits in all but tight limits.
+  """
+  limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+  if limit == resource.RLIM_INFINITY:
+    limit = 4096
+  return max(8, min(limit, 4096) / 4)
+
+
+_MAX_GIT_BATCHES = _GetMaxGitBatches()
+_git_batches = collections.OrderedDict()
+
+
+def GetGitBatch(git_repo):
+  """Returns the shared GitBatch for |git_repo|."""
+  key = os.path.realpath(git_repo)
+  batch = _git_batches.pop(key, None)
+  if batch is None:
+    batch = GitBatch(git_repo)
+  # Most recently used goes last; the least recently used are evicted.
+  _git_batches[key] = batch
+  while len(_git_batches) > _MAX_GIT_BATCHES:
+    _git_batches.popitem(last=False)[1].Close()
+  return batch
+
+
+@atexit.register
+def CloseGitBatches():
+  """Shut down all the shared GitBatch instances."""
+  while _git_batches:
+    _git_batches.popitem()[1].Close()
+
+
 def GetProjectUserEmail(git_repo):
   """Get the email configured for the project ."""
   output = RunGit(git_repo, ['var', 'GIT_COMMITTER_IDENT']).output
@@ -715,56 +1183,50 @@ def GetTrackingBranchViaGitConfig(git_repo, branch, for_checkout=True,
     A tuple of the remote and the ref name of the tracking branch, or
     None if it couldn't be found.
   """
-  try:
-    cmd = ['config', '--get-regexp',
-           r'branch\.%s\.(remote|merge)' % re.escape(branch)]
-    data = RunGit(git_repo, cmd).output.splitlines()
-
-    prefix = 'branch.%s.' % (branch,)
-    data = [x.split() for x in data]
-    vals = dict((x[0][len(prefix):], x[1]) for x in data)
-    if len(vals) != 2:
-      if not allow_broken_merge_settings:
-        return None
-      elif 'merge' not in vals:
-        # There isn't anything we can do here.
-        return None
-      elif 'remote' not in vals:
-        # Repo v1.9.4 and up occasionally invalidly leave the remote out.
-        # Only occurs for the manifest repo fortunately.
-        vals['remote'] = 'origin'
-    remote, rev = vals['remote'], vals['merge']
-    # Suppress non branches; repo likes to write revisions and tags here,
-    # which is wrong (git hates it, nor will it honor it).
-    if rev.startswith('refs/remotes/'):
-      if for_checkout:
-        return remote, rev
-      # We can't backtrack from here, or at least don't want to.
-      # This is likely refs/remotes/m/ which repo writes when dealing
-      # with a revision locked manifest.
+  config = GetGitBatch(git_repo).GetConfig()
+  vals = {}
+  for key in ('remote', 'merge'):
+    values = config.get('branch.%s.%s' % (branch, key))
+    if values:
+      vals[key] = values[-1]
+
+  if len(vals) != 2:
+    if not allow_broken_merge_settings:
       return None
-    if not rev.startswith('refs/heads/'):
-      # We explicitly don't allow pushing to tags, nor can one push
-      # to a sha1 remotely (makes no sense).
-      if not allow_broken_merge_settings:
-        return None
-    elif remote == '.':
-      if recurse == 0:
-        raise Exception(
-            "While tracing out tracking branches, we recursed too deeply: "
-            "bailing at %s" % branch)
-      return GetTrackingBranchViaGitConfig(
-          git_repo, StripRefsHeads(rev), for_checkout=for_checkout,
-          allow_broken_merge_settings=allow_broken_merge_settings,
-          recurse=recurse - 1)
-    elif for_checkout:
-      rev = 'refs/remotes/%s/%s' % (remote, StripRefsHeads(rev))
-    return remote, rev
-  except cros_build_lib.RunCommandError as e:
-    # 1 is the retcode for no matches.
-    if e.result.returncode != 1:
-      raise
-  return None
+    elif 'merge' not in vals:
+      # There isn't anything we can do here.
+      return None
+    elif 'remote' not in vals:
+      # Repo v1.9.4 and up occasionally invalidly leave the remote out.
+      # Only occurs for the manifest repo fortunately.
+      vals['remote'] = 'origin'
+  remote, rev = vals['remote'], vals['merge']
+  # Suppress non branches; repo likes to write revisions and tags here,
+  # which is wrong (git hates it, nor will it honor it).
+  if rev.startswith('refs/remotes/'):
+    if for_checkout:
+      return remote, rev
+    # We can't backtrack from here, or at least don't want to.
+    # This is likely refs/remotes/m/ which repo writes when dealing
+    # with a revision locked manifest.
+    return None
+  if not rev.startswith('refs/heads/'):
+    # We explicitly don't allow pushing to tags, nor can one push
+    # to a sha1 remotely (makes no sense).
+    if not allow_broken_merge_settings:
+      return None
+  elif remote == '.':
+    if recurse == 0:
+      raise Exception(
+          "While tracing out tracking branches, we recursed too deeply: "
+          "bailing at %s" % branch)
+    return GetTrackingBranchViaGitConfig(
+        git_repo, StripRefsHeads(rev), for_checkout=for_checkout,
+        allow_broken_merge_settings=allow_broken_merge_settings,
+        recurse=recurse - 1)
+  elif for_checkout:
+    rev = 'refs/remotes/%s/%s' % (remote, StripRefsHeads(rev))
+  return remote, rev
 
 
 def GetTrackingBranchViaManifest(git_repo, for_checkout=True, for_push=False,
@@ -797,22 +1259,8 @@ def GetTrackingBranchViaManifest(git_repo, for_checkout=True, for_push=False,
     if for_push:
       manifest.AssertProjectIsPushable(project)
 
-    data = manifest.projects[project]
-    if for_push:
-      remote = data['push_remote']
-    else:
-      remote = data['remote']
-
-    if for_checkout:
-      revision = data['local_revision']
-      if for_push:
-        revision = data['push_remote_local']
-    else:
-      revision = data['revision']
-      if not revision.startswith("refs/heads/"):
-        return None
-
-    return remote, revision
+    return manifest.GetTrackingBranches(for_checkout=for_checkout,
+                                        for_push=for_push)[project]
   except EnvironmentError:
     if e.errno != errno.ENOENT:
       raise
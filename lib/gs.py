@@ -5,6 +5,9 @@
 """Library to make common google storage operations more reliable.
 """
 
+import collections
+import errno
+import hashlib
 import logging
 import os
 
@@ -24,6 +27,9 @@ PUBLIC_BASE_HTTPS_URL = 'https://commondatastorage.googleapis.com/'
 PRIVATE_BASE_HTTPS_URL = 'https://sandbox.google.com/storage/'
 BASE_GS_URL = 'gs://'
 
+# The size and hex digests of data uploaded via GSContext.CopyFromStream.
+StreamResult = collections.namedtuple('StreamResult', ('size', 'md5', 'sha1'))
+
 
 def CanonicalizeURL(url, strict=False):
   """Convert provided URL to gs:// URL, if it follows a known format.
@@ -85,6 +91,9 @@ class GSContext(object):
   # (1*sleep) the first time, then (2*sleep), continuing via attempt * sleep.
   DEFAULT_SLEEP_TIME = 60
 
+  # How much to read at once when streaming uploads.
+  STREAM_CHUNK_SIZE = 1024 * 1024
+
   GSUTIL_TAR = 'gsutil-3.10.tar.gz'
   GSUTIL_URL = PUBLIC_BASE_HTTPS_URL + 'chromeos-public/%s' % GSUTIL_TAR
 
@@ -314,6 +323,102 @@ class GSContext(object):
       kwargs['headers'] = headers
     return self._DoCommand(cmd, redirect_stderr=True, **kwargs)
 
+  def CopyFromStream(self, stream, dest_path, acl=None, local_path=None,
+                     producers=()):
+    """Upload data to GS as it is read from the descriptor |stream|.
+
+    The data is checksummed, and optionally saved to |local_path|, in the
+    same pass.  Unlike Copy(), the streaming upload can't be retried, since
+    the stream can't be replayed; if it fails and a local copy was saved,
+    that is uploaded via Copy() instead.
+
+    Args:
+      stream: The file descriptor to read the data from, until EOF.
+      dest_path: Full gs:// path of the dest file.
+      acl: One of the google storage canned_acls to apply.
+      local_path: If given, also write the data to this local file.
+      producers: The CommandFutures of the commands writing to |stream|.  The
+        upload is abandoned if any of them fails, rather than committing
+        truncated data.
+
+    Raises:
+      RunCommandError if one of |producers| failed.
+      GSContextException if the upload failed, and there was no local copy
+      to fall back to.
+    Returns:
+      A StreamResult of the size, and md5 and sha1 hex digests, of the data.
+    """
+    cmd = [self.gsutil_bin, 'cp']
+    acl = self.acl_file if acl is None else acl
+    if acl is not None:
+      cmd += ['-a', acl]
+    cmd += ['--', '-', dest_path]
+
+    md5, sha1, size = hashlib.md5(), hashlib.sha1(), 0
+    upload = upload_fd = local = None
+    try:
+      # If anything goes wrong, the pool kills gsutil before its input is
+      # closed below, which abandons the upload.
+      with cros_build_lib.CommandPool(max_parallel=1) as pool:
+        if self.dry_run:
+          logging.debug("%s: would've streamed to %r",
+                        self.__class__.__name__, cmd)
+        else:
+          read_fd, upload_fd = os.pipe()
+          try:
+            upload = pool.RunCommand(
+                cmd, input=read_fd, redirect_stderr=True,
+                extra_env={'BOTO_CONFIG': self.boto_file},
+                debug_level=logging.DEBUG)
+          finally:
+            os.close(read_fd)
+
+        if local_path:
+          local = open(local_path, 'wb')
+        while True:
+          data = os.read(stream, self.STREAM_CHUNK_SIZE)
+          if not data:
+            break
+          md5.update(data)
+          sha1.update(data)
+          size += len(data)
+          if local:
+            local.write(data)
+          if upload_fd is not None:
+            try:
+              while data:
+                data = data[os.write(upload_fd, data):]
+            except OSError as e:
+              if e.errno != errno.EPIPE:
+                raise
+              # gsutil died; keep going for the sake of the local copy.
+              os.close(upload_fd)
+              upload_fd = None
+
+        for producer in producers:
+          producer.result()
+        if upload_fd is not None:
+          os.close(upload_fd)
+          upload_fd = None
+    finally:
+      if local:
+        local.close()
+      if upload_fd is not None:
+        os.close(upload_fd)
+
+    if upload is not None:
+      try:
+        upload.result()
+      except cros_build_lib.RunCommandError as e:
+        if not local_path:
+          raise GSContextException('Streaming upload to %s failed: %s'
+                                   % (dest_path, e))
+        logging.warning('Streaming upload to %s failed; uploading %s instead.',
+                        dest_path, local_path)
+        self.Copy(local_path, dest_path, acl=acl)
+
+    return StreamResult(size, md5.hexdigest(), sha1.hexdigest())
+
   def LS(self, path):
     """Does a directory listing of the given gs path."""
     return self._DoCommand(['ls', '--', path], redirect_stdout=True)
@@ -7,6 +7,7 @@
 """Unittests for the gs.py module."""
 
 import functools
+import hashlib
 import os
 import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
@@ -315,5 +316,66 @@ detail=A nonempty x-goog-project-id header is required for this request."""
     self.assertRaises(gs.GSContextException, self.ctx._InitBoto)
 
 
+class CopyFromStreamTest(cros_test_lib.TempDirTestCase):
+  """Tests GSContext.CopyFromStream() against a fake gsutil."""
+
+  DATA = 'monkeys\n' * (1024 * 256)
+
+  def setUp(self):
+    self.uploaded = os.path.join(self.tempdir, 'uploaded')
+    self.local = os.path.join(self.tempdir, 'local')
+    self.source = os.path.join(self.tempdir, 'source')
+    osutils.WriteFile(self.source, self.DATA)
+
+    # The upload is only complete once gsutil has read all of its input.
+    gsutil = os.path.join(self.tempdir, 'gsutil')
+    osutils.WriteFile(gsutil, '#!/bin/sh\ncat > %(path)s.tmp || exit 1\n'
+                      'mv %(path)s.tmp %(path)s\nexit ${FAKE_GS_EXIT:-0}\n'
+                      % {'path': self.uploaded})
+    os.chmod(gsutil, 0755)
+    boto_file = os.path.join(self.tempdir, 'boto')
+    osutils.Touch(boto_file)
+    self.ctx = gs.GSContext(gsutil_bin=gsutil, boto_file=boto_file)
+    os.environ.pop('FAKE_GS_EXIT', None)
+
+  def tearDown(self):
+    os.environ.pop('FAKE_GS_EXIT', None)
+
+  def _CopyFromSource(self, **kwargs):
+    fd = os.open(self.source, os.O_RDONLY)
+    try:
+      return self.ctx.CopyFromStream(fd, 'gs://foo/bar', **kwargs)
+    finally:
+      os.close(fd)
+
+  def testUpload(self):
+    """Verify data is uploaded, saved locally and checksummed."""
+    result = self._CopyFromSource(local_path=self.local)
+    self.assertEqual(osutils.ReadFile(self.uploaded), self.DATA)
+    self.assertEqual(osutils.ReadFile(self.local), self.DATA)
+    self.assertEqual(result, (len(self.DATA),
+                              hashlib.md5(self.DATA).hexdigest(),
+                              hashlib.sha1(self.DATA).hexdigest()))
+
+  def testFallback(self):
+    """Verify failed uploads fall back to the local copy, if there is one."""
+    os.environ['FAKE_GS_EXIT'] = '1'
+    self.assertRaises(gs.GSContextException, self._CopyFromSource)
+    with PatchGS('Copy') as copy:
+      self._CopyFromSource(local_path=self.local)
+      copy.assert_called_once_with(self.local, 'gs://foo/bar', acl=None)
+    self.assertEqual(osutils.ReadFile(self.local), self.DATA)
+
+  def testProducerFailure(self):
+    """Verify the upload is abandoned if a producer of the stream failed."""
+    with cros_build_lib.CommandPool() as pool:
+      producer = pool.RunCommand(['false'])
+      with PatchGS('Copy') as copy:
+        self.assertRaises(cros_build_lib.RunCommandError, self._CopyFromSource,
+                          local_path=self.local, producers=[producer])
+        self.assertFalse(copy.called)
+    self.assertFalse(os.path.exists(self.uploaded))
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
@@ -11,6 +11,7 @@ import os
 import shutil
 import cStringIO
 import tempfile
+import time
 from chromite.lib import cros_build_lib
 
 # Env vars that tempdir can be gotten from; minimally, this
@@ -161,6 +162,156 @@ def RmDir(path, ignore_missing=False, sudo=False):
         raise
 
 
+# The name of the directory RmDirInBackground moves trees into, at the top of
+# the part of each filesystem that we can write to.
+TRASH_DIR = '.chromite-trash'
+
+# Deletes the trash entries given after a '--', after removing the leftover
+# files given before it.  The pid of the deleter is recorded next to each
+# entry so that it isn't reclaimed by others meanwhile, and how long the
+# deletion took is recorded next to the first entry once it is done.
+_TRASH_DELETER = r"""
+while [ "$1" != -- ]; do rm -f -- "$1"; shift; done; shift
+for entry; do echo $$ > "$entry.pid"; done
+start=$(date +%s)
+rm -rf --one-file-system -- "$@"
+seconds=$(( $(date +%s) - start ))
+for entry; do rm -f -- "$entry.pid"; done
+echo $seconds > "$1.seconds"
+"""
+
+
+def _GetTrashDir(path, sudo=False):
+  """Returns the trash directory on the same filesystem as |path|.
+
+  This is the outermost directory above |path| on the same filesystem that
+  we can write to, so that all trees deleted on a filesystem share (and
+  reclaim) the same trash.
+  """
+  parent = os.path.dirname(os.path.abspath(path))
+  device = os.stat(parent).st_dev
+  top = parent
+  for directory in IteratePathParents(parent):
+    if os.stat(directory).st_dev != device:
+      break
+    if sudo or os.access(directory, os.W_OK | os.X_OK):
+      top = directory
+  return os.path.join(top, TRASH_DIR)
+
+
+def _IsPidAlive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
+
+
+def _FindReclaimableTrash(trash_dir):
+  """Find what's left in |trash_dir| that nobody is deleting.
+
+  Each entry is named after the pid of the process that moved it there; as
+  its deleter only records its own pid once it gets going, entries are left
+  alone while either of them lives.
+
+  Returns:
+    A tuple of the leftover bookkeeping files to remove, the trees left over
+    from earlier deleters that died, and the seconds that finished deleters
+    recorded saving.
+  """
+  names = set(os.listdir(trash_dir))
+  leftovers, entries, seconds = [], [], 0
+
+  def _IsBeingDeleted(name):
+    try:
+      return _IsPidAlive(int(ReadFile(os.path.join(trash_dir, name + '.pid'))))
+    except (EnvironmentError, ValueError):
+      return False
+
+  def _IsInUse(name):
+    parts = name.rsplit('.', 2)
+    if len(parts) == 3 and parts[1].isdigit() and _IsPidAlive(int(parts[1])):
+      return True
+    return _IsBeingDeleted(name)
+
+  for name in sorted(names):
+    path = os.path.join(trash_dir, name)
+    if name.endswith('.seconds'):
+      try:
+        seconds += int(ReadFile(path))
+      except (EnvironmentError, ValueError):
+        pass
+      leftovers.append(path)
+    elif name.endswith('.pid'):
+      if name[:-len('.pid')] not in names and not _IsBeingDeleted(
+          name[:-len('.pid')]):
+        leftovers.append(path)
+    elif not _IsInUse(name):
+      entries.append(path)
+  return leftovers, entries, seconds
+
+
+def RmDirInBackground(path, ignore_missing=False, sudo=False):
+  """Quickly remove a directory, deleting its contents in the background.
+
+  The tree is renamed into the trash directory of its filesystem, and
+  removed from there by a low priority background process, so that only the
+  rename is left on the critical path.  Trees left in the trash by earlier
+  deleters which died (e.g. in a crashed build) are removed along with it.
+  If the tree can't be renamed into the trash, it is removed synchronously.
+
+  Arguments:
+    path: The directory to remove.
+    ignore_missing: Do not error when path does not exist.
+    sudo: Remove directories as root.
+  """
+  if not os.path.lexists(path):
+    RmDir(path, ignore_missing=ignore_missing, sudo=sudo)
+    return
+
+  start = time.time()
+  try:
+    trash_dir = _GetTrashDir(path, sudo=sudo)
+    SafeMakedirs(trash_dir, sudo=sudo)
+    leftovers, entries, seconds = _FindReclaimableTrash(trash_dir)
+    entry = os.path.join(trash_dir, '%s.%d.%d' % (
+        os.path.basename(path.rstrip('/')), os.getpid(), time.time() * 1e6))
+    if sudo:
+      cros_build_lib.SudoRunCommand(['mv', '-T', '--', path, entry],
+                                    print_cmd=False, redirect_stderr=True)
+    else:
+      os.rename(path, entry)
+  except (EnvironmentError, cros_build_lib.RunCommandError) as e:
+    logging.debug('Failed moving %s to the trash; removing it now: %s',
+                  path, e)
+    RmDir(path, ignore_missing=ignore_missing, sudo=sudo)
+    return
+
+  cmd = ['nice', '-n', '19']
+  if Which('ionice'):
+    cmd = ['ionice', '-c', '3'] + cmd
+  if Which('setsid'):
+    cmd = ['setsid'] + cmd
+  cmd += ['sh', '-c', _TRASH_DELETER, 'trash-deleter'] + leftovers + ['--',
+                                                                     entry]
+  cmd += entries
+  # Leave the deleter running in the background, detached from our output.
+  cmd = ['sh', '-c', '"$@" </dev/null >/dev/null 2>&1 &', 'sh'] + cmd
+  if sudo:
+    cros_build_lib.SudoRunCommand(cmd, print_cmd=False)
+  else:
+    cros_build_lib.RunCommand(cmd, print_cmd=False)
+
+  logging.info('Moved %s to the trash in %.2fs; deleting it in the '
+               'background.', path, time.time() - start)
+  if entries:
+    logging.info('Also deleting %d trees left in %s by earlier runs.',
+                 len(entries), trash_dir)
+  if seconds:
+    logging.info('Earlier background deletions in %s took %ds off the '
+                 'critical path.', trash_dir, seconds)
+
+
 def Which(binary, path=None):
   """Return the absolute path to the specified binary.
 
@@ -8,6 +8,7 @@
 
 import os
 import sys
+import time
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
     os.path.abspath(__file__)))))
 
@@ -94,6 +95,64 @@ class TestOsutils(cros_test_lib.TempDirTestCase):
                       osutils.RmDir, subpath, sudo=True)
 
 
+class RmDirInBackgroundTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for deleting trees in the background."""
+
+  def setUp(self):
+    self.trash = os.path.join(self.tempdir, 'trash')
+    self.PatchObject(osutils, '_GetTrashDir', return_value=self.trash)
+
+  def _MakeTree(self, name):
+    path = os.path.join(self.tempdir, name)
+    osutils.WriteFile(os.path.join(path, 'a', 'b', 'file'), 'data',
+                      makedirs=True)
+    return path
+
+  def _WaitForTrash(self, expected):
+    """Wait for the trash to only hold files ending in |expected|."""
+    for _ in xrange(200):
+      suffixes = sorted(x.rsplit('.', 1)[-1] for x in os.listdir(self.trash))
+      if suffixes == expected:
+        return
+      time.sleep(0.05)
+    self.fail('Trash still holds %s' % os.listdir(self.trash))
+
+  def testRmDirInBackground(self):
+    """Test that trees are moved out of the way, and deleted later."""
+    path = self._MakeTree('tree')
+    osutils.RmDirInBackground(path)
+    self.assertFalse(os.path.exists(path))
+    self._WaitForTrash(['seconds'])
+
+    # The record of how long that took is cleaned up by the next deletion.
+    osutils.RmDirInBackground(self._MakeTree('tree'))
+    self._WaitForTrash(['seconds'])
+
+    self.assertRaises(EnvironmentError, osutils.RmDirInBackground, path)
+    osutils.RmDirInBackground(path, ignore_missing=True)
+
+  def testReclaimTrash(self):
+    """Test that trees left by dead deleters are reclaimed."""
+    osutils.SafeMakedirs(self.trash)
+    for name, pid in (('dead', 2 ** 22 + 1), ('live', os.getpid())):
+      osutils.SafeMakedirs(os.path.join(self.trash, name, 'subdir'))
+      osutils.WriteFile(os.path.join(self.trash, name + '.pid'), str(pid))
+    osutils.SafeMakedirs(os.path.join(self.trash, 'orphan'))
+    # Entries whose deleter hasn't started yet are named after their creator.
+    osutils.SafeMakedirs(os.path.join(self.trash, 'new.%d.1' % os.getpid()))
+    osutils.SafeMakedirs(os.path.join(self.trash, 'old.%d.2' % (2 ** 22 + 1)))
+
+    osutils.RmDirInBackground(self._MakeTree('tree'))
+    self._WaitForTrash(['1', 'live', 'pid', 'seconds'])
+
+  def testFallBack(self):
+    """Test that trees are deleted directly if they can't be moved."""
+    osutils.WriteFile(self.trash, 'not a directory')
+    path = self._MakeTree('tree')
+    osutils.RmDirInBackground(path)
+    self.assertFalse(os.path.exists(path))
+
+
 class IteratePathParentsTest(cros_test_lib.TestCase):
   """Test parent directory iteration functionality."""
 
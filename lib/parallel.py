@@ -14,9 +14,11 @@ import Queue
 import signal
 import sys
 import tempfile
+import time
 import traceback
 
 from chromite.buildbot import cbuildbot_results as results_lib
+from chromite.lib import cros_build_lib
 
 _PRINT_INTERVAL = 1
 _BUFSIZE = 1024
@@ -47,6 +49,9 @@ class _BackgroundSteps(multiprocessing.Process):
     self._queue = multiprocessing.Queue()
     self._semaphore = semaphore
     self._started = multiprocessing.Event()
+    self._output = None
+    self._pos = 0
+    self._result = None
 
   def AddStep(self, step):
     """Add a step to the list of steps to run in the background."""
@@ -70,45 +75,76 @@ class _BackgroundSteps(multiprocessing.Process):
 
     If an exception occurs, return a string containing the traceback.
     """
-    assert not self.Empty()
-    _step, output = self._steps.popleft()
+    while True:
+      done, error = self.PollStep(_PRINT_INTERVAL)
+      if done:
+        return error
+
+  def PollStep(self, timeout=0, print_output=True):
+    """Check whether the next step has completed.
+
+    Output from the step so far is printed, unless print_output is False, in
+    which case it is held back until a later call prints it. The results of
+    the step are propagated once all of its output has been printed, and the
+    following call moves on to the step after it.
+
+    Args:
+      timeout: How long to wait for the step to complete, in seconds.
+      print_output: Whether to print output from the step.
+
+    Returns:
+      A (done, error) tuple. done is True if the step has completed, and
+      error is a string containing the traceback if an exception occurred.
+    """
+    if self._output is None:
+      assert not self.Empty()
+      _step, output = self._steps.popleft()
+
+      # File position pointers are shared across processes, so we must open
+      # our own file descriptor to ensure output is not lost.
+      output_name = output.name
+      self._output = open(output_name, 'r')
+      os.unlink(output_name)
+      self._pos = 0
+
+    # Check whether the process is finished.
+    if self._result is None:
+      try:
+        self._result = self._queue.get(True, timeout)
+      except Queue.Empty:
+        pass
+
+    done = self._result is not None
+    error = self._result[0] if done else None
+    if not print_output:
+      return done, error
 
     # Flush stdout and stderr to be sure no output is interleaved.
     sys.stdout.flush()
     sys.stderr.flush()
 
-    # File position pointers are shared across processes, so we must open
-    # our own file descriptor to ensure output is not lost.
-    output_name = output.name
-    with open(output_name, 'r') as output:
-      os.unlink(output_name)
-      pos = 0
-      more_output = True
-      while more_output:
-        # Check whether the process is finished.
-        try:
-          error, results = self._queue.get(True, _PRINT_INTERVAL)
-          more_output = False
-        except Queue.Empty:
-          more_output = True
-
-        # Print output so far.
-        output.seek(pos)
-        buf = output.read(_BUFSIZE)
-        while len(buf) > 0:
-          sys.stdout.write(buf)
-          pos += len(buf)
-          if len(buf) < _BUFSIZE:
-            break
-          buf = output.read(_BUFSIZE)
-        sys.stdout.flush()
+    # Print output so far.
+    self._output.seek(self._pos)
+    buf = self._output.read(_BUFSIZE)
+    while len(buf) > 0:
+      sys.stdout.write(buf)
+      self._pos += len(buf)
+      if len(buf) < _BUFSIZE:
+        break
+      buf = self._output.read(_BUFSIZE)
+    sys.stdout.flush()
 
-    # Propagate any results.
-    for result in results:
-      results_lib.Results.Record(*result)
+    if done:
+      self._output.close()
+      self._output = None
+      _, results = self._result
+      self._result = None
 
-    # If a traceback occurred, return it.
-    return error
+      # Propagate any results.
+      for result in results:
+        results_lib.Results.Record(*result)
+
+    return done, error
 
   def Empty(self):
     """Return True if there are any steps left to run."""
@@ -157,8 +193,8 @@ class _BackgroundSteps(multiprocessing.Process):
       sys.stdout = os.fdopen(sys.__stdout__.fileno(), 'w', 0)
       sys.stderr = os.fdopen(sys.__stderr__.fileno(), 'w', 0)
       error = None
+      mark = results_lib.Results.Mark()
       try:
-        results_lib.Results.Clear()
         self._started.set()
         if not cancel:
           step()
@@ -177,7 +213,7 @@ class _BackgroundSteps(multiprocessing.Process):
       os.dup2(orig_stdout_fd, stdout_fileno)
       os.dup2(orig_stderr_fd, stderr_fileno)
       map(os.close, [orig_stdout_fd, orig_stderr_fd])
-      results = results_lib.Results.Get()
+      results = results_lib.Results.GetSince(mark)
       self._queue.put((error, results))
 
 
@@ -269,6 +305,192 @@ def RunParallelSteps(steps, max_parallel=None, halt_on_error=False):
     pass
 
 
+class _GraphStep(object):
+  """A step in a StepGraph, and its state while the graph runs."""
+
+  def __init__(self, name, step, inputs, outputs, cost, foreground):
+    self.name = name
+    self.step = step
+    self.inputs = frozenset(inputs)
+    self.outputs = frozenset(outputs)
+    self.cost = cost
+    self.foreground = foreground
+    self.bg = None
+    self.done = False
+
+
+class StepGraph(object):
+  """Run a graph of steps, each as soon as the steps it depends on are done.
+
+  Each step declares the inputs it needs and the outputs it produces, by
+  name. A step is started once every step producing one of its inputs has
+  completed successfully, so steps that do not depend on each other run
+  concurrently, as long as the total cost of the running steps stays within
+  the budget. Ready steps are started in the order they were added.
+
+  Background steps are run in their own processes, and their output is
+  printed in the order they were started, as if they were run in sequence.
+  Foreground steps are run in this process, one at a time, while background
+  steps proceed; use them for steps that update the state of this process
+  or that may call sys.exit().
+
+  If a background step fails, the steps that depend on it are not run, but
+  other steps carry on, and a BackgroundFailure is raised with the tracebacks
+  once they are done. If a foreground step fails, no further steps are
+  started, and its exception is re-raised once the running steps are done.
+
+  Example:
+    # Sync the source while the chroot is created, then build.
+    graph = StepGraph()
+    graph.AddStep('chroot', MakeChroot, outputs=['chroot'])
+    graph.AddStep('sync', SyncSource, outputs=['source'])
+    graph.AddStep('build', Build, inputs=['chroot', 'source'],
+                  foreground=True)
+    graph.Run()
+  """
+
+  def __init__(self, budget=None):
+    """Create a new StepGraph object.
+
+    Args:
+      budget: The total cost of the steps that may run at once. A step that
+        costs more than the budget is run on its own. Defaults to the number
+        of cpus.
+    """
+    self._budget = budget or multiprocessing.cpu_count()
+    self._steps = []
+
+  def AddStep(self, name, step, inputs=(), outputs=(), cost=1,
+              foreground=False):
+    """Add a step to the graph.
+
+    Args:
+      name: A unique name for the step.
+      step: The function to run.
+      inputs: Names of the outputs of other steps that this step needs.
+      outputs: Names of what this step produces.
+      cost: How much of the budget this step uses while it runs.
+      foreground: Whether to run the step in this process.
+    """
+    if name in [x.name for x in self._steps]:
+      raise ValueError('Step %s was already added' % name)
+    self._steps.append(_GraphStep(name, step, inputs, outputs,
+                                  min(cost, self._budget), foreground))
+
+  def _Validate(self):
+    """Check that every input is the output of exactly one step."""
+    producers = {}
+    for graph_step in self._steps:
+      for output in graph_step.outputs:
+        if output in producers:
+          raise ValueError('%s is produced by both %s and %s' %
+                           (output, producers[output], graph_step.name))
+        producers[output] = graph_step.name
+
+    for graph_step in self._steps:
+      missing = graph_step.inputs.difference(producers)
+      if missing:
+        raise ValueError('Nothing produces %s, needed by %s' %
+                         (', '.join(sorted(missing)), graph_step.name))
+
+  def Run(self):
+    """Run all of the steps, and wait for them to complete."""
+    self._Validate()
+    pending = list(self._steps)
+    running = collections.deque()
+    produced = set()
+    in_use = 0
+    blocked = set()
+    tracebacks = []
+    failure = None
+
+    try:
+      while pending or running:
+        if failure:
+          pending = []
+        self._SkipBlockedSteps(pending, blocked)
+
+        # Start the background steps that are ready, then run a foreground
+        # step while they proceed.
+        ready = [x for x in pending if produced.issuperset(x.inputs)]
+        ready.sort(key=lambda x: x.foreground)
+        for graph_step in ready:
+          if in_use + graph_step.cost > self._budget:
+            continue
+          pending.remove(graph_step)
+          in_use += graph_step.cost
+          if not graph_step.foreground:
+            graph_step.bg = _BackgroundSteps()
+            graph_step.bg.AddStep(graph_step.step)
+            graph_step.bg.start()
+            running.append(graph_step)
+            continue
+
+          try:
+            graph_step.step()
+          except BaseException:
+            failure = sys.exc_info()
+          else:
+            produced.update(graph_step.outputs)
+          in_use -= graph_step.cost
+          break
+        else:
+          if not running:
+            if pending:
+              raise ValueError('Steps %s can never run' %
+                               ', '.join(x.name for x in pending))
+            break
+
+          # Note which steps are done, so that the steps that depend on them
+          # can start, but print their output in order.
+          for graph_step in list(running)[1:]:
+            if not graph_step.done:
+              done, error = graph_step.bg.PollStep(print_output=False)
+              if done:
+                in_use -= self._StepDone(graph_step, error, produced,
+                                         blocked, tracebacks)
+
+          graph_step = running[0]
+          done, error = graph_step.bg.PollStep(_PRINT_INTERVAL)
+          if done:
+            running.popleft()
+            graph_step.bg.join()
+            if not graph_step.done:
+              in_use -= self._StepDone(graph_step, error, produced,
+                                       blocked, tracebacks)
+    finally:
+      for graph_step in running:
+        graph_step.bg.Kill()
+        graph_step.bg.join()
+
+    # Propagate any exceptions.
+    if failure:
+      raise failure[0], failure[1], failure[2]
+    if tracebacks:
+      raise BackgroundFailure('\n' + ''.join(tracebacks))
+
+  @staticmethod
+  def _StepDone(graph_step, error, produced, blocked, tracebacks):
+    """Record that a background step is done, and return its cost."""
+    graph_step.done = True
+    if error is None:
+      produced.update(graph_step.outputs)
+    else:
+      blocked.update(graph_step.outputs)
+      tracebacks.append(error)
+    return graph_step.cost
+
+  @staticmethod
+  def _SkipBlockedSteps(pending, blocked):
+    """Remove the steps that depend on a failed step from |pending|."""
+    skipped = True
+    while skipped:
+      skipped = [x for x in pending if x.inputs & blocked]
+      for graph_step in skipped:
+        pending.remove(graph_step)
+        blocked.update(graph_step.outputs)
+
+
 class _AllTasksComplete(object):
   """Sentinel object to indicate that all tasks are complete."""
 
@@ -364,6 +586,264 @@ def BackgroundTaskRunner(task, queue=None, processes=None, onexit=None):
         queue.put(_AllTasksComplete())
 
 
+class _TaskClass(object):
+  """The shared state of one class of tasks in a PriorityTaskRunner."""
+
+  def __init__(self, name, queue, task, size, max_parallel):
+    self.name = name
+    self.queue = queue
+    self.task = task
+    self.size = size
+    self.max_parallel = max_parallel
+    # These are shared between processes, and guarded by the runner's lock.
+    self.closing = multiprocessing.Value('b', False, lock=False)
+    self.closed = multiprocessing.Value('b', False, lock=False)
+    self.in_flight = multiprocessing.Value('i', 0, lock=False)
+    self.done = multiprocessing.Value('i', 0, lock=False)
+    self.failed = multiprocessing.Value('i', 0, lock=False)
+    self.total_size = multiprocessing.Value('d', 0, lock=False)
+    self.start = multiprocessing.Value('d', 0, lock=False)
+    # When the next task of the class may start, under the rate limit.
+    self.next_start = multiprocessing.Value('d', 0, lock=False)
+    self.tracebacks = multiprocessing.Queue()
+
+
+class PriorityTaskRunner(object):
+  """Run tasks from several queues in one pool of processes, by priority.
+
+  Each queue is a class of tasks with its own task function, and classes are
+  served in the order they were added: a worker that becomes free always
+  picks the next task from the first class that has one queued.  The pool
+  bounds how many tasks run at once over all classes, and a class may be
+  bounded further.  Optionally, tasks are also admitted at no more than a
+  given rate, in bytes per second of the inputs they handle.  The rate is
+  budgeted by priority too: each task counts against its own class and all
+  lower classes, but not higher ones, so lower classes use what higher ones
+  leave and never hold them back.  Tasks wait for the budget before they
+  take a process, not while holding one.
+
+  Example:
+    runner = PriorityTaskRunner(processes=8)
+    runner.AddQueue('urgent', urgent_queue, Upload, size=GetSize)
+    runner.AddQueue('rest', rest_queue, Upload, size=GetSize)
+    with runner:
+      ... put inputs on urgent_queue and rest_queue ...
+      runner.Close('urgent')
+      ... everything on urgent_queue has been uploaded ...
+    # Exiting the with statement will block until all tasks have completed.
+
+  When a class is closed, a summary of its tasks is logged; each task is
+  logged as it completes too.  As with BackgroundTaskRunner, the output of
+  the pool is printed when the with statement exits.
+  """
+
+  # How long to wait before checking the queues again when they are empty.
+  POLL_INTERVAL = 0.5
+
+  def __init__(self, processes=None, rate=None):
+    """Initialize.
+
+    Args:
+      processes: Number of processes to launch, and so how many tasks may run
+        at once.  Defaults to the number of cpus.
+      rate: If set, the maximum number of bytes per second to admit tasks at,
+        as measured by the size functions passed to AddQueue.
+    """
+    self._processes = processes or multiprocessing.cpu_count()
+    self._rate = rate
+    self._classes = []
+    self._lock = multiprocessing.Condition()
+    self._running = multiprocessing.Value('i', 0, lock=False)
+    self._steps = None
+
+  def AddQueue(self, name, queue, task, size=None, max_parallel=None):
+    """Add a class of tasks, at a lower priority than those already added.
+
+    Must be called before the runner is started.
+
+    Args:
+      name: The name of the class, for Close() and for logging.
+      queue: The queue to take the inputs of this class from.
+      task: Function to run with each queued input, as task(*input).
+      size: Function returning the size in bytes of each queued input, as
+        size(*input).  Inputs without a size are not rate limited.
+      max_parallel: The maximum number of tasks of this class to run at once.
+    """
+    assert self._steps is None, 'Queues must be added before starting.'
+    self._classes.append(_TaskClass(name, queue, task, size, max_parallel))
+
+  def _GetClass(self, name):
+    for task_class in self._classes:
+      if task_class.name == name:
+        return task_class
+    raise KeyError(name)
+
+  def _Next(self, classes):
+    """Take the next task to run from the first of |classes| that has one.
+
+    The lock must be held.
+
+    Returns:
+      A tuple (task_class, input, size), or (None, None, 0) if there is
+      nothing that can be run now.
+    """
+    if self._running.value >= self._processes:
+      return None, None, 0
+    now = time.time()
+    for task_class in classes:
+      if task_class.closed.value or (
+          task_class.max_parallel and
+          task_class.in_flight.value >= task_class.max_parallel):
+        continue
+      if self._rate and task_class.next_start.value > now:
+        continue
+      try:
+        x = task_class.queue.get_nowait()
+      except Queue.Empty:
+        continue
+      if isinstance(x, _AllTasksComplete):
+        task_class.closed.value = True
+        self._lock.notify_all()
+        continue
+      size = self._Charge(task_class, x, now)
+      if not task_class.start.value:
+        task_class.start.value = now
+      task_class.in_flight.value += 1
+      self._running.value += 1
+      return task_class, x, size
+    return None, None, 0
+
+  def _Charge(self, task_class, x, now):
+    """Count the input |x| of |task_class| against the rate budget.
+
+    The lock must be held.
+
+    Returns:
+      The size of |x| in bytes, or 0 if it has none.
+    """
+    size = 0
+    if task_class.size:
+      try:
+        size = task_class.size(*x)
+      except EnvironmentError:
+        pass
+    if self._rate and size:
+      index = self._classes.index(task_class)
+      for lower_class in self._classes[index:]:
+        lower_class.next_start.value = (
+            max(now, lower_class.next_start.value) + float(size) / self._rate)
+    return size
+
+  def _Wait(self, classes):
+    """Wait until one of |classes| may have a task to run.
+
+    The lock must be held.
+    """
+    timeout = self.POLL_INTERVAL
+    if self._rate:
+      now = time.time()
+      for task_class in classes:
+        if task_class.next_start.value > now:
+          timeout = min(timeout, task_class.next_start.value - now)
+    self._lock.wait(timeout)
+
+  def _RunTask(self, task_class, x, size):
+    """Run |task_class| with the input |x| of |size|, and record the outcome."""
+    start = time.time()
+    error = None
+    try:
+      task_class.task(*x)
+    except BaseException as e:
+      error = e
+      tb = traceback.format_exc()
+    elapsed = time.time() - start
+
+    with self._lock:
+      task_class.in_flight.value -= 1
+      self._running.value -= 1
+      task_class.done.value += 1
+      task_class.total_size.value += size
+      if error is not None:
+        task_class.failed.value += 1
+        task_class.tracebacks.put(tb)
+      self._lock.notify_all()
+
+    cros_build_lib.Info('%s: %s %s (%.1f MiB) in %.1fs', task_class.name,
+                        'failed' if error else 'finished',
+                        ' '.join(str(y) for y in x), size / 2.0 ** 20, elapsed)
+    if error is not None and not isinstance(error, Exception):
+      raise error
+
+  def _Worker(self):
+    """Run the queued tasks, until all classes are closed."""
+    while True:
+      with self._lock:
+        if all(x.closed.value for x in self._classes):
+          return
+        task_class, x, size = self._Next(self._classes)
+        if task_class is None:
+          self._Wait(self._classes)
+          continue
+      self._RunTask(task_class, x, size)
+
+  def Close(self, name):
+    """Wait for all the tasks queued in class |name| to complete.
+
+    No more tasks may be queued in the class afterwards.  While waiting, the
+    caller helps to run the tasks of the class, within the limits of the pool.
+
+    Raises:
+      BackgroundFailure if any of the tasks of the class failed.
+    """
+    task_class = self._GetClass(name)
+    with self._lock:
+      if task_class.closing.value:
+        return
+      task_class.closing.value = True
+    task_class.queue.put(_AllTasksComplete())
+
+    while True:
+      with self._lock:
+        if task_class.closed.value and not task_class.in_flight.value:
+          break
+        next_class, x, size = self._Next([task_class])
+        if next_class is None:
+          self._Wait([task_class])
+          continue
+      self._RunTask(next_class, x, size)
+
+    elapsed = time.time() - (task_class.start.value or time.time())
+    size = task_class.total_size.value / 2.0 ** 20
+    cros_build_lib.Info(
+        '%s: %d tasks done, %d failed; %.1f MiB in %.1fs (%.1f MiB/s)',
+        name, task_class.done.value, task_class.failed.value, size, elapsed,
+        size / elapsed if elapsed else 0)
+
+    if task_class.failed.value:
+      tracebacks = [task_class.tracebacks.get()
+                    for _ in xrange(task_class.failed.value)]
+      raise BackgroundFailure('\n' + ''.join(tracebacks))
+
+  def __enter__(self):
+    steps = [self._Worker] * self._processes
+    self._steps = _ParallelSteps(steps)
+    self._steps.__enter__()
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    failure = None
+    try:
+      for task_class in self._classes:
+        try:
+          self.Close(task_class.name)
+        except BackgroundFailure:
+          failure = failure or sys.exc_info()
+    finally:
+      self._steps.__exit__(exc_type, exc_value, tb)
+    if failure and exc_type is None:
+      raise failure[0], failure[1], failure[2]
+
+
 def RunTasksInProcessPool(task, inputs, processes=None, onexit=None):
   """Run the specified function with each supplied input in a pool of processes.
 
@@ -12,6 +12,7 @@ import time
 import Queue
 
 sys.path.insert(0, os.path.abspath('%s/../../..' % __file__))
+from chromite.buildbot import cbuildbot_results as results_lib
 from chromite.lib import cros_test_lib
 from chromite.lib import parallel
 from chromite.lib import partial_mock
@@ -246,5 +247,231 @@ class TestHalting(cros_test_lib.OutputTestCase, cros_test_lib.MockTestCase):
     self.assertFalse(self.failed.is_set())
 
 
+class TestStepGraph(cros_test_lib.OutputTestCase):
+  """Test running steps in dependency order with StepGraph."""
+
+  def setUp(self):
+    self.started = multiprocessing.Event()
+    self.ran = []
+
+  def _WaitForStart(self):
+    """Print 'a' once a concurrent step has started."""
+    if not self.started.wait(30):
+      raise Exception('Steps were not run concurrently')
+    sys.stdout.write('a')
+
+  def _Start(self):
+    self.started.set()
+    sys.stdout.write('b')
+
+  def _Fail(self):
+    raise Exception('failed')
+
+  def _Record(self, name):
+    self.ran.append(name)
+
+  def testConcurrentSteps(self):
+    """Verify independent steps overlap, and output is printed in order."""
+    graph = parallel.StepGraph(budget=2)
+    graph.AddStep('a', self._WaitForStart, outputs=['a'])
+    graph.AddStep('b', self._Start, outputs=['b'])
+    graph.AddStep('c', lambda: self._Record('c'), inputs=['a', 'b'],
+                  foreground=True)
+    with self.OutputCapturer() as capture:
+      graph.Run()
+    self.assertEqual(capture.GetStdout(), 'ab')
+    self.assertEqual(self.ran, ['c'])
+
+  def testDependencyOrder(self):
+    """Verify steps wait for their inputs, whatever order they were added."""
+    graph = parallel.StepGraph()
+    graph.AddStep('c', lambda: self._Record('c'), inputs=['b'],
+                  foreground=True)
+    graph.AddStep('b', lambda: self._Record('b'), inputs=['a'],
+                  outputs=['b'], foreground=True)
+    graph.AddStep('a', lambda: self._Record('a'), outputs=['a'],
+                  foreground=True)
+    graph.Run()
+    self.assertEqual(self.ran, ['a', 'b', 'c'])
+
+  def testBudget(self):
+    """Verify steps that do not fit in the budget are not run concurrently."""
+    self.started.set()
+    graph = parallel.StepGraph(budget=1)
+    graph.AddStep('a', self._WaitForStart, cost=1)
+    graph.AddStep('b', lambda: self.started.clear(), cost=5)
+    with self.OutputCapturer() as capture:
+      graph.Run()
+    self.assertEqual(capture.GetStdout(), 'a')
+
+  def testBackgroundFailure(self):
+    """Verify a failure skips the steps depending on it, and only those."""
+    graph = parallel.StepGraph(budget=2)
+    graph.AddStep('fail', self._Fail, outputs=['x'])
+    graph.AddStep('b', self._Start, outputs=['b'])
+    graph.AddStep('c', lambda: self._Record('c'), inputs=['x'],
+                  outputs=['c'], foreground=True)
+    graph.AddStep('d', lambda: self._Record('d'), inputs=['c'],
+                  foreground=True)
+    graph.AddStep('e', lambda: self._Record('e'), inputs=['b'],
+                  foreground=True)
+    with self.OutputCapturer() as capture:
+      self.assertRaises(parallel.BackgroundFailure, graph.Run)
+    self.assertEqual(capture.GetStdout(), 'b')
+    self.assertEqual(self.ran, ['e'])
+
+  def testForegroundFailure(self):
+    """Verify exceptions from foreground steps stop the graph."""
+    graph = parallel.StepGraph()
+    graph.AddStep('fail', self._Fail, foreground=True)
+    graph.AddStep('c', lambda: self._Record('c'), foreground=True)
+    self.assertRaises(Exception, graph.Run)
+    self.assertEqual(self.ran, [])
+
+  def testInvalidGraphs(self):
+    """Verify missing inputs and cycles are rejected."""
+    graph = parallel.StepGraph()
+    graph.AddStep('a', self._Fail, inputs=['missing'])
+    self.assertRaises(ValueError, graph.Run)
+    self.assertRaises(ValueError, graph.AddStep, 'a', self._Fail)
+
+    graph = parallel.StepGraph()
+    graph.AddStep('a', self._Fail, inputs=['b'], outputs=['a'])
+    graph.AddStep('b', self._Fail, inputs=['a'], outputs=['b'])
+    self.assertRaises(ValueError, graph.Run)
+
+  def testResumedResults(self):
+    """Verify background steps see, but don't send back, inherited results."""
+    def _Step():
+      record = results_lib.Results.PreviouslyCompletedRecord('Old')
+      results_lib.Results.Record('Old', results_lib.Results.SUCCESS, None,
+                                 float(record[2]))
+
+    results_lib.Results.Clear()
+    results_lib.Results.RestoreCompletedStages(
+        [results_lib.Results.SPLIT_TOKEN.join(['Old', 'None', '3'])])
+    results_lib.Results.Record('New', results_lib.Results.SUCCESS)
+    try:
+      graph = parallel.StepGraph()
+      graph.AddStep('old', _Step)
+      graph.Run()
+      self.assertEqual(results_lib.Results.Get(),
+                       [('New', results_lib.Results.SUCCESS, None, 0, None),
+                        ('Old', results_lib.Results.SUCCESS, None, 3.0, None)])
+    finally:
+      results_lib.Results.Clear()
+
+
+class TestPriorityTaskRunner(cros_test_lib.MockTestCase):
+  """Test running queued tasks by priority with PriorityTaskRunner."""
+
+  def setUp(self):
+    self.ran = []
+    self.lock = multiprocessing.Lock()
+    self.running = multiprocessing.Array('i', 3, lock=False)
+    self.peak = multiprocessing.Array('i', 3, lock=False)
+
+  def _Record(self, name):
+    self.ran.append(name)
+
+  def _Fail(self, name):
+    raise Exception('failed %s' % name)
+
+  def _Sleep(self, index):
+    """Count the tasks running at once in slots 0 (all) and |index|."""
+    with self.lock:
+      for i in (0, index):
+        self.running[i] += 1
+        self.peak[i] = max(self.peak[i], self.running[i])
+    time.sleep(0.05)
+    with self.lock:
+      for i in (0, index):
+        self.running[i] -= 1
+
+  def testPriority(self):
+    """Verify tasks of earlier classes are run first."""
+    runner = parallel.PriorityTaskRunner(processes=1)
+    queues = [Queue.Queue() for _ in range(2)]
+    runner.AddQueue('high', queues[0], self._Record)
+    runner.AddQueue('low', queues[1], self._Record)
+    for name in ('low1', 'high1', 'low2', 'high2'):
+      queues[name.startswith('low')].put([name])
+    for queue in queues:
+      queue.put(parallel._AllTasksComplete())
+    runner._Worker()
+    self.assertEqual(self.ran, ['high1', 'high2', 'low1', 'low2'])
+
+  def testConcurrency(self):
+    """Verify the pool and class limits are kept."""
+    runner = parallel.PriorityTaskRunner(processes=3)
+    queues = [multiprocessing.Queue() for _ in range(2)]
+    runner.AddQueue('one', queues[0], self._Sleep, max_parallel=1)
+    runner.AddQueue('many', queues[1], self._Sleep)
+    with runner:
+      for _ in range(4):
+        queues[0].put([1])
+        queues[1].put([2])
+      runner.Close('one')
+    self.assertEqual(self.peak[1], 1)
+    self.assertTrue(2 <= self.peak[0] <= 3)
+    self.assertTrue(self.peak[2] <= 3)
+
+  def testRate(self):
+    """Verify tasks are admitted at no more than the given rate."""
+    runner = parallel.PriorityTaskRunner(processes=1, rate=10000)
+    queue = Queue.Queue()
+    runner.AddQueue('sized', queue, self._Record, size=lambda _: 1000)
+    for i in range(4):
+      queue.put([i])
+    queue.put(parallel._AllTasksComplete())
+    start = time.time()
+    runner._Worker()
+    self.assertTrue(time.time() - start >= 0.3)
+    self.assertEqual(self.ran, range(4))
+
+  def testRatePriority(self):
+    """Verify the rate budget goes to higher classes first."""
+    runner = parallel.PriorityTaskRunner(processes=1, rate=1000)
+    queues = [Queue.Queue() for _ in range(2)]
+
+    def _QueueHigh(name):
+      self._Record(name)
+      queues[0].put(['high2'])
+      queues[0].put(parallel._AllTasksComplete())
+
+    def _RecordTime(name):
+      self._Record(name)
+      times.append(time.time())
+
+    times = []
+    runner.AddQueue('high', queues[0], _RecordTime, size=lambda _: 1000)
+    runner.AddQueue('low', queues[1], _QueueHigh, size=lambda _: 1000)
+
+    # Lower classes wait for the budget used by higher ones.
+    queues[0].put(['high1'])
+    queues[1].put(['low'])
+    queues[1].put(parallel._AllTasksComplete())
+    start = time.time()
+    runner._Worker()
+    self.assertEqual(self.ran, ['high1', 'low', 'high2'])
+
+    # But higher classes don't wait for the budget used by lower ones.
+    self.assertTrue(1.0 <= times[1] - start < 1.5)
+
+  def testFailure(self):
+    """Verify failures are raised when their own class is closed."""
+    self.StartPatcher(ParallelMock())
+    runner = parallel.PriorityTaskRunner(processes=2)
+    queues = [multiprocessing.Queue() for _ in range(2)]
+    runner.AddQueue('bad', queues[0], self._Fail)
+    runner.AddQueue('good', queues[1], self._Record)
+    with runner:
+      queues[0].put(['a'])
+      queues[1].put(['b'])
+      self.assertRaises(parallel.BackgroundFailure, runner.Close, 'bad')
+      runner.Close('good')
+    self.assertEqual(self.ran, ['b'])
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
@@ -4,6 +4,7 @@
 
 """Module that handles the processing of patches to the source tree."""
 
+import collections
 import logging
 import os
 import random
@@ -1165,6 +1166,85 @@ class GerritPatch(GitRepoPatch):
     return self.id == other.id
 
 
+def _PrefetchPatches(changes, max_parallel=None):
+  """Pull down the objects for |changes| with as few fetches as possible.
+
+  The changes are grouped by repository and url, and each group is pulled
+  down with a single multi-refspec fetch; the groups are fetched in
+  parallel.  Patches whose sha1 wasn't known are updated with what was
+  fetched.  This only makes the objects available; GitRepoPatch.Fetch is
+  what records the commit message and fetched state, and is where any
+  failure here is reported (since a single bad ref fails its whole group).
+
+  Args:
+    changes: A list of (patch, git_repo) pairs; see FetchPatches.
+    max_parallel: The maximum number of fetches to run at once.
+  """
+  # pylint: disable=W0212
+  groups = collections.OrderedDict()
+  for patch, git_repo in changes:
+    if not os.path.isdir(git_repo) or git_repo in patch._is_fetched:
+      continue
+    if (patch.sha1 is not None and
+        git.DoesCommitExistInRepo(git_repo, patch.sha1)):
+      continue
+    groups.setdefault((git_repo, patch.project_url), []).append(patch)
+
+  while groups:
+    # Each fetch rewrites FETCH_HEAD, so only fetch from one url at a time
+    # in a given repository.
+    wave = {}
+    for (git_repo, url), patches in groups.items():
+      if git_repo not in wave:
+        wave[git_repo] = (url, patches)
+        del groups[(git_repo, url)]
+
+    futures = {}
+    with cros_build_lib.CommandPool(max_parallel=max_parallel) as pool:
+      for git_repo, (url, patches) in wave.iteritems():
+        refs = list(collections.OrderedDict.fromkeys(p.ref for p in patches))
+        futures[git_repo] = refs, pool.RunCommand(
+            ['git', 'fetch', url] + refs, cwd=git_repo, print_cmd=False,
+            redirect_stdout=True, redirect_stderr=True, error_code_ok=True)
+
+    for git_repo, (refs, future) in futures.iteritems():
+      if future.result().returncode != 0:
+        continue
+      # FETCH_HEAD lists what was fetched in the order the refs were given.
+      fetch_head = os.path.join(git.GetGitBatch(git_repo).git_dir,
+                                'FETCH_HEAD')
+      with open(fetch_head) as f:
+        sha1s = [line.split('\t', 1)[0] for line in f.read().splitlines()]
+      if len(sha1s) != len(refs):
+        continue
+      fetched = dict(zip(refs, sha1s))
+      for patch in wave[git_repo][1]:
+        if patch.sha1 is None:
+          patch.sha1 = FormatSha1(fetched[patch.ref], strict=True)
+
+
+def FetchPatches(changes, max_parallel=None):
+  """Fetch many patches at once.
+
+  This has the same result as calling GitRepoPatch.Fetch on each of them,
+  but rather than a fetch per patch, patches from the same repository are
+  fetched together, and different repositories are fetched in parallel.
+
+  Args:
+    changes: A list of (patch, git_repo) pairs, giving the git repository
+      each patch should be fetched into.
+    max_parallel: The maximum number of fetches to run at once; see
+      cros_build_lib.CommandPool.
+
+  Returns:
+    A list of the sha1s of the patches.
+  """
+  changes = [(patch, os.path.normpath(git_repo))
+             for patch, git_repo in changes]
+  _PrefetchPatches(changes, max_parallel=max_parallel)
+  return [patch.Fetch(git_repo) for patch, git_repo in changes]
+
+
 def GeneratePatchesFromRepo(git_repo, project, tracking_branch, branch,
                             remote, allow_empty=False, starting_ref=None):
   if starting_ref is None:
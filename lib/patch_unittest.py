@@ -606,6 +606,65 @@ class TestGerritPatch(TestGitRepoPatch):
       self.assertEqual(patch.approval_timestamp, expected, msg)
 
 
+class TestFetchPatches(cros_test_lib.TempDirTestCase):
+  """Tests for fetching many patches at once."""
+
+  def setUp(self):
+    self.source = os.path.join(self.tempdir, 'source')
+    self.dest = os.path.join(self.tempdir, 'dest')
+    git.RunGit(self.tempdir, ['init', self.source])
+    git.RunGit(self.tempdir, ['init', self.dest])
+    self.sha1s = []
+    for i in xrange(3):
+      git.RunGit(self.source, ['-c', 'user.email=nobody@chromium.org',
+                               '-c', 'user.name=nobody', 'commit',
+                               '--allow-empty', '-m', 'commit %i' % i])
+      git.RunGit(self.source, ['update-ref', self._Ref(i), 'HEAD'])
+      self.sha1s.append(
+          git.RunGit(self.source, ['rev-parse', 'HEAD']).output.strip())
+
+  @staticmethod
+  def _Ref(i):
+    return gerrit.GetChangeRef(i + 1, 1)
+
+  def _MkPatch(self, i, sha1=None):
+    return cros_patch.GitRepoPatch(self.source, 'chromiumos/chromite',
+                                   self._Ref(i), 'origin/master',
+                                   constants.EXTERNAL_REMOTE, sha1=sha1)
+
+  def _ReadFetchHead(self):
+    return osutils.ReadFile(os.path.join(self.dest, '.git', 'FETCH_HEAD'))
+
+  def testGrouped(self):
+    """Verify patches are fetched with one fetch, and filled in."""
+    patches = [self._MkPatch(0), self._MkPatch(1),
+               self._MkPatch(2, sha1=self.sha1s[2])]
+    sha1s = cros_patch.FetchPatches([(p, self.dest) for p in patches])
+    self.assertEqual(sha1s, self.sha1s)
+    self.assertEqual(len(self._ReadFetchHead().splitlines()), 3)
+    for i, patch in enumerate(patches):
+      self.assertEqual(patch.sha1, self.sha1s[i])
+      self.assertEqual(patch.commit_message, 'commit %i' % i)
+      self.assertTrue(self.dest in patch._is_fetched)
+
+  def testAlreadyFetched(self):
+    """Verify objects which are already present aren't fetched again."""
+    patch = self._MkPatch(0)
+    patch.Fetch(self.dest)
+    fetch_head = self._ReadFetchHead()
+    cros_patch.FetchPatches(
+        [(patch, self.dest), (self._MkPatch(0, sha1=self.sha1s[0]), self.dest)])
+    self.assertEqual(self._ReadFetchHead(), fetch_head)
+
+  def testBadRef(self):
+    """Verify a bad ref fails just like fetching it by itself would."""
+    good, bad = self._MkPatch(0), self._MkPatch(3)
+    self.assertRaises(cros_build_lib.RunCommandError, cros_patch.FetchPatches,
+                      [(good, self.dest), (bad, self.dest)])
+    self.assertEqual(good.sha1, self.sha1s[0])
+    self.assertTrue(self.dest in good._is_fetched)
+
+
 class PrepareRemotePatchesTest(cros_test_lib.TestCase):
 
   def MkRemote(self,
@@ -0,0 +1,122 @@
+# Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Measure the resources used by this process and the processes it runs.
+
+Counters cover this process and every descendant it has reaped (waited for),
+which includes all commands run via cros_build_lib.RunCommand, and all
+background steps from lib/parallel once they are joined. Processes that are
+still running, or that belong to another process tree (such as a chroot
+server), are not counted.
+"""
+
+import resource
+
+from chromite.lib import osutils
+
+
+CPU_SECONDS = 'cpu-seconds'
+BUILD_PEAK_RSS_KIB = 'build-peak-rss-kib'
+DISK_READ_BYTES = 'disk-read-bytes'
+DISK_WRITE_BYTES = 'disk-write-bytes'
+NET_BYTES = 'net-bytes'
+
+PROC_IO = '/proc/self/io'
+PROC_NET_DEV = '/proc/self/net/dev'
+
+
+def _ReadProcIO():
+  """Returns the storage bytes (read, written) by this process tree."""
+  values = {}
+  for line in osutils.ReadFile(PROC_IO).splitlines():
+    key, _, value = line.partition(':')
+    values[key.strip()] = int(value)
+  return values['read_bytes'], values['write_bytes']
+
+
+def _ReadNetBytes():
+  """Returns the bytes received and sent over all non-loopback interfaces.
+
+  Network traffic is not accounted per process, so this covers the whole
+  network namespace, including any concurrent activity.
+  """
+  total = 0
+  # The first two lines are headers.
+  for line in osutils.ReadFile(PROC_NET_DEV).splitlines()[2:]:
+    interface, _, counters = line.partition(':')
+    if interface.strip() == 'lo':
+      continue
+    counters = counters.split()
+    # Received bytes are the first counter, and sent bytes the ninth.
+    total += int(counters[0]) + int(counters[8])
+  return total
+
+
+def Sample():
+  """Returns the resources used so far, as a dict.
+
+  Counters that cannot be read on this system are left out.
+  """
+  usage = {}
+  rusages = [resource.getrusage(x) for x in
+             (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+  usage[CPU_SECONDS] = sum(x.ru_utime + x.ru_stime for x in rusages)
+  usage[BUILD_PEAK_RSS_KIB] = max(x.ru_maxrss for x in rusages)
+
+  try:
+    usage[DISK_READ_BYTES], usage[DISK_WRITE_BYTES] = _ReadProcIO()
+  except (EnvironmentError, KeyError, ValueError):
+    pass
+
+  try:
+    usage[NET_BYTES] = _ReadNetBytes()
+  except (EnvironmentError, IndexError, ValueError):
+    pass
+
+  return usage
+
+
+def Since(start):
+  """Returns the resources used since |start| was returned by Sample().
+
+  The peak RSS can't be measured over an interval; it is the largest
+  resident set of this process or of any single reaped descendant over the
+  whole build so far, and is reported as such.
+  """
+  end = Sample()
+  usage = {}
+  for key, value in end.iteritems():
+    if key == BUILD_PEAK_RSS_KIB:
+      usage[key] = value
+    elif key in start:
+      usage[key] = value - start[key]
+  return usage
+
+
+def _FormatBytes(num):
+  """Returns |num| bytes in human readable form."""
+  for unit in ('B', 'KiB', 'MiB', 'GiB'):
+    if num < 1024:
+      break
+    num /= 1024.0
+  else:
+    unit = 'TiB'
+  return '%.1f %s' % (num, unit) if unit != 'B' else '%d B' % num
+
+
+def Format(usage):
+  """Returns a one line summary of |usage|, as returned by Since()."""
+  parts = []
+  if CPU_SECONDS in usage:
+    parts.append('cpu %.1fs' % usage[CPU_SECONDS])
+  if BUILD_PEAK_RSS_KIB in usage:
+    parts.append('build peak rss so far %s' %
+                 _FormatBytes(usage[BUILD_PEAK_RSS_KIB] * 1024))
+  if DISK_READ_BYTES in usage:
+    parts.append('disk read %s, written %s' % (
+        _FormatBytes(usage[DISK_READ_BYTES]),
+        _FormatBytes(usage[DISK_WRITE_BYTES])))
+  if NET_BYTES in usage:
+    parts.append('net %s' % _FormatBytes(usage[NET_BYTES]))
+  return ', '.join(parts)
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for resource_usage.py."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath('%s/../../..' % __file__))
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from chromite.lib import resource_usage
+
+
+_NET_DEV = """\
+Inter-|   Receive                         |  Transmit
+ face |bytes packets errs drop fifo frame compressed multicast|bytes ...
+    lo: 1000 10 0 0 0 0 0 0 1000 10 0 0 0 0 0 0
+  eth0: 2000 20 0 0 0 0 0 0 3000 30 0 0 0 0 0 0
+  eth1:  500  5 0 0 0 0 0 0  100  1 0 0 0 0 0 0
+"""
+
+
+class ResourceUsageTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for sampling resource usage."""
+
+  def testNetBytes(self):
+    """Verify traffic is summed over all interfaces but loopback."""
+    net_dev = os.path.join(self.tempdir, 'dev')
+    osutils.WriteFile(net_dev, _NET_DEV)
+    self.PatchObject(resource_usage, 'PROC_NET_DEV', new=net_dev)
+    self.assertEqual(resource_usage._ReadNetBytes(), 5600)
+
+  def testMissingCounters(self):
+    """Verify counters that can't be read are left out."""
+    missing = os.path.join(self.tempdir, 'missing')
+    self.PatchObject(resource_usage, 'PROC_IO', new=missing)
+    self.PatchObject(resource_usage, 'PROC_NET_DEV', new=missing)
+    usage = resource_usage.Since(resource_usage.Sample())
+    self.assertEqual(sorted(usage), sorted([resource_usage.CPU_SECONDS,
+                                            resource_usage.BUILD_PEAK_RSS_KIB]))
+
+  def testChildProcesses(self):
+    """Verify the resources used by reaped children are counted."""
+    start = resource_usage.Sample()
+    cros_build_lib.RunCommand(
+        ['sh', '-c', 'i=0; while [ $i -lt 100000 ]; do i=$((i+1)); done'])
+    usage = resource_usage.Since(start)
+    self.assertTrue(usage[resource_usage.CPU_SECONDS] > 0)
+    self.assertTrue(usage[resource_usage.BUILD_PEAK_RSS_KIB] > 0)
+    for key in (resource_usage.DISK_READ_BYTES,
+                resource_usage.DISK_WRITE_BYTES):
+      if key in start:
+        self.assertTrue(usage[key] >= 0)
+
+  def testFormat(self):
+    """Verify the summary is human readable."""
+    usage = {
+        resource_usage.CPU_SECONDS: 61.25,
+        resource_usage.BUILD_PEAK_RSS_KIB: 2 * 1024 ** 2,
+        resource_usage.DISK_READ_BYTES: 512,
+        resource_usage.DISK_WRITE_BYTES: 3 * 1024 ** 3,
+        resource_usage.NET_BYTES: 1536,
+    }
+    self.assertEqual(resource_usage.Format(usage),
+                     'cpu 61.2s, build peak rss so far 2.0 GiB, disk read '
+                     '512 B, written 3.0 GiB, net 1.5 KiB')
+    self.assertEqual(resource_usage.Format({}), '')
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -12,6 +12,7 @@ full and pre-flight-queue builds.
 
 import distutils.version
 import errno
+import functools
 import glob
 import logging
 import optparse
@@ -31,6 +32,7 @@ from chromite.buildbot import tee
 from chromite.buildbot import trybot_patch_pool
 
 from chromite.lib import cgroups
+from chromite.lib import chroot_server
 from chromite.lib import cleanup
 from chromite.lib import commandline
 from chromite.lib import cros_build_lib
@@ -47,6 +49,7 @@ cros_build_lib.STRICT_SUDO = True
 
 _DEFAULT_LOG_DIR = 'cbuildbot_logs'
 _BUILDBOT_LOG_FILE = 'cbuildbot.log'
+_COMMAND_STATS_FILE = 'runcommand_stats.json'
 _DEFAULT_EXT_BUILDROOT = 'trybot'
 _DEFAULT_INT_BUILDROOT = 'trybot-internal'
 _DISTRIBUTED_TYPES = [constants.COMMIT_QUEUE_TYPE, constants.PFQ_TYPE,
@@ -155,6 +158,7 @@ class Builder(object):
     self.archive_urls = {}
     self.release_tag = None
     self.patch_pool = trybot_patch_pool.TrybotPatchPool()
+    self.chroot_server = None
 
     bs.BuilderStage.SetManifestBranch(self.options.branch)
 
@@ -188,6 +192,22 @@ class Builder(object):
     stage_instance = self._GetStageInstance(stage, *args, **kwargs)
     return stage_instance.Run()
 
+  def _StartChrootServer(self):
+    """Route later enter_chroot commands through a chroot server.
+
+    Must be run after the chroot has been created.  The server is stopped
+    when the build finishes.
+    """
+    if not self.options.chroot_server or self.chroot_server:
+      return
+    chroot = os.path.join(self.options.buildroot, constants.DEFAULT_CHROOT_DIR)
+    self.chroot_server = chroot_server.ChrootServer(chroot)
+    try:
+      self.chroot_server.Start()
+    except chroot_server.ChrootServerError as e:
+      cros_build_lib.Warning('Not using a chroot server: %s', e)
+      self.chroot_server = None
+
   def GetSyncInstance(self):
     """Returns an instance of a SyncStage that should be run.
 
@@ -320,6 +340,8 @@ class Builder(object):
       exception_thrown = True
       raise
     finally:
+      if self.chroot_server:
+        self.chroot_server.Stop()
       if print_report:
         results_lib.WriteCheckpoint(self.options.buildroot)
         print '\n\n\n@@@BUILD_STEP Report@@@\n'
@@ -392,11 +414,6 @@ class SimpleBuilder(Builder):
       self._RunStage(stages.BuildBoardStage)
       self._RunStage(stages.RefreshPackageStatusStage)
     else:
-      self._RunStage(stages.BuildBoardStage)
-      self._RunStage(stages.UprevStage)
-      self._RunStage(stages.SyncChromeStage)
-      self._RunStage(stages.PatchChromeStage)
-
       configs = self.build_config['board_specific_configs']
       for board in self.build_config['boards']:
         config = configs.get(board, self.build_config)
@@ -404,20 +421,63 @@ class SimpleBuilder(Builder):
                                                config=config)
         self.archive_stages[board] = archive_stage
 
-      # Set up a process pool to run test/archive stages in the background.
-      # This process runs task(board) for each board added to the queue.
-      task = self._RunBackgroundStagesForBoard
-      with parallel.BackgroundTaskRunner(task) as queue:
-        for board in self.build_config['boards']:
-          # Run BuildTarget in the foreground.
-          archive_stage = self.archive_stages[board]
-          config = configs.get(board, self.build_config)
-          self._RunStage(stages.BuildTargetStage, board, archive_stage,
-                         self.release_tag, config=config)
-          self.archive_urls[board] = archive_stage.GetDownloadUrl()
+      self._GetStageGraph().Run()
 
-          # Kick off task(board) in the background.
-          queue.put([board])
+  def _RunBuildTargetStage(self, board):
+    """Build the specified board, and note where its artifacts will be."""
+    archive_stage = self.archive_stages[board]
+    configs = self.build_config['board_specific_configs']
+    config = configs.get(board, self.build_config)
+    self._RunStage(stages.BuildTargetStage, board, archive_stage,
+                   self.release_tag, config=config)
+    self.archive_urls[board] = archive_stage.GetDownloadUrl()
+
+  def _GetStageGraph(self):
+    """Returns a StepGraph of the stages that build and test the boards.
+
+    Each stage waits only for the stages producing what it needs, so e.g.
+    Chrome can be synced while the chroot and boards are being set up.
+    Stages that may exit early, or that update the state of this builder,
+    run in the foreground.
+    """
+    graph = parallel.StepGraph()
+    graph.AddStep('BuildBoard',
+                  functools.partial(self._RunStage, stages.BuildBoardStage),
+                  outputs=['chroot', 'boards'])
+    graph.AddStep('ChrootServer', self._StartChrootServer, inputs=['chroot'],
+                  outputs=['chroot_server'], cost=0, foreground=True)
+    graph.AddStep('Uprev', functools.partial(self._RunStage, stages.UprevStage),
+                  inputs=['chroot_server', 'boards'], outputs=['uprev'],
+                  foreground=True)
+
+    # Chrome is synced to the version of the uprevved ebuild, unless the
+    # version to build is given explicitly.
+    chrome_inputs = ['uprev']
+    chrome_rev = self.options.chrome_rev or self.build_config['chrome_rev']
+    if chrome_rev == constants.CHROME_REV_SPEC:
+      chrome_inputs = []
+    graph.AddStep('SyncChrome',
+                  functools.partial(self._RunStage, stages.SyncChromeStage),
+                  inputs=chrome_inputs, outputs=['chrome_source'],
+                  foreground=True)
+    graph.AddStep('PatchChrome',
+                  functools.partial(self._RunStage, stages.PatchChromeStage),
+                  inputs=['chrome_source'], outputs=['chrome'])
+
+    # Boards are built one at a time, each one's test/archive stages running
+    # in the background while the next board builds.
+    built = []
+    for board in self.build_config['boards']:
+      graph.AddStep('BuildTarget:%s' % board,
+                    functools.partial(self._RunBuildTargetStage, board),
+                    inputs=['uprev', 'chrome'] + built[-1:],
+                    outputs=['built:%s' % board], foreground=True)
+      built.append('built:%s' % board)
+      graph.AddStep('Background:%s' % board,
+                    functools.partial(self._RunBackgroundStagesForBoard, board),
+                    inputs=built[-1:])
+
+    return graph
 
 
 class DistributedBuilder(SimpleBuilder):
@@ -832,6 +892,11 @@ def _CreateParser():
                           callback=_CheckChromeVersionOption,
                           help='Used with SPEC logic to force a particular SVN '
                                'revision of chrome rather than the latest.')
+  group.add_remote_option('--chroot-server', action='store_true',
+                          dest='chroot_server', default=False,
+                          help='Once the chroot is set up, run commands in it '
+                               'through a persistent server rather than '
+                               'entering it via cros_sdk each time.')
   group.add_remote_option('--clobber', action='store_true', dest='clobber',
                           default=False,
                           help='Clears an old checkout before syncing')
@@ -859,6 +924,11 @@ def _CreateParser():
   group.add_remote_option('--nocgroups', action='store_false', dest='cgroups',
                           default=True,
                           help='Disable cbuildbots usage of cgroups.')
+  group.add_remote_option('--noimage-cache', action='store_false',
+                          dest='image_cache', default=True,
+                          help="Always rebuild images and payloads, rather "
+                               "than reusing those cached from an earlier "
+                               "build with the same inputs.")
   group.add_remote_option('--noprebuilts', action='store_false',
                           dest='prebuilts', default=True,
                           help="Don't upload prebuilts.")
@@ -891,6 +961,10 @@ def _CreateParser():
                    default=False,
                    help='Submit a tryjob to the test repository.  Will not '
                         'show up on the production trybot waterfall.')
+  group.add_remote_option('--upload-bandwidth', type='float', default=None,
+                          help='The maximum rate, in MiB/s, at which to '
+                               'upload build artifacts.  Unlimited by '
+                               'default.')
   group.add_remote_option('--validation_pool', default=None,
                           help='Path to a pickled validation pool. Intended '
                                'for use only with the commit queue.')
@@ -964,6 +1038,11 @@ def _CreateParser():
   group.add_option('--notee', action='store_false', dest='tee', default=True,
                     help="Disable logging and internal tee process.  Primarily "
                          "used for debugging cbuildbot itself.")
+  group.add_option('--command-stats', action='store_true',
+                    dest='command_stats', default=False,
+                    help='Record the resources used by every command run '
+                         'into %s in the log dir; summarize it with '
+                         'summarize_runcommand_stats.' % _COMMAND_STATS_FILE)
   return parser
 
 
@@ -1251,6 +1330,12 @@ def main(argv):
     osutils.SafeMakedirs(options.log_dir)
     _BackupPreviousLog(log_file)
 
+  if options.command_stats:
+    stats_file = os.path.join(options.log_dir, _COMMAND_STATS_FILE)
+    osutils.SafeMakedirs(options.log_dir)
+    _BackupPreviousLog(stats_file)
+    os.environ[constants.RUNCOMMAND_STATS_ENVVAR] = stats_file
+
   with cros_build_lib.ContextManagerStack() as stack:
     critical_section = stack.Add(cleanup.EnforcedCleanupSection)
     stack.Add(sudo.SudoKeepAlive)
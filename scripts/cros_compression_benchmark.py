@@ -0,0 +1,119 @@
+#!/usr/bin/python2
+
+# Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Report the throughput and ratio of each compression profile on a tree.
+
+Tars up the given directory once per compressor and profile, the same way
+cros_build_lib.CreateTarball does for build artifacts, so the tradeoffs can
+be compared on the machine (and with the compressors) that will be used.
+"""
+
+import os
+import time
+
+from chromite.lib import commandline
+from chromite.lib import cros_build_lib
+from chromite.lib import osutils
+
+
+COMPRESSIONS = {
+    'gzip': cros_build_lib.COMP_GZIP,
+    'bzip2': cros_build_lib.COMP_BZIP2,
+    'xz': cros_build_lib.COMP_XZ,
+}
+
+
+class Result(object):
+  """The outcome of compressing the tree one way."""
+
+  def __init__(self, compressor, profile, raw_size, size, seconds):
+    self.compressor = compressor
+    self.profile = profile
+    self.raw_size = raw_size
+    self.size = size
+    self.seconds = seconds
+
+  @property
+  def throughput(self):
+    """The uncompressed MiB/s processed."""
+    return self.raw_size / 1024.0 ** 2 / max(self.seconds, 1e-6)
+
+  @property
+  def ratio(self):
+    return float(self.raw_size) / max(self.size, 1)
+
+
+def Benchmark(path, compressions, profiles, tempdir, chroot=None):
+  """Compress |path| with each of |compressions| and |profiles|.
+
+  Args:
+    path: The directory to tar up.
+    compressions: A list of cros_build_lib.COMP_* types.
+    profiles: A list of cros_build_lib.COMP_PROFILES.
+    tempdir: Where to write the tarballs.
+    chroot: See cros_build_lib.FindCompressor().
+
+  Returns:
+    A list of Result objects.
+  """
+  # An uncompressed pass gives the raw size, and warms the page cache so the
+  # first compressor isn't penalized for reading the tree from disk.
+  target = os.path.join(tempdir, 'bench.tar')
+  cros_build_lib.CreateTarball(target, path,
+                               compression=cros_build_lib.COMP_NONE)
+  raw_size = os.path.getsize(target)
+
+  results = []
+  for compression in compressions:
+    for profile in profiles:
+      cmd = cros_build_lib.GetCompressorCommand(compression, chroot=chroot,
+                                                profile=profile)
+      start = time.time()
+      cros_build_lib.CreateTarball(target, path, compression=compression,
+                                   chroot=chroot, profile=profile)
+      seconds = time.time() - start
+      results.append(Result(' '.join(cmd), profile, raw_size,
+                            os.path.getsize(target), seconds))
+  osutils.SafeUnlink(target)
+  return results
+
+
+def _GetParser():
+  """Returns the parser to use for this module."""
+  parser = commandline.ArgumentParser(description=__doc__)
+  parser.add_argument('path', type='path',
+                      help='The sample tree to compress.')
+  parser.add_argument('--compression', action='append',
+                      choices=sorted(COMPRESSIONS),
+                      help='Compressions to try; may be repeated.  Defaults '
+                           'to all of them.')
+  parser.add_argument('--profile', action='append',
+                      choices=cros_build_lib.COMP_PROFILES,
+                      help='Profiles to try; may be repeated.  Defaults to '
+                           'all of them.')
+  parser.add_argument('--chroot', type='path',
+                      help='Prefer the compressors in this chroot, as '
+                           'cbuildbot does.')
+  return parser
+
+
+def main(argv):
+  options = _GetParser().parse_args(argv)
+  if not os.path.isdir(options.path):
+    cros_build_lib.Die('%s is not a directory', options.path)
+
+  compressions = [COMPRESSIONS[x] for x in
+                  options.compression or sorted(COMPRESSIONS)]
+  profiles = options.profile or cros_build_lib.COMP_PROFILES
+  with osutils.TempDirContextManager() as tempdir:
+    results = Benchmark(options.path, compressions, profiles, tempdir,
+                        chroot=options.chroot)
+
+  print '%-8s %9s %8s %7s  %s' % ('profile', 'MiB/s', 'secs', 'ratio',
+                                  'compressor')
+  for r in results:
+    print '%-8s %9.1f %8.2f %7.2f  %s' % (r.profile, r.throughput, r.seconds,
+                                          r.ratio, r.compressor)
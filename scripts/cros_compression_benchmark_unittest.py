@@ -0,0 +1,55 @@
+#!/usr/bin/python2
+
+# Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the cros_compression_benchmark program."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+
+from chromite.scripts import cros_compression_benchmark as benchmark
+
+
+class BenchmarkTest(cros_test_lib.TempDirTestCase):
+
+  def setUp(self):
+    self.src = os.path.join(self.tempdir, 'src')
+    osutils.WriteFile(os.path.join(self.src, 'foo.txt'), 'foo\n' * 10000,
+                      makedirs=True)
+
+  def testBenchmark(self):
+    """Verify every compression/profile pair is measured."""
+    out = os.path.join(self.tempdir, 'out')
+    osutils.SafeMakedirs(out)
+    results = benchmark.Benchmark(
+        self.src, [cros_build_lib.COMP_GZIP],
+        [cros_build_lib.COMP_PROFILE_FAST, cros_build_lib.COMP_PROFILE_BEST],
+        out)
+    self.assertEqual([r.profile for r in results],
+                     [cros_build_lib.COMP_PROFILE_FAST,
+                      cros_build_lib.COMP_PROFILE_BEST])
+    for r in results:
+      self.assertTrue(r.ratio > 10)
+      self.assertTrue(r.throughput > 0)
+    self.assertEqual(os.listdir(out), [])
+
+  def testMain(self):
+    """Verify the report can be produced."""
+    with cros_test_lib.OutputCapturer() as output:
+      benchmark.main([self.src, '--compression', 'gzip'])
+    stdout = output.GetStdout()
+    for profile in cros_build_lib.COMP_PROFILES:
+      self.assertTrue(profile in stdout)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
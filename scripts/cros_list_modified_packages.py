@@ -23,17 +23,14 @@ Some caveats:
 
 import errno
 import logging
-import multiprocessing
 import optparse
 import os
-import Queue
 
 from chromite.buildbot import constants
 from chromite.buildbot import portage_utilities
 from chromite.lib import cros_build_lib
 from chromite.lib import git
 from chromite.lib import osutils
-from chromite.lib import parallel
 
 
 class WorkonProjectsMonitor(object):
@@ -41,8 +38,6 @@ class WorkonProjectsMonitor(object):
 
   Members:
     _tasks: A list of the (project, path) pairs to check.
-    _result_queue: A queue. When GetProjectModificationTimes is called,
-      (project, mtime) tuples are pushed onto the end of this queue.
   """
 
   def __init__(self, projects):
@@ -54,28 +49,21 @@ class WorkonProjectsMonitor(object):
     manifest = git.ManifestCheckout.Cached(constants.SOURCE_ROOT)
     self._tasks = [(name, manifest.GetProjectPath(name, True))
                    for name in set(projects).intersection(manifest.projects)]
-    self._result_queue = multiprocessing.Queue(len(self._tasks))
 
-  def _EnqueueProjectModificationTime(self, project, path):
-    """Calculate the last time that this project was modified, and enqueue it.
-
-    Args:
-      project: The project to look at.
-      path: The path associated with the specified project.
-    """
-    if os.path.isdir(path):
-      self._result_queue.put((project, self._LastModificationTime(path)))
-
-  def _LastModificationTime(self, path):
-    """Calculate the last time a directory subtree was modified.
+  @staticmethod
+  def _LastModificationTime(pool, path):
+    """Start calculating the last time a directory subtree was modified.
 
     Args:
+      pool: The CommandPool to run the calculation in.
       path: Directory to look at.
+
+    Returns:
+      A CommandFuture whose output is the modification time.
     """
     cmd = 'find . -name .git -prune -o -printf "%T@\n" | sort -nr | head -n1'
-    ret = cros_build_lib.RunCommandCaptureOutput(cmd, cwd=path, shell=True,
-                                                 print_cmd=False)
-    return float(ret.output) if ret.output else 0
+    return pool.RunCommand(cmd, cwd=path, shell=True, print_cmd=False,
+                           redirect_stdout=True, redirect_stderr=True)
 
   def GetProjectModificationTimes(self):
     """Get the last modification time of each specified project.
@@ -83,19 +71,17 @@ class WorkonProjectsMonitor(object):
     Returns:
       A dictionary mapping project names to last modification times.
     """
-    task = self._EnqueueProjectModificationTime
-    parallel.RunTasksInProcessPool(task, self._tasks)
+    futures = {}
+    with cros_build_lib.CommandPool() as pool:
+      for project, path in self._tasks:
+        if os.path.isdir(path):
+          futures[project] = self._LastModificationTime(pool, path)
 
     # Create a dictionary mapping project names to last modification times.
-    # All of the workon projects are already stored in the queue, so we can
-    # retrieve them all without waiting any longer.
     mtimes = {}
-    while True:
-      try:
-        project, mtime = self._result_queue.get_nowait()
-      except Queue.Empty:
-        break
-      mtimes[project] = mtime
+    for project, future in futures.iteritems():
+      output = future.result().output
+      mtimes[project] = float(output) if output else 0
     return mtimes
 
 
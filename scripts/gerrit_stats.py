@@ -100,7 +100,7 @@ def main(argv):
     print "  %s: %i" % (status, value)
 
   # Get approval stats.
-  requested = helper.Query(
+  requested = helper.QueryIter(
       "( %s  AND NOT ( %s ) ) AND -age:%s" % (" OR ".join(reviewers),
                                               " OR ".join(owners), opts.age),
       current_patch=False, options=("--all-approvals",))
@@ -125,14 +125,14 @@ def main(argv):
 
   # Find comments; gerrit doesn't give that information in --all-approvals
   # unfortunately.
-  comments = helper.Query(
+  comments = helper.QueryIter(
       "( %s AND NOT ( %s ) ) AND -age:%s" % (" OR ".join(reviewers),
                                              " OR ".join(owners), opts.age),
       options=("--comments", "--patch-sets"), raw=True, current_patch=False)
-  requested_review = len(comments)
 
-  commented_changes = total_comments = 0
+  requested_review = commented_changes = total_comments = 0
   for change in comments:
+    requested_review += 1
     touched = False
     for comment in change.get("comments", ()):
       if comment["reviewer"].get("email", None) in targets:
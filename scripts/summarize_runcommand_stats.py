@@ -0,0 +1,132 @@
+#!/usr/bin/python2
+
+# Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Summarize which commands consumed the most time during a build.
+
+Reads the command stats log written by cros_build_lib.RunCommand when
+CROS_RUNCOMMAND_STATS is set (cbuildbot does this for --command-stats), and
+ranks the commands by their total or 95th percentile wall time.
+"""
+
+import json
+import logging
+import math
+
+from chromite.lib import commandline
+
+
+# The keys commands can be ranked by.
+SORT_KEYS = ('total', 'p95', 'cpu', 'count')
+
+
+class CommandStats(object):
+  """Aggregated stats for one kind of command."""
+
+  def __init__(self, key):
+    self.key = key
+    self.walls = []
+    self.cpu = 0.0
+    self.maxrss_kb = 0
+    self.failures = 0
+    self.output_bytes = 0
+
+  def Add(self, record):
+    """Fold the stats |record| into this object."""
+    self.walls.append(record['wall'])
+    self.cpu += record.get('utime', 0) + record.get('stime', 0)
+    self.maxrss_kb = max(self.maxrss_kb, record.get('maxrss_kb', 0))
+    self.output_bytes += record['stdout_bytes'] + record['stderr_bytes']
+    if record['returncode']:
+      self.failures += 1
+
+  @property
+  def count(self):
+    return len(self.walls)
+
+  @property
+  def total(self):
+    return sum(self.walls)
+
+  @property
+  def p95(self):
+    return Percentile(self.walls, 95)
+
+
+def Percentile(values, percent):
+  """Returns the |percent|th percentile of |values| (nearest-rank method)."""
+  if not values:
+    return 0.0
+  values = sorted(values)
+  rank = int(math.ceil(percent / 100.0 * len(values)))
+  return values[min(max(rank, 1), len(values)) - 1]
+
+
+def LoadRecords(path):
+  """Yield the records in the stats log at |path|, skipping corrupt lines."""
+  with open(path) as f:
+    for lineno, line in enumerate(f, 1):
+      try:
+        yield json.loads(line)
+      except ValueError:
+        logging.warning('%s:%i: skipping corrupt record', path, lineno)
+
+
+def Summarize(records, depth=2):
+  """Group |records| by the first |depth| words of their normalized argv.
+
+  Returns:
+    A dict mapping the group name to a CommandStats.
+  """
+  stats = {}
+  for record in records:
+    key = ' '.join(record['argv'][:depth])
+    if key not in stats:
+      stats[key] = CommandStats(key)
+    stats[key].Add(record)
+  return stats
+
+
+def _GetParser():
+  """Returns the parser to use for this module."""
+  parser = commandline.ArgumentParser(description=__doc__)
+  parser.add_argument('logs', nargs='+', type='path',
+                      help='Command stats logs to summarize.')
+  parser.add_argument('--depth', type=int, default=2,
+                      help='How many words of each command to group by; '
+                           'e.g. 2 groups "git fetch" separately from '
+                           '"git push".  Defaults to %(default)s.')
+  parser.add_argument('--sort', choices=SORT_KEYS, default='total',
+                      help='What to rank the commands by.  Defaults to '
+                           '%(default)s.')
+  parser.add_argument('--limit', type=int, default=25,
+                      help='How many commands to show; 0 shows all.  '
+                           'Defaults to %(default)s.')
+  return parser
+
+
+def main(argv):
+  options = _GetParser().parse_args(argv)
+
+  records = []
+  for path in options.logs:
+    records.extend(LoadRecords(path))
+  stats = Summarize(records, depth=options.depth)
+
+  ranked = sorted(stats.itervalues(), reverse=True,
+                  key=lambda x: getattr(x, options.sort))
+  if options.limit:
+    ranked = ranked[:options.limit]
+
+  total_wall = sum(x.total for x in stats.itervalues())
+  print '%i commands, %.1fs total wall time' % (len(records), total_wall)
+  print '%10s %6s %7s %9s %9s %10s %10s %5s  %s' % (
+      'total(s)', '%', 'count', 'p95(s)', 'cpu(s)', 'maxrss(MB)', 'output(MB)',
+      'fail', 'command')
+  for x in ranked:
+    print '%10.1f %6.1f %7i %9.2f %9.1f %10.1f %10.1f %5i  %s' % (
+        x.total, 100.0 * x.total / total_wall if total_wall else 0, x.count,
+        x.p95, x.cpu, x.maxrss_kb / 1024.0, x.output_bytes / 1024.0 ** 2,
+        x.failures, x.key)
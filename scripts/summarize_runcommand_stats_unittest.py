@@ -0,0 +1,81 @@
+#!/usr/bin/python2
+
+# Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the summarize_runcommand_stats program."""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from chromite.buildbot import constants
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+
+from chromite.scripts import summarize_runcommand_stats as summarize
+
+
+class PercentileTest(cros_test_lib.TestCase):
+
+  def testPercentile(self):
+    values = range(1, 101)
+    self.assertEqual(summarize.Percentile(values, 95), 95)
+    self.assertEqual(summarize.Percentile(values, 100), 100)
+    self.assertEqual(summarize.Percentile([3], 95), 3)
+    self.assertEqual(summarize.Percentile([], 95), 0.0)
+
+
+class SummarizeTest(cros_test_lib.TempDirTestCase):
+
+  def setUp(self):
+    self.log = os.path.join(self.tempdir, 'stats.json')
+    self.old_env = os.environ.get(constants.RUNCOMMAND_STATS_ENVVAR)
+    os.environ[constants.RUNCOMMAND_STATS_ENVVAR] = self.log
+
+  def tearDown(self):
+    if self.old_env is None:
+      os.environ.pop(constants.RUNCOMMAND_STATS_ENVVAR)
+    else:
+      os.environ[constants.RUNCOMMAND_STATS_ENVVAR] = self.old_env
+
+  def testRunCommandRecords(self):
+    """Verify RunCommand writes records that Summarize can group."""
+    cros_build_lib.RunCommand(['echo', 'foo'], redirect_stdout=True)
+    cros_build_lib.RunCommand(['true', 'a'], error_code_ok=True)
+    cros_build_lib.RunCommand(['false', 'b'], error_code_ok=True)
+    with cros_build_lib.CommandPool() as pool:
+      pool.RunCommand(['true', 'c'])
+    # Corrupt records must be skipped.
+    with open(self.log, 'a') as f:
+      f.write('{"argv": \n')
+
+    records = list(summarize.LoadRecords(self.log))
+    self.assertEqual(len(records), 4)
+    self.assertEqual(records[0]['argv0'], 'echo')
+    self.assertEqual(records[0]['stdout_bytes'], 4)
+    self.assertTrue('utime' in records[0])
+    self.assertEqual(records[2]['returncode'], 1)
+
+    stats = summarize.Summarize(records, depth=1)
+    self.assertEqual(sorted(stats), ['echo', 'false', 'true'])
+    self.assertEqual(stats['true'].count, 2)
+    self.assertEqual(stats['false'].failures, 1)
+
+  def testMain(self):
+    """Verify the summary can be produced."""
+    osutils.WriteFile(self.log, json.dumps({
+        'argv0': 'sudo', 'argv': ['git', 'fetch'], 'wall': 1.5,
+        'returncode': 0, 'stdout_bytes': 0, 'stderr_bytes': 10}) + '\n')
+    with cros_test_lib.OutputCapturer() as output:
+      summarize.main([self.log, '--sort', 'p95'])
+    self.assertTrue('git fetch' in output.GetStdout())
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()